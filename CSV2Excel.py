@@ -8,13 +8,38 @@ formulation sheet with the standard formatting of the Dahlman Lab. Lastly, perfo
 enrichment analysis by formulation composition and specified cell type.
 '''
 import math
-from openpyxl import Workbook
+import re
+import warnings
 import pandas as pd
 import numpy as np
-import openpyxl
+
+import Enrichment_cache
+import Enrichment_output
+import Enrichment_permutation
+import Enrichment_profile
+import Enrichment_store
+
+# end of a sample name: organ letter, cell type letters and replicate number (e.g. "AD SB102"),
+# optionally followed by a sequencing sample number ("AD SB102_S7") and the number pandas adds to
+# repeated column names ("AD SB102.1")
+SAMPLE_NAME = re.compile(r"([A-Za-z])([A-Za-z]*)[ _-]?([0-9]*)(?:_S[0-9]+)?(?:\.[0-9]+)?\s*$")
+
+# largest count matrix np.percentile copies to find the outlier percentile, larger matrices (and
+# counts read in chunks) are read in blocks with the quantile sketch instead
+PERCENTILE_COPY_BYTES = 1 << 30 # 1 GB
+
+# component types and mole ratios of the formulation sheet
+COMPONENTS = ["Lipomer %", "Cholesterol %", "PEG %", "Phospholipid %", "Lipomer", "Cholesterol",\
+                "PEG", "Phospholipid"]
 
 def run_enrichment_analysis(destination_folder, formulations_sheet, csv_filepath, sorted_cells,\
-                            x_percent, sort_by, percentile=99.9):
+                            x_percent, sort_by, percentile=99.9, one_workbook=True,\
+                            chunksize=None, exact_percentile=True,\
+                            cache_folder=Enrichment_cache.DEFAULT_CACHE_FOLDER,\
+                            output_backend="xlsx", hooks=None, profile_report=False,\
+                            trace_allocations=False, permutations=1000,\
+                            permutation_workers=None, x_percent_sweep=None,\
+                            percentile_sweep=None, compact_dtypes=False, replicates=False):
     '''
     run_enrichment_analysis : uses all other functions to create enrichment analysis
         inputs:
@@ -25,416 +50,1064 @@ def run_enrichment_analysis(destination_folder, formulations_sheet, csv_filepath
             csv_filepath : user specified file path to csv with normalized counts
             sorted_cells : user specified list of cells that were sorted
             x_percent : user specified integer to find top and bottom performing LNPs (0-100)
-            sort_by : user specified cell type/organ/avg across organs to sort by
+            sort_by : user specified cell type/organ/avg across organs to sort by, a list of them
+                    or "all" for every sorted cell, organ and the average across organs
+            percentile : percentile of values accepted (default = 99.9%)
+            one_workbook : if several sort_by are given, saves all of them on a single excel
+                        spreadsheet (default = True) or on one excel spreadsheet per sort_by
+            chunksize : number of rows of the csv read at a time (default = None, reads the whole
+                        file at once)
+            exact_percentile : finds exact value at percentile (default = True) or estimates it
+                                from the quantile sketch only
+            cache_folder : folder to cache the results of reading, outlier removal, merging and
+                            averaging in, so runs that only change x_percent or sort_by skip them
+                            (default = ~/.cache/enrichment_analysis), None to not cache them
+            output_backend : format of the results, "xlsx" (default), "xlsx-stream" (constant
+                            memory excel writer), "csv" or "parquet" (folder with a file per
+                            sheet), "hdf5" or "npz" (single file)
+            hooks : list of callables called with the record of each stage as it ends (see
+                    Enrichment_profile)
+            profile_report : saves the records of all stages as "Enrichment Profile" + sort_by +
+                            ".json" on destination_folder (default = False)
+            trace_allocations : records peak memory allocated by each stage (default = False,
+                                slows the run down)
+            permutations : number of random top/bottom sets to find the p-value and FDR of each
+                            net enrichment factor (default = 1000, 0 to not test them)
+            permutation_workers : number of worker processes of the permutation test (default =
+                                None, one per CPU for large screens)
+            x_percent_sweep : list of x_percent (e.g. range(1, 51)) to calculate enrichment,
+                            depletion and net enrichment factors of, on a sheet named "X Percent
+                            Sweep" + sort_by (default = None, no sweep)
+            percentile_sweep : list of outlier percentiles (e.g. [99, 99.5, 99.9]) to show
+                            averaged counts and net enrichment factors of, on sheets named
+                            "Percentile Sweep" (default = None, no sweep)
+            compact_dtypes : stores components as categoricals and counts as float32, lowering
+                            peak memory (default = False), counts and factors of the output differ
+                            by float32 precision (relative 1e-7, see README)
+            replicates : adds a sheet named "Replicate Enrichment" + sort_by with the net
+                        enrichment factors of the LNPs ranked on each sample of sort_by, and their
+                        mean and spread across samples (default = False)
+        output:
+            report : dictionary with timing and memory of every stage of the run, and the number of
+                    barcodes of the counts and of the formulation sheet left out of the merge
+                    ("unmatched_barcodes")
     '''
 
     # check if no input (reset to 99.9)
     if percentile == 0.0:
         percentile = 99.9
 
-    # create excel destination file
-    destination_file = create_excel_spreadsheet(destination_folder + "/", sort_by) #added "+ '/'"
+    # missing packages of the output are found before the analysis, not when saving it
+    Enrichment_output.check_backend(output_backend)
 
-    # Import formulation sheet and create dataframe
-    df_formulations = create_df_formulation_sheet(formulations_sheet, destination_file)
+    sort_targets = get_sort_targets(sort_by, sorted_cells)
+    profiler = Enrichment_profile.Profiler(hooks, trace_allocations)
+
+    cache = None
+    if cache_folder is not None:
+        cache = Enrichment_cache.DiskCache(cache_folder)
+
+    if one_workbook or len(sort_targets) == 1:
+        if isinstance(sort_by, str):
+            workbooks = {sort_by : sort_targets}
+        else:
+            workbooks = {"-".join(sort_targets) : sort_targets}
+    else:
+        workbooks = {target : [target] for target in sort_targets}
+
+    # stages of the screen are counted by create_screen from its stage graph
+    profiler.expect(count_workbook_stages(workbooks, permutations, x_percent_sweep,\
+                                        percentile_sweep, replicates))
+
+    # read, remove outliers, merge and average once for all sort_by
+    screen = create_screen(formulations_sheet, csv_filepath, sorted_cells, sort_targets,\
+                            percentile, chunksize, exact_percentile, cache, profiler,\
+                            compact_dtypes)
+
+    # outliers removed at every percentile of the sweep from a single sorted copy of the counts
+    sweep = None
+    if percentile_sweep is not None:
+        with profiler.stage("percentile sweep") as record:
+            sweep = sweep_outlier_percentile(screen, sorted_cells, sort_targets, x_percent,\
+                                            percentile_sweep)
+            record["rows"], record["columns"] = screen["df_norm_counts"].shape
+
+    for workbook_name, workbook_targets in workbooks.items():
+        # create excel destination file
+        destination_file = create_excel_spreadsheet(destination_folder + "/", workbook_name,\
+                            extension=Enrichment_output.OUTPUT_EXTENSIONS.get(output_backend, ""))
+
+        # single output session for the whole run, flushed to disk once when closed, and removed
+        # if any stage fails (or is cancelled) so no partial workbook is left
+        with Enrichment_output.open_output(destination_file, output_backend) as output:
+            create_enrichment_workbook(output, screen, sorted_cells, workbook_targets, x_percent,\
+                                        profiler, destination_file, permutations,\
+                                        permutation_workers, x_percent_sweep, replicates)
+            if sweep is not None:
+                with profiler.stage("percentile sweep sheets", destination_file):
+                    create_percentile_sweep(output, sweep, workbook_targets)
+            with profiler.stage("save " + workbook_name, destination_file):
+                output.close()
+
+    if profile_report:
+        run_name = sort_by if isinstance(sort_by, str) else "-".join(sort_targets)
+        profiler.write_report(create_excel_spreadsheet(destination_folder + "/", run_name,\
+                                "Enrichment Profile ", ".json"))
+
+    report = profiler.report()
+    report["unmatched_barcodes"] = screen["unmatched_barcodes"]
+
+    return report
+
+def count_workbook_stages(workbooks, permutations=0, x_percent_sweep=None, percentile_sweep=None,\
+                            replicates=False):
+    '''
+    count_workbook_stages : returns number of stages recorded by run_enrichment_analysis after the
+                            screen is created (see create_enrichment_workbook)
+        inputs:
+            workbooks : dictionary of workbook name : list of sort_by on the workbook
+            permutations : number of random top/bottom sets of the permutation test (default = 0)
+            x_percent_sweep : list of x_percent of the sweep (default = None, no sweep)
+            percentile_sweep : list of outlier percentiles of the sweep (default = None, no sweep)
+            replicates : adds net enrichment factors of every replicate (default = False)
+        output:
+            stages : number of stages
+    '''
+
+    # top/bottom, net enrichment and winning LNPs of every sort_by, and its optional sheets
+    target_stages = 3 + int(bool(permutations)) + int(x_percent_sweep is not None) +\
+                    int(bool(replicates))
+    # shared sheets, enrichment tables and save of every workbook, and its percentile sweep sheets
+    workbook_stages = 3 + int(percentile_sweep is not None)
+
+    stages = int(percentile_sweep is not None) # percentile sweep
+    for workbook_targets in workbooks.values():
+        stages += workbook_stages + target_stages*len(workbook_targets)
+
+    return stages
 
-    # Read CSV file and save as dataframe
-    df_norm_counts = create_df_norm_counts(csv_filepath, destination_file)
+def get_sort_targets(sort_by, sorted_cells):
+    '''
+    get_sort_targets : returns list of cell types/organs/avg across organs to sort by
+        inputs:
+            sort_by : user specified cell type/organ/avg across organs to sort by, a list of them
+                    or "all"
+            sorted_cells : user specified list of cells that were sorted
+        output:
+            sort_targets : list of cell types/organs/avg across organs to sort by
+    '''
+
+    if sort_by == "all":
+        organs = []
+        for cell in sorted_cells:
+            if cell[0] not in organs:
+                organs.append(cell[0])
+        sort_targets = sorted_cells + organs + ["AVG"]
+    elif isinstance(sort_by, str):
+        sort_targets = [sort_by]
+    else:
+        sort_targets = list(sort_by)
+
+    return sort_targets
+
+def create_screen(formulations_sheet, csv_filepath, sorted_cells, sort_targets, percentile,\
+                    chunksize=None, exact_percentile=True, cache=None, profiler=None,\
+                    compact_dtypes=False):
+    '''
+    create_screen : reads formulation sheet and normalized counts, removes outliers, merges and
+                    averages them, all the work shared by every sort_by
+        inputs:
+            formulations_sheet : file path to excel sheet of formulation sheet
+            csv_filepath : file path to csv with normalized counts
+            sorted_cells : user specified list of cells that were sorted
+            sort_targets : list of cell types/organs/avg across organs to sort by
+            percentile : percentile of values accepted
+            chunksize : number of rows of the csv read at a time (default = None)
+            exact_percentile : finds exact value at percentile (default = True)
+            cache : Enrichment_cache.DiskCache to memoize each stage on (default = None)
+            profiler : Enrichment_profile.Profiler recording each stage (default = None)
+            compact_dtypes : stores components as categoricals and counts as float32 (default =
+                            False)
+        output:
+            screen : dictionary with formulations, normalized counts, merged (with and without
+                    outliers) and averaged dataframes, organized sample columns, sample index,
+                    barcode join, number of unmatched barcodes, component lists and enrichment of
+                    all LNPs
+    '''
+
+    # each stage declares what it depends on, stages whose inputs did not change since a previous
+    # run are loaded from the cache, only the stages downstream of a change are run
+    graph = Enrichment_cache.StageGraph(cache, profiler)
+
+    # Import formulation sheet and create dataframe
+    graph.add("read formulations", lambda: compact_formulations(create_df_formulation_sheet(\
+            formulations_sheet), compact_dtypes), [Enrichment_cache.file_hash(formulations_sheet),\
+            compact_dtypes])
+
+    # Read CSV file and save as dataframe, screen files are opened memory-mapped on every run
+    # rather than cached
+    if Enrichment_store.is_store(csv_filepath):
+        counts_hash, memoize_counts = Enrichment_store.source_hash(csv_filepath), False
+    else:
+        counts_hash, memoize_counts = Enrichment_cache.file_hash(csv_filepath), True
+    graph.add("read counts", lambda: compact_counts(create_df_norm_counts(csv_filepath,\
+            chunksize), compact_dtypes), [counts_hash, compact_dtypes], memoize=memoize_counts)
 
     # Remove outliers from normalized count dataframe
-    df_norm_no_outliers, sample_columns = create_df_norm_no_outliers(df_norm_counts, percentile)
+    graph.add("remove outliers", lambda df_norm_counts: create_df_norm_no_outliers(df_norm_counts,\
+            percentile, exact_percentile, chunksize is not None), [percentile, exact_percentile],\
+            ["read counts"])
+
+    # Parse sample names of the csv header once into organ, cell type and replicate
+    graph.add("index samples", lambda df_norm_counts: index_samples(\
+            df_norm_counts.columns.tolist()[1:]), [], ["read counts"], memoize=False)
 
     # Organize sample_columns by cell type
-    organized_columns = organize_cell_type(sample_columns, sorted_cells)
+    graph.add("organize columns", lambda sample_index: organize_cell_type(\
+            sample_index["columns"], sorted_cells, sample_index), [sorted_cells],\
+            ["index samples"], memoize=False)
+
+    # Index barcodes of the formulation sheet once, cached with it and reused by every screen of
+    # the same library
+    graph.add("barcode index", create_barcode_index, [], ["read formulations"])
+
+    # Rows of formulations and normalized counts with the same barcode, shared by both merges
+    graph.add("join barcodes", lambda barcode_index, df_norm_counts: join_barcodes(barcode_index,\
+            df_norm_counts["BC"]), [], ["barcode index", "read counts"])
 
     # Merge formulations and normalized counts data frames
     # with outliers
-    merge_formulations_and_norm_counts(df_formulations, df_norm_counts,\
-                                    organized_columns, destination_file, True)
+    graph.add("merge with outliers", lambda df_formulations, df_norm_counts, organized_columns,\
+            join: merge_formulations_and_norm_counts(df_formulations, df_norm_counts,\
+            organized_columns, join), [], ["read formulations", "read counts", "organize columns",\
+            "join barcodes"])
     # without outliers
-    df_merged = merge_formulations_and_norm_counts(df_formulations, df_norm_no_outliers,\
-                                                    organized_columns, destination_file)
+    graph.add("merge without outliers", lambda df_formulations, no_outliers, organized_columns,\
+            join: merge_formulations_and_norm_counts(df_formulations, no_outliers[0],\
+            organized_columns, join), [], ["read formulations", "remove outliers",\
+            "organize columns", "join barcodes"])
 
     # Average sample normalized counts by cell type
-    df_averaged = average_normalized_counts(df_merged, organized_columns, sorted_cells,\
-                                            destination_file, sort_by)
+    graph.add("average", lambda df_merged, organized_columns, sample_index:\
+            average_normalized_counts(df_merged, organized_columns, sorted_cells, sort_targets,\
+            sample_index), [sorted_cells, sort_targets], ["merge without outliers",\
+            "organize columns", "index samples"])
+
+    # component lists and enrichment of all LNPs do not depend on sort_by
+    graph.add("enrichment all LNPs", enrichment_all_LNPs, [], ["average"])
+
+    # every stage is loaded or run at most once below
+    if profiler is not None:
+        profiler.expect(len(graph.stages))
+
+    screen = {"df_formulations" : graph.get("read formulations"),\
+            "df_norm_counts" : graph.get("read counts"),\
+            "df_merged_outliers" : graph.get("merge with outliers"),\
+            "df_merged" : graph.get("merge without outliers"),\
+            "df_averaged" : graph.get("average"),\
+            "organized_columns" : graph.get("organize columns"),\
+            "sample_index" : graph.get("index samples"),\
+            "barcode_join" : graph.get("join barcodes")}
+    screen["unmatched_barcodes"] = screen["barcode_join"]["unmatched"]
+    screen["dict_components"], screen["df_levels_averaged"] = graph.get("enrichment all LNPs")
+
+    # stages needed only by stages loaded from the cache were not loaded or run
+    if profiler is not None:
+        profiler.expect(len(graph.results) - len(graph.stages))
+
+    return screen
+
+def enrichment_all_LNPs(df_averaged):
+    '''
+    enrichment_all_LNPs : returns component lists and level table (count and fraction of every
+    component level) of all LNPs of df_averaged
+    '''
+    dict_components = get_lists_of_components(df_averaged)
+    df_levels_averaged = get_all_enrichments(df_averaged, dict_components,\
+                                            {"Averaged" : None})["Averaged"]
 
-    # create top and bottom x_percent enrichment tables by specified cell type
-    d_df_components_top, d_df_components_bottom = top_bottom_enrichment(destination_file,\
-                                                    sort_by, df_averaged, x_percent)
+    return dict_components, df_levels_averaged
 
-    # create enrichment tables
-    d_df_components_averaged = create_enrichment_tables(destination_file, df_averaged)
+def create_enrichment_workbook(output, screen, sorted_cells, sort_targets, x_percent,\
+                                profiler=None, destination_file=None, permutations=0,\
+                                permutation_workers=None, x_percent_sweep=None,\
+                                replicates=False):
+    '''
+    create_enrichment_workbook : writes shared sheets of the screen and the enrichment analysis of
+                                each sort_by onto a workbook
+        inputs:
+            output : open Enrichment_output session of the destination
+            screen : dictionary returned by create_screen
+            sorted_cells : user specified list of cells that were sorted
+            sort_targets : list of cell types/organs/avg across organs on this workbook
+            x_percent : user specified integer to find top and bottom performing LNPs (0-100)
+            profiler : Enrichment_profile.Profiler recording each stage (default = None)
+            destination_file : path of the output, to measure bytes written (default = None)
+            permutations : number of random top/bottom sets of the permutation test of net
+                            enrichment factors (default = 0, not tested)
+            permutation_workers : number of worker processes of the permutation test (default =
+                                None)
+            x_percent_sweep : list of x_percent to calculate factors of (default = None, no sweep)
+            replicates : adds net enrichment factors ranked on each sample of sort_by (default =
+                        False)
+    '''
 
-    # create net enrichment factor sheet
-    create_net_enrichment_factor(destination_file, d_df_components_averaged,\
-                                d_df_components_top, d_df_components_bottom, sort_by)
+    if profiler is None:
+        profiler = Enrichment_profile.Profiler()
 
-    #create sheet with top/winning LNPs
-    winning_LNPs(sort_by, df_averaged, x_percent, destination_file)
+    # averaged counts with only the organ/avg columns of this workbook's sort_by
+    l1 = screen["df_averaged"].columns.tolist()[:10] # columns up to phospholipid%
+    extra_columns = [target for target in sort_targets if target not in sorted_cells]
+    df_averaged = screen["df_averaged"][l1 + sorted_cells + extra_columns]
 
-def winning_LNPs(sort_by, df_averaged, x_percent, destination_file):
+    with profiler.stage("shared sheets", destination_file) as record:
+        output.write_sheet("Formulations", [(screen["df_formulations"], 0, 0)])
+        output.write_sheet("Normalized Counts", [(screen["df_norm_counts"], 0, 0)])
+        output.write_sheet("Formulations + Norm Counts", [(screen["df_merged_outliers"], 0, 0)])
+        output.write_sheet("Averaged Norm Counts", [(df_averaged, 0, 0)])
+        record["rows"], record["columns"] = screen["df_merged_outliers"].shape
+
+    # create top and bottom x_percent enrichment tables by specified cell type
+    d_top_bottom = {}
+    orders = {}
+    for sort_by in sort_targets:
+        with profiler.stage("top/bottom " + sort_by, destination_file) as record:
+            # LNPs are ranked once per sort_by, the same order is used by all tables of sort_by
+            orders[sort_by] = rank_norm_counts(sort_by, df_averaged)
+            d_top_bottom[sort_by] = top_bottom_enrichment(output, sort_by, df_averaged,\
+                                        x_percent, screen["dict_components"], orders[sort_by])
+            record["rows"], record["columns"] = df_averaged.shape
+
+    # create enrichment tables
+    with profiler.stage("enrichment tables", destination_file) as record:
+        create_enrichment_tables(output, df_averaged, screen["df_levels_averaged"])
+        record["rows"], record["columns"] = df_averaged.shape
+
+    for sort_by in sort_targets:
+        df_levels_top, df_levels_bottom, df_top = d_top_bottom[sort_by]
+
+        # p-value and FDR of net enrichment factors
+        df_significance = None
+        if permutations:
+            with profiler.stage("permutation test " + sort_by) as record:
+                top, bottom = top_and_bottom_percent(df_averaged, sort_by, x_percent,\
+                                                    orders[sort_by])
+                df_significance = Enrichment_permutation.permutation_test(df_averaged,\
+                        screen["dict_components"], top, bottom, permutations, permutation_workers)
+                record["rows"], record["columns"] = permutations, len(df_averaged)
+
+        # create net enrichment factor sheet
+        with profiler.stage("net enrichment " + sort_by, destination_file) as record:
+            df_model = enrichment_model(screen["df_levels_averaged"], df_levels_top,\
+                                        df_levels_bottom, df_significance)
+            create_net_enrichment_factor(output, df_model, sort_by)
+            record["rows"], record["columns"] = df_model.shape
+
+        #create sheet with top/winning LNPs
+        with profiler.stage("winning LNPs " + sort_by, destination_file) as record:
+            winning_LNPs(sort_by, df_top, output)
+            record["rows"], record["columns"] = df_top.shape
+
+        # create sheet with factors of every x_percent of the sweep
+        if x_percent_sweep is not None:
+            with profiler.stage("x percent sweep " + sort_by, destination_file) as record:
+                create_x_percent_sweep(output, df_averaged, sort_by, screen["dict_components"],\
+                                        x_percent_sweep, orders[sort_by])
+                record["rows"], record["columns"] = len(x_percent_sweep), len(df_averaged)
+
+        # create sheet with net enrichment factors of every replicate of sort_by
+        if replicates:
+            with profiler.stage("replicate enrichment " + sort_by, destination_file) as record:
+                samples = target_samples(sort_by, sorted_cells, screen["sample_index"],\
+                                        screen["organized_columns"])
+                df_replicates = replicate_enrichment(screen["df_merged"], samples,\
+                                        screen["dict_components"], x_percent)
+                create_replicate_enrichment(output, df_replicates, sort_by)
+                record["rows"], record["columns"] = len(screen["df_merged"]), len(samples)
+
+def winning_LNPs(sort_by, df_top, output):
     '''
     winning_LNPs: creates excel sheet with formulations and normalized counts of top performing LNPs
                 named " Winning LNPS" + sort_by
         inputs:
             sort_by : user specified cell type to sort by
-            df_averaged : dataframe with averaged normalized counts by cell type
-            x_percent : user specified integer to find top and bottom performing LNPs (0-100)
-            destination_file : directory of the excel spreadsheet
+            df_top : dataframe of top performing LNPs, in descending order
+            output : open Enrichment_output session of the destination
     '''
 
-    df_sorted = sort_norm_counts(sort_by, df_averaged)
-    df_top, _ = top_and_bottom_percent(df_sorted, x_percent)
-
     winning_LNP_sheet = "Winning LNPs " + sort_by
-    with pd.ExcelWriter(destination_file, engine="openpyxl", mode="a")\
-    as writer: # pylint: disable=abstract-class-instantiated
-        df_top.to_excel(writer, sheet_name=winning_LNP_sheet, index=False)
+    output.write_sheet(winning_LNP_sheet, [(df_top, 0, 0)])
 
-def create_net_enrichment_factor(destination_file, d_df_components_averaged,\
-                                d_df_components_top, d_df_components_bottom, sort_by):
+def create_x_percent_sweep(output, df_averaged, sort_by, dict_components, x_percents,\
+                            order=None):
     '''
-    create_net_enrichment_factor: creates excel sheet with all enrichment analysis (averaged, top,
-                        bottom, raw enrichment and net enrichment factor) named "Net Enrichment
-                        Factors"
+    create_x_percent_sweep: creates excel sheet with enrichment, depletion and net enrichment
+                            factors of every x_percent of the sweep, a table per component,
+                            named "X Percent Sweep" + sort_by
         inputs:
-            destination_file : directory of the excel spreadsheet
-            d_df_components_averaged : dictionary with all dataframes of all enrichment calculations
-                                        of df_averaged
-            d_df_components_top : dictionary with all dataframes of all enrichment calculations of
-                                    df_top
-            d_df_components_bottom : dictionary with all dataframes of all enrichment calculations
-                                    of df_bottom
+            output : open Enrichment_output session of the destination
+            df_averaged : dataframe with averaged normalized counts by cell type
             sort_by : user specified cell type to sort by
-	'''
-
-    d_df_component_net_enrichment, d_raw_enrichment_top, d_raw_enrichment_bottom = \
-                net_enrichment_factor(d_df_components_averaged, d_df_components_top,\
-                                    d_df_components_bottom, sort_by)
-    dict_df_raw_enrichment_top = dict_list_to_dict_df(d_raw_enrichment_top, sort_by)
-    dict_df_raw_enrichment_bottom = dict_list_to_dict_df(d_raw_enrichment_bottom, sort_by)
-    current_row = 1 # variable to place formulation enrichments by mole ratio
-    net_enrichment_sheet = "Net Enrichment Factors " + sort_by
+            dict_components : dictionary containing list of all the component mole ratios and
+                            types
+            x_percents : list of x_percent (0-100)
+            order : positions of LNPs of df_averaged in descending order by sort_by (default =
+                    None, ranks them)
+    '''
 
-    list_enrichments = ["Lipomer %", "Cholesterol %", "PEG %", "Phospholipid %", "Lipomer",\
-                        "Cholesterol", "PEG", "Phospholipid"]
-
-    with pd.ExcelWriter(destination_file, engine="openpyxl", mode="a")\
-    as writer: # pylint: disable=abstract-class-instantiated
-
-        for item in list_enrichments:
-            d_df_components_averaged[item].to_excel(writer, sheet_name=net_enrichment_sheet,\
-                                                    startrow=current_row, startcol=0, index=False)
-            d_df_components_top[item].to_excel(writer, sheet_name=net_enrichment_sheet,\
-                                                    startrow=current_row, startcol=4, index=False)
-            dict_df_raw_enrichment_top[item].to_excel(writer, sheet_name=net_enrichment_sheet,\
-                                                    startrow=current_row, startcol=8, index=False)
-            d_df_components_bottom[item].to_excel(writer, sheet_name=net_enrichment_sheet,\
-                                                    startrow=current_row, startcol=11, index=False)
-            dict_df_raw_enrichment_bottom[item].to_excel(writer, sheet_name=net_enrichment_sheet,\
-                                                    startrow=current_row, startcol=15, index=False)
-            d_df_component_net_enrichment[item].to_excel(writer, sheet_name=net_enrichment_sheet,\
-                                                    startrow=current_row, startcol=18, index=False)
-            current_row += len(d_df_components_averaged[item]) + 2
-
-    xfile = openpyxl.load_workbook(destination_file)
-    sheet = xfile[net_enrichment_sheet]
-    sheet["A1"] = "Formulation Enrichment"
-    sheet["E1"] = "Top"
-    sheet["I1"] = "Enrichment Factor Top"
-    sheet["L1"] = "Bottom"
-    sheet["P1"] = "Depletion Factor Bottom"
-    sheet["S1"] = "Net Enrichment Factor"
-    xfile.save(destination_file)
-
-def dict_list_to_dict_df(dict_list, sort_by):
-    '''
-    dict_list_to_dict_df: converts dictionary with lists to dictionary with dataframes
-        inputs:
-            dict_list: dictionary containing lists
+    d_df_sweep = sweep_x_percent(df_averaged, sort_by, dict_components, x_percents, order)
+
+    current_row = 0
+    blocks = []
+    cells = {}
+    tables = []
+    for component, df_sweep in d_df_sweep.items():
+        cells["A" + str(current_row + 1)] = component
+        blocks.append((df_sweep, current_row + 1, 0))
+        current_row += len(df_sweep) + 3
+
+        # one row per level and x_percent, for outputs that are not spreadsheets
+        for level in dict_components[component]:
+            tables.append(pd.DataFrame({"Component" : component, "Level" : level,\
+                "X %" : df_sweep["X %"].to_numpy(),\
+                "Enrichment Factor Top" : df_sweep[str(level) + " Top"].to_numpy(),\
+                "Depletion Factor Bottom" : df_sweep[str(level) + " Bottom"].to_numpy(),\
+                "Net Enrichment Factor" : df_sweep[str(level) + " Net"].to_numpy()}))
+
+    output.write_sheet("X Percent Sweep " + sort_by, blocks,\
+                        numeric_table(pd.concat(tables, ignore_index=True)), cells)
+
+def sweep_x_percent(df_averaged, sort_by, dict_components, x_percents, order=None):
+    '''
+    sweep_x_percent: calculates enrichment, depletion and net enrichment factors of the top and
+                    bottom performing LNPs of many x_percent at once, from cumulative counts over
+                    the LNPs ranked by sort_by
+        inputs:
+            df_averaged : dataframe with averaged normalized counts by cell type
             sort_by : user specified cell type to sort by
+            dict_components : dictionary containing list of all the component mole ratios and
+                            types
+            x_percents : list of x_percent (0-100)
+            order : positions of LNPs of df_averaged in descending order by sort_by (default =
+                    None, ranks them)
         output:
-            dict_df : dictionary with dataframes
+            d_df_sweep : dictionary with a dataframe per component with a row per x_percent, the
+                        number of top and bottom LNPs and the enrichment ("Top"), depletion
+                        ("Bottom") and net enrichment ("Net") factors of each level
     '''
 
-    dict_df = {}
-    for component in dict_list:
-        np_temporary = np.array(dict_list[component])
-        dict_df[component] = pd.DataFrame(data=np_temporary, columns=[component, sort_by])
+    if order is None:
+        order = rank_norm_counts(sort_by, df_averaged)
+
+    # same numbers of top and bottom LNPs as top_and_bottom_percent
+    total_LNP = len(df_averaged.index) - 2 # subtract two because of naked barcodes
+    n_top = np.array([math.ceil(total_LNP*(x_percent/100)) for x_percent in x_percents], dtype=int)
+    n_bottom = np.minimum(n_top + 2, len(df_averaged.index))
+
+    codes, offsets = Enrichment_permutation.encode_components(df_averaged, dict_components)
+    fractions_all = level_fractions(np.bincount(codes.ravel(), minlength=offsets[-1]), offsets)
+    fractions_top = level_fractions(prefix_counts(codes[order], n_top, offsets[-1]), offsets)
+    fractions_bottom = level_fractions(prefix_counts(codes[order[::-1]], n_bottom, offsets[-1]),\
+                                        offsets)
+
+    # factors rounded as enrichment_model rounds them, so the row of the run's x_percent is the
+    # same as the Net Enrichment Factors sheet
+    with np.errstate(divide="ignore", invalid="ignore"):
+        factors_top = np.round(fractions_top/fractions_all, 9)
+        factors_bottom = np.round(fractions_bottom/fractions_all, 9)
+    factors_net = np.round(factors_top - factors_bottom, 9)
+
+    d_df_sweep = {}
+    for index, (component, component_list) in enumerate(dict_components.items()):
+        df_sweep = pd.DataFrame({"X %" : list(x_percents), "Top LNPs" : n_top,\
+                                "Bottom LNPs" : n_bottom})
+        for position, level in enumerate(component_list):
+            level_bin = offsets[index] + position
+            df_sweep[str(level) + " Top"] = factors_top[:, level_bin]
+            df_sweep[str(level) + " Bottom"] = factors_bottom[:, level_bin]
+            df_sweep[str(level) + " Net"] = factors_net[:, level_bin]
+        d_df_sweep[component] = df_sweep
+
+    return d_df_sweep
+
+def prefix_counts(ranked_codes, n_lnps, n_bins):
+    '''
+    prefix_counts: counts the first LNPs of a ranking on every bin, for many numbers of LNPs with a
+                single bincount and a cumulative sum
+        inputs:
+            ranked_codes : array (LNPs x components) of bins from encode_components, in rank order
+            n_lnps : array of numbers of first LNPs to count
+            n_bins : total number of bins
+        output:
+            counts : array (len(n_lnps) x bins) of counts of the first n_lnps LNPs on each bin
+    '''
+
+    boundaries = np.unique(n_lnps)
+    # segment of each ranked LNP, counted by every prefix from its segment's boundary on
+    segments = np.searchsorted(boundaries, np.arange(len(ranked_codes)), side="right")
+    counted = segments < len(boundaries)
+    bins = ranked_codes[counted] + (segments[counted]*n_bins)[:, None]
+    counts = np.bincount(bins.ravel(), minlength=len(boundaries)*n_bins)
+    counts = counts.reshape(len(boundaries), n_bins).cumsum(axis=0)
 
-    return dict_df
+    return counts[np.searchsorted(boundaries, n_lnps)]
 
-def net_enrichment_factor(d_df_components_averaged, d_df_components_top,\
-                            d_df_components_bottom, sort_by):
+def create_replicate_enrichment(output, df_replicates, sort_by):
     '''
-    net_enrichment_factor: creates dataframes for best and worst performing LNPs, counts and their
-                        formulations
+    create_replicate_enrichment: creates excel sheet with net enrichment factors of the LNPs ranked
+                                on each sample of sort_by, a table per component, named
+                                "Replicate Enrichment" + sort_by
         inputs:
-            d_df_components_averaged : dictionary with all dataframes of all enrichment
-                                        calculations of df_averaged
-            d_df_components_top : dictionary with all dataframes of all enrichment calculations
-                                    of df_top
-            d_df_components_bottom : dictionary with all dataframes of all enrichment
-                                    calculations of df_bottom
+            output : open Enrichment_output session of the destination
+            df_replicates : dataframe returned by replicate_enrichment
             sort_by : user specified cell type to sort by
+    '''
+
+    blocks = component_blocks(df_replicates, df_replicates.columns.tolist())
+    output.write_sheet("Replicate Enrichment " + sort_by, blocks, tidy_table(df_replicates),\
+                        {"A1" : "Net Enrichment Factor by Replicate"})
+
+def replicate_enrichment(df_merged, samples, dict_components, x_percent, block_size=64):
+    '''
+    replicate_enrichment: calculates net enrichment factors of the top and bottom performing LNPs
+                        of every sample, ranking LNPs on each sample instead of on their average,
+                        selecting and counting the top and bottom LNPs of a block of samples at
+                        once
+        inputs:
+            df_merged : dataframe of merged formulations and normalized counts without outliers
+            samples : list of sample columns of df_merged to rank LNPs on
+            dict_components : dictionary containing list of all the component mole ratios and
+                            types
+            x_percent : user specified integer to find top and bottom performing LNPs (0-100)
+            block_size : number of samples selected at a time (default = 64)
         output:
-            d_df_component_net_enrichment : dictionary with dataframes of net enrichment factors by
-                                            component type or mole ratio
-            d_raw_enrichment_factors_top: dictionary with dataframes of raw enrichment of top
-                                            performing LNPs
-            d_raw_enrichment_factors_bottom: dictionary with dataframes of raw enrichment of
-                                                bottom performing LNPs
+            df_replicates : dataframe indexed by (Component, Level) with the net enrichment factor
+                            of each level on every sample, and its "Mean", standard deviation
+                            ("SD"), "Min" and "Max" across samples
     '''
 
-    dict_component_net_enrichment_factor = {}
+    codes, offsets = Enrichment_permutation.encode_components(df_merged, dict_components)
+    counts_all = np.bincount(codes.ravel(), minlength=offsets[-1])
+
+    # same numbers of top and bottom LNPs as top_and_bottom_percent
+    total_LNP = len(df_merged.index) - 2 # subtract two because of naked barcodes
+    n_top = math.ceil(total_LNP*(x_percent/100))
+    n_bottom = min(n_top + 2, len(df_merged.index))
+
+    # (samples x bins) net enrichment factors of the top and bottom LNPs of each sample, selected
+    # as top_and_bottom_percent (missing counts last, ties by position) without sorting them
+    net = np.full((len(samples), offsets[-1]), np.nan)
+    for start in range(0, len(samples), block_size):
+        keys = -df_merged[samples[start:start + block_size]].to_numpy(dtype=np.float64).T
+        keys[np.isnan(keys)] = np.inf
+        top = select_rank_sets(keys, n_top)
+        bottom = keys.shape[1] - 1 - select_rank_sets(-keys[:, ::-1], n_bottom)
+        net[start:start + len(keys)] = Enrichment_permutation.net_enrichment(\
+                Enrichment_permutation.count_sets(codes, top, offsets[-1]),\
+                Enrichment_permutation.count_sets(codes, bottom, offsets[-1]), counts_all, offsets)
+    net = np.round(net, 9)
+
+    # TOTAL rows are left out
+    levels = np.ones(offsets[-1], dtype=bool)
+    levels[offsets[1:] - 1] = False
+    index = level_index(dict_components)[levels]
+
+    df_replicates = pd.DataFrame(net[:, levels].T, index=index, columns=samples)
+    with warnings.catch_warnings():
+        # levels without factors on any sample (no LNPs of them) have no mean or spread
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        df_replicates["Mean"] = np.round(np.nanmean(net[:, levels], axis=0), 9)
+        df_replicates["SD"] = np.round(np.nanstd(net[:, levels], axis=0, ddof=1), 9)
+        df_replicates["Min"] = np.nanmin(net[:, levels], axis=0)
+        df_replicates["Max"] = np.nanmax(net[:, levels], axis=0)
+
+    return df_replicates
+
+def target_samples(sort_by, sorted_cells, sample_index, organized_columns):
+    '''
+    target_samples: returns sample columns averaged into sort_by (samples of a cell type, of the
+                    cell types of an organ or of all sorted cells for "AVG"), in organized order
+        inputs:
+            sort_by : user specified cell type/organ/avg across organs to sort by
+            sorted_cells : user specified list of cells that were sorted
+            sample_index : index of sample names returned by index_samples
+            organized_columns : list of samples organized by cell types of sorted cells
+        output:
+            samples : list of sample columns of sort_by
+    '''
 
-    d_raw_enrichment_factors_top = raw_enrichment_factor(d_df_components_averaged,\
-                                                            d_df_components_top)
-    d_raw_enrichment_factors_bottom = raw_enrichment_factor(d_df_components_averaged,\
-                                                            d_df_components_bottom)
+    if sort_by in sorted_cells:
+        cell_types = [sort_by]
+    elif sort_by == "AVG":
+        cell_types = sorted_cells
+    else:
+        cell_types = group_by_organ(sorted_cells).get(sort_by, [])
 
-    for component in d_raw_enrichment_factors_top:
-        temporary_list = []
-        for index in range(len(d_raw_enrichment_factors_top[component])):
-            enrichment_factor_row_top = d_raw_enrichment_factors_top[component][index]
-            enrichment_factor_row_bottom = d_raw_enrichment_factors_bottom[component][index]
-            item = [enrichment_factor_row_top[0],\
-                    round(enrichment_factor_row_top[1] - enrichment_factor_row_bottom[1], 9)]
-            temporary_list.append(item)
+    organized = set(organized_columns)
+    samples = [sample for cell_type in cell_types for sample in\
+                sample_index["cell_types"].get(cell_type, []) if sample in organized]
 
-        dict_component_net_enrichment_factor[component] = temporary_list
+    return list(dict.fromkeys(samples))
 
-    d_df_component_net_enrichment = {"Lipomer %" : None, "Cholesterol %" : None, "PEG %" : None,\
-                                    "Phospholipid %" : None, "Lipomer" : None,\
-                                    "Cholesterol" : None, "PEG" : None, "Phospholipid" : None}
+def create_percentile_sweep(output, sweep, sort_targets):
+    '''
+    create_percentile_sweep: creates excel sheets with the outliers removed at each percentile of
+                            the sweep and the net enrichment factors of each sort_by at each
+                            percentile, named "Percentile Sweep", and the averaged counts of each
+                            sort_by at each percentile, named "Percentile Sweep Averaged"
+        inputs:
+            output : open Enrichment_output session of the destination
+            sweep : dictionary returned by sweep_outlier_percentile
+            sort_targets : list of cell types/organs/avg across organs on this workbook
+    '''
 
-    for component in dict_component_net_enrichment_factor:
-        np_temporary = np.array(dict_component_net_enrichment_factor[component])
-        d_df_component_net_enrichment[component] = pd.DataFrame(data=np_temporary,\
-                                                                columns=[component, sort_by])
+    blocks = [(sweep["df_summary"], 0, 0)]
+    cells = {}
+    tables = []
+    current_row = len(sweep["df_summary"]) + 2
+    for sort_by in sort_targets:
+        cells["A" + str(current_row + 1)] = "Net Enrichment Factor " + sort_by
+        blocks.append((sweep["d_df_net"][sort_by], current_row + 1, 0))
+        current_row += len(sweep["d_df_net"][sort_by]) + 3
+
+        # one row per level and percentile, for outputs that are not spreadsheets
+        df_net = sweep["d_df_net"][sort_by].melt(id_vars=["Component", "Level"],\
+                                        var_name="Percentile", value_name="Net Enrichment Factor")
+        df_net.insert(loc=0, column="Sort By", value=sort_by)
+        tables.append(df_net)
+
+    df_table = pd.concat(tables, ignore_index=True)
+    df_table["Level"] = df_table["Level"].astype(str)
+    df_table["Percentile"] = pd.to_numeric(df_table["Percentile"])
+    output.write_sheet("Percentile Sweep", blocks, df_table, cells)
+
+    columns = ["LNP", "BC"] + [column for column in sweep["df_averaged"].columns[2:]\
+                                if column.rsplit(" ", 1)[0] in sort_targets]
+    output.write_sheet("Percentile Sweep Averaged", [(sweep["df_averaged"][columns], 0, 0)])
+
+def create_net_enrichment_factor(output, df_model, sort_by):
+    '''
+    create_net_enrichment_factor: creates excel sheet with all enrichment analysis (averaged, top,
+                        bottom, raw enrichment and net enrichment factor) named "Net Enrichment
+                        Factors"
+        inputs:
+            output : open Enrichment_output session of the destination
+            df_model : enrichment table of sort_by returned by enrichment_model
+            sort_by : user specified cell type to sort by
+    '''
 
-    return d_df_component_net_enrichment, d_raw_enrichment_factors_top,\
-    d_raw_enrichment_factors_bottom
+    net_enrichment_sheet = "Net Enrichment Factors " + sort_by
+    significance = "P-value" in df_model.columns
+
+    # tables of every component side by side, components one under the other
+    columns = [(0, ["Total #", "% of Total"], None),\
+                (4, ["Top Total #", "Top % of Total"], ["Total #", "% of Total"]),\
+                (8, ["Enrichment Factor Top"], [sort_by]),\
+                (11, ["Bottom Total #", "Bottom % of Total"], ["Total #", "% of Total"]),\
+                (15, ["Depletion Factor Bottom"], [sort_by]),\
+                (18, ["Net Enrichment Factor"], [sort_by])]
+    blocks = []
+    for startcol, model_columns, names in columns:
+        blocks += component_blocks(df_model, model_columns, names, startcol)
+    if significance:
+        blocks += component_blocks(df_model, ["P-value", "FDR"], startcol=20, levels=False)
+
+    headers = {"A1" : "Formulation Enrichment", "E1" : "Top", "I1" : "Enrichment Factor Top",\
+                "L1" : "Bottom", "P1" : "Depletion Factor Bottom", "S1" : "Net Enrichment Factor"}
+    if significance:
+        headers["U1"] = "Permutation Test"
+
+    # same tables side by side as a single table, for outputs that are not spreadsheets
+    output.write_sheet(net_enrichment_sheet, blocks, tidy_table(df_model), headers)
+
+def enrichment_model(df_levels_averaged, df_levels_top, df_levels_bottom, df_significance=None):
+    '''
+    enrichment_model: creates the enrichment table of a sort_by, every column computed at once for
+                    all component levels
+        inputs:
+            df_levels_averaged : level table of all LNPs (see get_all_enrichments)
+            df_levels_top : level table of top performing LNPs
+            df_levels_bottom : level table of bottom performing LNPs
+            df_significance : dataframe of "P-value" and "FDR" of each row from
+                            Enrichment_permutation (default = None)
+        output:
+            df_model : dataframe indexed by (Component, Level) with the number and fraction of all,
+                    top and bottom LNPs, raw enrichment ("Enrichment Factor Top") and depletion
+                    ("Depletion Factor Bottom") factors, "Net Enrichment Factor" and, if given,
+                    "P-value" and "FDR"
+    '''
 
-def raw_enrichment_factor(d_df_components_averaged, d_df_components_top_bottom):
+    fraction_averaged = df_levels_averaged["% of Total"].to_numpy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        enrichment_top = np.round(df_levels_top["% of Total"].to_numpy()/fraction_averaged, 9)
+        depletion_bottom = np.round(df_levels_bottom["% of Total"].to_numpy()/fraction_averaged,\
+                                    9)
+
+    df_model = pd.DataFrame({"Total #" : df_levels_averaged["Total #"].to_numpy(),\
+                "% of Total" : fraction_averaged,\
+                "Top Total #" : df_levels_top["Total #"].to_numpy(),\
+                "Top % of Total" : df_levels_top["% of Total"].to_numpy(),\
+                "Enrichment Factor Top" : enrichment_top,\
+                "Bottom Total #" : df_levels_bottom["Total #"].to_numpy(),\
+                "Bottom % of Total" : df_levels_bottom["% of Total"].to_numpy(),\
+                "Depletion Factor Bottom" : depletion_bottom,\
+                "Net Enrichment Factor" : np.round(enrichment_top - depletion_bottom, 9)},\
+                index=df_levels_averaged.index)
+    if df_significance is not None:
+        df_model["P-value"] = df_significance["P-value"].to_numpy()
+        df_model["FDR"] = df_significance["FDR"].to_numpy()
+
+    return df_model
+
+def component_blocks(df_model, columns, names=None, startcol=0, levels=True):
     '''
-    raw_enrichment_factor: creates dataframes for best and worst performing LNPs, counts and their
-                            formulations
+    component_blocks: lays out columns of an enrichment or level table as one table per component,
+                    one under the other with a blank row in between
         inputs:
-            d_df_components_averaged : dictionary with all dataframes of all enrichment
-                                        calculations of df_averaged
-            d_df_components_top_bottom : dictionary with all dataframes of all enrichment
-                                        calculations of df_top_bottom_sort_by
+            df_model : dataframe indexed by (Component, Level)
+            columns : columns of df_model to lay out
+            names : names of the columns on the sheet (default = None, same as columns)
+            startcol : column of the sheet of the tables (default = 0)
+            levels : adds the levels as first column, named after the component (default = True)
         output:
-            dict_raw_enrichment_factors : dictionary with lists of all raw enrichment factors
+            blocks : list of (dataframe, startrow, startcol) of each component
     '''
 
-    dict_components_averaged = {}
-    dict_components_top_bottom = {}
-    dict_raw_enrichment_factors = {}
+    blocks = []
+    current_row = 1
+    components = df_model.index.get_level_values("Component")
+    for component in pd.unique(components):
+        rows = df_model[components == component]
+        df_block = rows[columns].reset_index(drop=True)
+        df_block.columns = names or columns
+        if levels:
+            df_block.insert(loc=0, column=component, value=rows.index.get_level_values(\
+                            "Level").astype(str))
+        blocks.append((df_block, current_row, startcol))
+        current_row += len(df_block) + 2
+
+    return blocks
+
+def tidy_table(df_model):
+    '''
+    tidy_table: returns enrichment or level table with Component and Level as columns, and its
+                levels (mole ratios, component names and "TOTAL") as text
+    '''
 
-    for component in d_df_components_averaged:
-        dict_components_averaged[component] = d_df_components_averaged[component].values.tolist()
-        dict_components_top_bottom[component] =\
-                            d_df_components_top_bottom[component].values.tolist()
+    df_table = df_model.reset_index()
+    df_table["Level"] = df_table["Level"].astype(str)
 
-        temporary_list = []
-        for index in range(len(dict_components_averaged[component])):
-            averaged_row = dict_components_averaged[component][index]
-            top_bottom_row = dict_components_top_bottom[component][index]
-            item = [averaged_row[0], round(float(top_bottom_row[2])/float(averaged_row[2]), 9)]
-            temporary_list.append(item)
+    return df_table
 
-        dict_raw_enrichment_factors[component] = temporary_list
+def numeric_table(df_table):
+    '''
+    numeric_table : returns table with its number columns (all but "Component" and "Level") as
+    numbers, and its levels (mole ratios, component names and "TOTAL") as text
+    '''
+
+    df_table["Level"] = df_table["Level"].astype(str)
+    for column in df_table.columns[2:]:
+        df_table[column] = pd.to_numeric(df_table[column])
 
-    return dict_raw_enrichment_factors
+    return df_table
 
-def top_bottom_enrichment(destination_file, sort_by, df_averaged, x_percent):
+def top_bottom_enrichment(output, sort_by, df_averaged, x_percent, dict_components, order=None):
     '''
     top_bottom_enrichment: creates dataframes for best and worst performing LNPs, counts and their
                             formulations
         inputs:
-            destination_file : directory of the excel spreadsheet
+            output : open Enrichment_output session of the destination
             sort_by : user specified cell type to sort by
             df_averaged : dataframe with averaged normalized counts by cell type
             x_percent : user specified integer to find top and bottom performing LNPs (0-100)
+            dict_components : dictionary containing list of all the component mole ratios and
+                            types
+            order : positions of LNPs of df_averaged in descending order by sort_by (default =
+                    None, ranks them)
         output:
-            d_df_components_top : dictionary containing dataframes with enrichment analysis of top
-                                    performing LNPs
-            d_df_components_bottom : dictionary containing dataframes with enrichment analysis of
-                                        bottom performing LNPs
+            df_levels_top : level table of top performing LNPs (see get_all_enrichments)
+            df_levels_bottom : level table of bottom performing LNPs
+            df_top : dataframe of top performing LNPs
     '''
 
     # sort normalized counts by cell type
-    df_sorted = sort_norm_counts(sort_by, df_averaged)
-    df_top, df_bottom = top_and_bottom_percent(df_sorted, x_percent)
+    if order is None:
+        order = rank_norm_counts(sort_by, df_averaged)
+    df_sorted = sort_norm_counts(sort_by, df_averaged, order)
+    top, bottom = top_and_bottom_percent(df_averaged, sort_by, x_percent, order)
+    df_top = df_averaged.take(top).reset_index(drop=True)
+
+    # count top and bottom performing LNPs together
+    dict_subset_levels = get_all_enrichments(df_averaged, dict_components, {"Top" : top,\
+                                            "Bottom" : bottom})
+    df_levels_top = dict_subset_levels["Top"]
+    df_levels_bottom = dict_subset_levels["Bottom"]
 
-    d_df_components_top = create_enrichment_tables(destination_file, df_averaged, df_top, sort_by,\
-                                                    "Top")
-    d_df_components_bottom = create_enrichment_tables(destination_file, df_averaged, df_bottom,\
-                                                        sort_by, "Bottom")
+    create_enrichment_tables(output, df_sorted, df_levels_top, sort_by, "Top")
+    create_enrichment_tables(output, df_sorted, df_levels_bottom, sort_by, "Bottom")
 
-    return d_df_components_top, d_df_components_bottom
+    return df_levels_top, df_levels_bottom, df_top
 
-def top_and_bottom_percent(df_sorted, x_percent):
+def top_and_bottom_percent(df_averaged, sort_by, x_percent, order=None):
     '''
-    top_and_bottom_percent: creates dataframes for best and worst performing LNPs, counts and their\
-                            formulations
+    top_and_bottom_percent: finds best and worst performing LNPs, selecting only them (without
+                            sorting all LNPs) if order is not given
         inputs:
-            df_sorted : dataframe with normalized counts sorted in descending order by specified\
-                        cell type
+            df_averaged : dataframe with averaged normalized counts by cell type
+            sort_by : user specified cell type to sort by
             x_percent : user specified integer to find top and bottom performing LNPs (0-100)
+            order : positions of LNPs of df_averaged in descending order by sort_by (default =
+                    None)
         output:
-            df_top : dataframe top performing LNPs
-            df_bottom : dataframe bottom performing LNPs
+            top : positions on df_averaged of top performing LNPs, in descending order
+            bottom : positions on df_averaged of bottom performing LNPs (+ 2), in descending order
     '''
 
-    total_LNP = len(df_sorted.index) - 2 # subtract two because of naked barcodes
+    total_LNP = len(df_averaged.index) - 2 # subtract two because of naked barcodes
     values_x_percent = math.ceil(total_LNP*(x_percent/100))
+    n_bottom = min(values_x_percent + 2, len(df_averaged.index))
 
-    # gets top x percent
-    df_top = df_sorted.loc[range(0, values_x_percent)]
-    # gets bottom x percent
-    df_bottom = df_sorted.loc[range(total_LNP - values_x_percent, total_LNP + 2)]
+    if order is not None:
+        # gets top x percent
+        top = order[:values_x_percent]
+        # gets bottom x percent
+        bottom = order[len(order) - n_bottom:]
+    else:
+        keys = rank_keys(sort_by, df_averaged)
+        top = select_ranks(keys, values_x_percent)
+        # bottom ranks are the top ranks of the reversed ranking
+        bottom = len(keys) - 1 - select_ranks(-keys[::-1], n_bottom)[::-1]
 
-    if "NAKED1" not in df_bottom["LNP"].to_list() and "NAKED2" not in df_bottom["LNP"].to_list():
+    lnps_bottom = df_averaged["LNP"].to_numpy()[bottom].tolist()
+    if "NAKED1" not in lnps_bottom and "NAKED2" not in lnps_bottom:
         raise NameError("Error: Naked barcodes not on bottom " + str(x_percent) + "% + 2!")
 
-    return df_top, df_bottom
+    return top, bottom
 
-def create_enrichment_tables(destination_file, df_averaged, df_top_bottom_sort_by=None,\
-                            sort_by=None, top_or_bottom=None):
+def create_enrichment_tables(output, df_table, df_levels, sort_by=None, top_or_bottom=None):
     '''
     create_enrichment_tables: creates excel sheet with formulation enrichment tables of averaged
-                            normalized counts (top or bottom performing LNPs if
-                            df_top_bottom_sort_by value is passed) named "Form Enrichment" (or
-                            "Form Enrichment" + sort_by + top_or_bottom if df_top_bottom_sort_by
-                            provided)
+                            normalized counts (top or bottom performing LNPs if sort_by value is
+                            passed) named "Form Enrichment" (or "Form Enrichment" + sort_by +
+                            top_or_bottom if sort_by provided)
         inputs:
-            destination_file : directory of the excel spreadsheet
-            df_averaged : dataframe with averaged normalized counts by cell type
-            df_top_bottom_sort_by : dataframe of either top or bottom performing LNPs by specified
-                                    cell type (default = None)
+            output : open Enrichment_output session of the destination
+            df_table : dataframe with averaged normalized counts by cell type (sorted by sort_by
+                        if sort_by is passed)
+            df_levels : level table of df_averaged (or of top or bottom performing LNPs) from
+                        get_all_enrichments
             sort_by : user specified cell type to sort by (default = None)
             top_or_bottom : specifies if enrichment is for top or bottom performing LNPs by
                             specified cell type(default = None)
-        output:
-            dict_df_components : dictionary with all data frames of all enrichment calculations of
-            df_averaged (or df_top_bottom_sort_by if inputted)
     '''
 
-    dict_df_components = get_all_enrichments(df_averaged, df_top_bottom_sort_by)
-
-    current_row_1 = 1 # variable to place formulation enrichments by mole ratio
-    current_row_2 = 1 # variable to place formulation enrichments by component
     enrichment_sheet = "Form Enrichment"
     if sort_by is not None:
         enrichment_sheet += " " + sort_by + " " + top_or_bottom
-    with pd.ExcelWriter(destination_file, engine="openpyxl", mode="a")\
-    as writer: # pylint: disable=abstract-class-instantiated
-        if df_top_bottom_sort_by is None:
-            df_averaged.to_excel(writer, sheet_name=enrichment_sheet, index=False)
-            off_set = len(df_averaged.columns)
-        else:
-            df_sorted_by_sort_by = sort_norm_counts(sort_by, df_averaged)
-            df_sorted_by_sort_by.to_excel(writer, sheet_name=enrichment_sheet, index=False)
-            off_set = len(df_sorted_by_sort_by.columns)
-
-        list_enrichments = ["Lipomer %", "Cholesterol %", "PEG %", "Phospholipid %", "Lipomer",\
-                            "Cholesterol", "PEG", "Phospholipid"]
-
-        for index in range(len(list_enrichments)//2):
-            dict_df_components[list_enrichments[index]].to_excel(writer,\
-            	    sheet_name=enrichment_sheet, startrow=current_row_1, startcol=off_set + 2,\
-            	    index=False)
-            dict_df_components[list_enrichments[index + 4]].to_excel(writer,\
-            	    sheet_name=enrichment_sheet, startrow=current_row_2, startcol=off_set + 6,\
-            	    index=False)
-            current_row_1 += len(dict_df_components[list_enrichments[index]]) + 2
-            current_row_2 += len(dict_df_components[list_enrichments[index + 4]]) + 2
-
-    return dict_df_components
+    off_set = len(df_table.columns)
+
+    # mole ratios (first half of the components) beside component types (second half)
+    components = df_levels.index.get_level_values("Component")
+    n_ratios = len(pd.unique(components))//2
+    ratios = components.isin(pd.unique(components)[:n_ratios])
+    blocks = [(df_table, 0, 0)]
+    blocks += component_blocks(df_levels[ratios], ["Total #", "% of Total"], startcol=off_set + 2)
+    blocks += component_blocks(df_levels[~ratios], ["Total #", "% of Total"],\
+                                startcol=off_set + 6)
+
+    # enrichment tables of all components stacked, for outputs that are not spreadsheets, with the
+    # sorted top or bottom LNPs as a second table
+    tables = {enrichment_sheet : tidy_table(df_levels)}
+    if sort_by is not None:
+        tables[enrichment_sheet + "_lnps"] = df_table
+    output.write_sheet(enrichment_sheet, blocks, tables)
 
-def sort_norm_counts(sort_by, df_averaged):
+def sort_norm_counts(sort_by, df_averaged, order=None):
     '''
     sort_norm_counts: creates dataframe with normalized counts sorted in descending order by
                     specified cell type
         inputs:
             sort_by : user specified cell type to sort by
             df_averaged : dataframe with averaged normalized counts by cell type
+            order : positions of LNPs in descending order by sort_by (default = None, ranks them)
         output:
             df_sorted : dataframe with normalized counts sorted in descending order by specified
                         cell type
     '''
 
-    df_sorted = df_averaged.sort_values(by=sort_by, ascending=False, ignore_index=True)
+    if order is None:
+        order = rank_norm_counts(sort_by, df_averaged)
+    df_sorted = df_averaged.take(order).reset_index(drop=True)
 
     return df_sorted
 
-def get_all_enrichments(df_averaged, df_top_bottom_sort_by):
+def rank_norm_counts(sort_by, df_averaged):
     '''
-    get_all_enrichments: calculated enrichment by component or component_ratio
+    rank_norm_counts: ranks LNPs in descending order by specified cell type, LNPs with the same
+                    normalized counts keep their order and missing counts go last
         inputs:
+            sort_by : user specified cell type to sort by
             df_averaged : dataframe with averaged normalized counts by cell type
-            df_top_bottom_sort_by : dataframe of either top or bottom performing LNPs by specified
-                                    sort_by (optional input)
         output:
-            dict_df_components : dictionary with all dataframes of all enrichment calculations of
-                                df_averaged (or df_top_bottom_sort_by if inputted)
+            order : positions of LNPs of df_averaged in descending order
     '''
 
-    dict_components = get_lists_of_components(df_averaged)
-    dict_df_components = {"Lipomer %" : None, "Cholesterol %" : None, "PEG %" : None,\
-                        "Phospholipid %" : None, "Lipomer" : None, "Cholesterol" : None,\
-                        "PEG" : None, "Phospholipid" : None}
-
-    if df_top_bottom_sort_by is None:
-        for component in dict_df_components:
-            dict_df_components[component] = calculate_enrichment(component,\
-            	            dict_components[component], df_averaged)
-    else:
-        for component in dict_df_components:
-            dict_df_components[component] = calculate_enrichment(component,\
-            	            dict_components[component], df_top_bottom_sort_by)
+    return np.argsort(rank_keys(sort_by, df_averaged), kind="stable")
+
+def rank_keys(sort_by, df_averaged):
+    '''
+    rank_keys: returns keys that order LNPs in descending order by specified cell type when sorted
+                in ascending order (missing counts last)
+    '''
+
+    keys = -df_averaged[sort_by].to_numpy(dtype=float)
+    keys[np.isnan(keys)] = np.inf
+
+    return keys
+
+def select_ranks(keys, n_ranks):
+    '''
+    select_ranks: returns positions of the n_ranks smallest keys (ties by position), in ascending
+                order, without sorting all keys
+        inputs:
+            keys : array of keys from rank_keys
+            n_ranks : number of positions to select
+        output:
+            positions : positions of the n_ranks smallest keys
+    '''
+
+    if n_ranks <= 0:
+        return np.zeros(0, dtype=np.intp)
+    if n_ranks >= len(keys):
+        return np.argsort(keys, kind="stable")
+
+    # keys smaller than the n_ranks-th smallest key and as many ties as needed, first ones first
+    threshold = np.partition(keys, n_ranks - 1)[n_ranks - 1]
+    smaller = np.flatnonzero(keys < threshold)
+    ties = np.flatnonzero(keys == threshold)[:n_ranks - len(smaller)]
+    positions = np.sort(np.concatenate([smaller, ties]))
 
-    return dict_df_components
+    return positions[np.argsort(keys[positions], kind="stable")]
 
-def calculate_enrichment(component, component_list, df_averaged):
+def select_rank_sets(keys, n_ranks):
     '''
-    calculate_enrichment: calculated enrichment by component or component_ratio
+    select_rank_sets: returns positions of the n_ranks smallest keys (ties by position) of every
+                    row of keys at once, as select_ranks, without sorting them
+        inputs:
+            keys : array (rows x LNPs) of keys from rank_keys
+            n_ranks : number of positions to select on each row
+        output:
+            positions : array (rows x n_ranks) of the selected positions of each row, in ascending
+                        order of position
+    '''
+
+    n_ranks = max(min(n_ranks, keys.shape[1]), 0)
+    if n_ranks == 0:
+        return np.zeros((len(keys), 0), dtype=np.intp)
+
+    # keys smaller than the n_ranks-th smallest key of the row and as many ties as needed
+    threshold = np.partition(keys, n_ranks - 1, axis=1)[:, n_ranks - 1:n_ranks]
+    smaller = keys < threshold
+    ties = keys == threshold
+    n_ties = n_ranks - smaller.sum(axis=1, keepdims=True)
+    selected = smaller | (ties & (np.cumsum(ties, axis=1) <= n_ties))
+
+    return np.nonzero(selected)[1].reshape(len(keys), n_ranks)
+
+def get_all_enrichments(df_averaged, dict_components, subsets, encoded=None):
+    '''
+    get_all_enrichments: counts LNPs of every level of every component of every subset of LNPs in a
+                        single counting pass
         inputs:
-            component : component or component ratio
-            component_list : list of all component types and component ratios specified component
             df_averaged : dataframe with averaged normalized counts by cell type
+            dict_components : dictionary containing list of all the component mole ratios and
+                            types
+            subsets : dictionary of positions on df_averaged of LNPs to count (e.g. top and bottom
+                    performing LNPs by specified sort_by, None for all LNPs) by name
+            encoded : (codes, offsets) of Enrichment_permutation.encode_components of df_averaged
+                    (default = None, encodes them)
         output:
-            df_component_list : dataframe of enrichment for specified component
+            dict_subset_levels : dictionary by subset name with the level table of that subset
+                                (see level_table)
     '''
 
-    component_total = [0]*len(component_list)
-    for bc_x in df_averaged[component].values:
-        for index, value in enumerate(component_list):
-            if bc_x == value:
-                component_total[index] += 1
-                break
+    if encoded is None:
+        encoded = Enrichment_permutation.encode_components(df_averaged, dict_components)
+    codes, offsets = encoded
+    index = level_index(dict_components)
+
+    # label rows of every subset so all subsets are counted with one bincount
+    names = list(subsets)
+    positions = [np.arange(len(codes)) if subsets[name] is None else np.asarray(subsets[name])\
+                for name in names]
+    subset_ids = np.repeat(np.arange(len(names)), [len(position) for position in positions])
+    bins = codes[np.concatenate(positions).astype(np.intp)] + (subset_ids*offsets[-1])[:, None]
+    counts = np.bincount(bins.ravel(), minlength=len(names)*offsets[-1])
+    counts = counts.reshape(len(names), offsets[-1])
 
-    total = sum(component_total)
+    return {name : level_table(subset_counts, offsets, index) for name, subset_counts in\
+            zip(names, counts)}
 
-    component_percent_total = []
-    for each_component in component_total:
-        component_percent_total.append(round(each_component/total, 9))
+def level_index(dict_components):
+    '''
+    level_index : returns (Component, Level) index of every level of each component followed by its
+                TOTAL row, in the bin order of Enrichment_permutation.encode_components
+    '''
+    return pd.MultiIndex.from_tuples([(component, level) for component, component_list in\
+                                    dict_components.items() for level in component_list +\
+                                    ["TOTAL"]], names=["Component", "Level"])
 
-    component_list.append("TOTAL")
-    component_total.append(total)
-    component_percent_total.append(round(sum(component_percent_total)))
+def level_table(counts, offsets, index):
+    '''
+    level_table: calculates number and fraction of LNPs of every level of each component
+        inputs:
+            counts : array with the number of LNPs on each bin of encode_components (the last bin
+                    of each component are the LNPs without it, e.g. naked barcodes)
+            offsets : first bin of each component, and total number of bins
+            index : (Component, Level) index from level_index
+        output:
+            df_levels : dataframe indexed by (Component, Level) with "Total #" and "% of Total" of
+                        every level, and the sum of each on the TOTAL row of the component
+    '''
 
-    t_component_list = [component_list,	component_total, component_percent_total]
-    np_temporary = np.array(t_component_list)
-    np_temporary = np_temporary.T
-    df_component_list = pd.DataFrame(data=np_temporary, columns=[component, "Total #",\
-    	"% of Total"])
+    last = offsets[1:] - 1 # TOTAL row of each component
+    fractions = level_fractions(counts, offsets)
+    totals = np.add.reduceat(np.where(level_bins(offsets), counts, 0), offsets[:-1])
 
-    return df_component_list
+    # TOTAL rows take the sum of the rounded fractions, added in level order
+    fractions[last] = np.round([fractions[start:end].sum() for start, end in\
+                                zip(offsets[:-1], last)])
+    counts = counts.copy()
+    counts[last] = totals
+
+    return pd.DataFrame({"Total #" : counts, "% of Total" : fractions}, index=index)
+
+def level_bins(offsets):
+    '''
+    level_bins : returns mask of the bins of encode_components that are levels (every bin but the
+    last one of each component)
+    '''
+    levels = np.ones(offsets[-1], dtype=bool)
+    levels[offsets[1:] - 1] = False
+
+    return levels
+
+def level_fractions(counts, offsets):
+    '''
+    level_fractions: calculates fraction of the LNPs of each component on every level, rounded to 9
+    decimals as on the level tables
+        inputs:
+            counts : array (bins, or sets x bins) with the number of LNPs on each bin of
+                    encode_components
+            offsets : first bin of each component, and total number of bins
+        output:
+            fractions : array of the shape of counts with the fraction of every level (the last bin
+                        of each component is divided by the total of the component too)
+    '''
+    totals = np.add.reduceat(np.where(level_bins(offsets), counts, 0), offsets[:-1], axis=-1)
+    component_totals = np.repeat(totals, np.diff(offsets), axis=-1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.round(counts/component_totals, 9)
 
 def get_lists_of_components(df_averaged):
     '''
@@ -447,8 +1120,7 @@ def get_lists_of_components(df_averaged):
                                 and types
     '''
 
-    dict_components = {"Lipomer %" : [], "Cholesterol %" : [], "PEG %" : [], "Phospholipid %" : [],\
-                        "Lipomer" : [], "Cholesterol" : [], "PEG" : [], "Phospholipid" : []}
+    dict_components = {component : [] for component in COMPONENTS}
 
     for component in dict_components:
         dict_components[component] = retrieve_component_list(df_averaged, component)
@@ -465,282 +1137,721 @@ def retrieve_component_list(df_averaged, component):
         output:
             component_list : list of all the different mole ratios or types of a component used
     '''
-    component_list = []
 
-    for index in range(len(df_averaged[component].values)-2):
-        if df_averaged[component].values[index] not in component_list:
-            component_list.append(df_averaged[component].values[index])
+    # distinct values of all LNPs, leaving out the two naked barcodes at the end
+    values = pd.unique(df_averaged[component].values[:len(df_averaged) - 2])
+    component_list = [value for value in values if not pd.isna(value)]
 
     component_list.sort()
 
     return component_list
 
-def average_normalized_counts(df_merged, organized_columns, sorted_cells, destination_file,\
-	                        sort_by):
+def average_normalized_counts(df_merged, organized_columns, sorted_cells, sort_targets,\
+                                sample_index=None):
     '''
     average_normalized_counts : creates and returns a dataframe with averaged normalized counts by
-    cell type and appends it to excel spreadsheet on a sheet named "Averaged Norm Counts"
+    cell type, and by organ or across organs for each of those in sort_targets, from a single
+    grouped reduction of the sample columns (replicates -> cell types -> organs and AVG)
         inputs:
-            df_merged : dataframe of merged formulations and normalized counts
+            df_merged : dataframe of merged formulations and normalized counts (not modified)
             organized_columns : list of samples organized by cell types of sorted cells
             sorted_cells: user specified list of cells that were sorted
-            destination_file : directory of the excel spreadsheet created
+            sort_targets : list of cell types/organs/avg across organs to sort by
+            sample_index : index of sample names returned by index_samples (default = None,
+                            indexes organized_columns)
         output:
             df_averaged : dataframe with averaged normalized counts by cell type
     '''
 
-    df_averaged = df_merged # copy merged dataframe
-
-    for _, value in enumerate(sorted_cells):
-        temporary_list = []
-        for column in organized_columns: # for each sample
-            if value in column: # if sample is specific cell type
-                temporary_list.append(column) # add to temporary list of samples per cell type
-        # get average of repeats of each cell type and append to dataframe
-        df_averaged[value] = df_averaged[temporary_list].mean(axis=1)
+    if sample_index is None:
+        sample_index = index_samples(organized_columns)
+
+    # samples of each cell type, looked up on the sample index, and positions of them on the
+    # count matrix
+    samples = list(dict.fromkeys(organized_columns))
+    positions = {sample : position for position, sample in enumerate(samples)}
+    cell_groups = [[positions[sample] for sample in sample_index["cell_types"].get(value, [])\
+                    if sample in positions] for value in sorted_cells]
+
+    # average of repeats of each cell type, counts stored as float32 are added up as float64 by
+    # group_means without a float64 copy of the whole matrix
+    counts = df_merged[samples].to_numpy()
+    cell_means = group_means(counts, cell_groups)
+
+    # organs average their cell types, AVG averages all cell types
+    organs = group_by_organ(sorted_cells)
+    cell_positions = {}
+    for position, value in enumerate(sorted_cells):
+        cell_positions.setdefault(value, position)
+    targets = [sort_by for sort_by in dict.fromkeys(sort_targets) if sort_by not in sorted_cells]
+    target_groups = [[cell_positions[value] for value in\
+                    (sorted_cells if sort_by == "AVG" else organs.get(sort_by, []))]\
+                    for sort_by in targets]
+    target_means = group_means(cell_means, target_groups)
 
     #order columns
     l1 = df_merged.columns.tolist()[:10] # columns up to phospholipid%
-    order_columns = l1 + sorted_cells # formulation columns and cell types
-
-    # rearrange columns on df_averaged
-    df_averaged = df_averaged[order_columns]
-
-    if len(sort_by) != 2:
-        df_averaged = avg_sort_by_norm_counts(df_averaged, sorted_cells, sort_by)
 
-
-    # append merged data frames onto excel spreadsheet
-    with pd.ExcelWriter(destination_file, engine="openpyxl", mode="a")\
-    as writer: # pylint: disable=abstract-class-instantiated
-        df_averaged.to_excel(writer, sheet_name="Averaged Norm Counts", index=False)
+    # formulation columns, cell types and sort targets built at once, df_merged is not modified
+    df_averaged = pd.concat([df_merged[l1],\
+                            pd.DataFrame(np.hstack([cell_means, target_means]),\
+                                        index=df_merged.index, columns=sorted_cells + targets)],\
+                            axis=1)
 
     return df_averaged
 
-def avg_sort_by_norm_counts(df_averaged, sorted_cells, sort_by):
+def group_means(values, groups):
     '''
-    avg_sort_by_norm_counts : returns dataframe with averaged norm counts as user specified
+    group_means : averages groups of columns of a matrix in one reduction, missing values are left
+    out of the averages
         inputs:
-            df_averaged : dataframe with averaged normalized counts by cell type
-            sorted_cells: user specified list of cells that were sorted
-            sort_by : specifies sorting method (average across all samples or by organ)
+            values : array (rows x columns), float64 or float32
+            groups : list of lists of column positions
         output:
-            df_averaged : dataframe with averaged normalized counts by cell type
+            means : array (rows x groups) with the average of each group, NaN for groups without
+                    values
     '''
-    if sort_by == "AVG":
-        df_averaged = avg_across_organs(df_averaged, sorted_cells)
-    else:
-        df_averaged = avg_by_organ(df_averaged, sorted_cells, sort_by)
+    means = np.full((values.shape[0], len(groups)), np.nan)
+    if not groups or values.shape[0] == 0:
+        return means
 
-    return df_averaged
+    # one column of every group at a time, added up left to right so each sum is the same as adding
+    # its columns in order, only those columns are converted to float64 (values may be float32)
+    sums = np.zeros(means.shape)
+    n_values = np.zeros(means.shape, dtype=np.int64)
+    for position in range(max(len(group) for group in groups)):
+        in_groups = [index for index, group in enumerate(groups) if len(group) > position]
+        columns = values[:, [groups[index][position] for index in in_groups]].astype(np.float64)
+        present = ~np.isnan(columns)
+        sums[:, in_groups] += np.where(present, columns, 0)
+        n_values[:, in_groups] += present
+
+    np.divide(sums, n_values, out=means, where=n_values > 0)
 
-def avg_by_organ(df_averaged, sorted_cells, sort_by):
+    return means
+
+def merge_formulations_and_norm_counts(df_formulations, df_norm_counts, organized_columns,\
+                                        join=None):
     '''
-    avg_by_organ: returns dataframe with the averaged norm counts from specified organ (sort_by)
+    merge_formulations_and_norm_counts : merges formulation and norm count dataframes into single
+    data frame
         inputs:
-            df_averaged : dataframe with averaged normalized counts by cell type
-            sorted_cells: user specified list of cells that were sorted
-            sort_by : specifies organ for sorting method
+            df_formulations : formulations datasheet
+            df_norm_counts : data frame of normalized counts
+            organized_columns : list of samples organized by cell types of sorted cells
+            join : rows of df_formulations and df_norm_counts with the same barcode, returned by
+                    join_barcodes (default = None, joins them)
         output:
-            df_averaged : dataframe with averaged normalized counts by organ specified
+            df_merged : dataframe of merged formulations and normalized counts
     '''
+    if join is None:
+        join = join_barcodes(create_barcode_index(df_formulations), df_norm_counts["BC"])
 
-    temporary_list = []
-    for sample in sorted_cells:
-        if sample[0] == sort_by:
-            temporary_list.append(sample)
+    # ordered columns, as on the inner merge of formulations and counts
+    merged_columns = df_formulations.columns.tolist() +\
+                    [column for column in df_norm_counts.columns if column != "BC"]
+    l1 = merged_columns[:10] # columns up to phospholipid%
+    order_columns = l1 + organized_columns # formulation columns and organized sample columns
 
-    df_averaged[sort_by] = df_averaged[temporary_list].mean(axis=1)
+    if join["count_rows"] is None:
+        # inner merge of data frames around barcodes ("BC"), repeated barcodes on the formulation
+        # sheet pair every count row with each of them
+        return df_formulations.merge(df_norm_counts, on="BC")[order_columns]
+
+    # rows taken by position, in the order of the inner merge around barcodes ("BC")
+    formulation_columns = [column for column in order_columns if column in df_formulations.columns]
+    count_columns = [column for column in order_columns if column not in formulation_columns]
+    df_merged = pd.concat([df_formulations.iloc[join["formulation_rows"],\
+                            df_formulations.columns.get_indexer(formulation_columns)]\
+                            .reset_index(drop=True),\
+                        df_norm_counts.iloc[join["count_rows"],\
+                            df_norm_counts.columns.get_indexer(count_columns)]\
+                            .reset_index(drop=True)], axis=1)
 
-    return df_averaged
+    # rearrange columns on df_merged
+    df_merged = df_merged[order_columns]
+
+    return df_merged
 
-def avg_across_organs(df_averaged, sorted_cells):
+def create_barcode_index(df_formulations):
     '''
-    avg_across_organs: returns dataframe with the averaged norm counts across all organs
+    create_barcode_index : index of the barcodes of the formulation sheet, the position of each
+    barcode is its row on the sheet
         inputs:
-            df_averaged : dataframe with averaged normalized counts by cell type
-            sorted_cells: user specified list of cells that were sorted
+            df_formulations : formulations datasheet
         output:
-            df_averaged : dataframe with averaged normalized counts across organs
+            barcode_index : pandas index of barcodes ("BC")
     '''
-    df_averaged["AVG"] = df_averaged[sorted_cells].mean(axis=1)
-
-    return df_averaged
+    return pd.Index(df_formulations["BC"].to_numpy())
 
-def merge_formulations_and_norm_counts(df_formulations, df_norm_counts, organized_columns,\
-                destination_file, add_to_excel=False): # pylint: disable=R1710
+def join_barcodes(barcode_index, barcodes):
     '''
-    merge_formulations_and_norm_counts : merges formulation and norm count dataframes into single
-    data frame and appends it to excel spreadsheet named "Formulations + Norm Counts"
+    join_barcodes : finds the row of the formulation sheet of every barcode of the normalized
+    counts, in the order of an inner merge (formulation sheet order, then counts order)
         inputs:
-            df_formulations : formulations datasheet
-            df_norm_counts : data frame of normalized counts
-            organized_columns : list of samples organized by cell types of sorted cells
-            destination_file : directory of the excel spreadsheet created
+            barcode_index : index of barcodes of the formulation sheet (create_barcode_index)
+            barcodes : barcode column ("BC") of the normalized counts
         output:
-            df_merged : dataframe of merged formulations and normalized counts
+            join : dictionary with rows of the formulation sheet ("formulation_rows") and of the
+                    counts ("count_rows") of each merged row, None if barcodes repeat on the
+                    formulation sheet, and number of barcodes of the counts and of the formulation
+                    sheet without a match ("unmatched")
     '''
-    # inner merge of data frames around barcodes ("BC")
-    df_merged = df_formulations.merge(df_norm_counts, on="BC")
+    if not barcode_index.is_unique:
+        return {"formulation_rows" : None, "count_rows" : None,\
+                "unmatched" : {"counts" : int((~pd.Index(barcodes).isin(barcode_index)).sum()),\
+                            "formulations" : int((~barcode_index.isin(barcodes)).sum())}}
 
-    # ordered columns
-    l1 = df_merged.columns.tolist()[:10] # columns up to phospholipid%
-    order_columns = l1 + organized_columns # formulation columns and organized sample columns
+    positions = barcode_index.get_indexer(barcodes)
+    matched = np.flatnonzero(positions >= 0)
 
-    # rearrange columns on df_merged
-    df_merged = df_merged[order_columns]
+    # stable sort keeps count rows of a barcode in the order they are on the counts
+    count_rows = matched[np.argsort(positions[matched], kind="stable")]
+    formulation_rows = positions[count_rows]
+
+    unmatched = {"counts" : len(positions) - len(matched),\
+                "formulations" : len(barcode_index) - len(np.unique(formulation_rows))}
 
-    if add_to_excel:
-        # append merged data frames onto spreadsheet on sheet named Formulations + Norm Counts
-        # with outliers
-        with pd.ExcelWriter(destination_file, engine="openpyxl", mode="a")\
-        as writer: # pylint: disable=abstract-class-instantiated
-            df_merged.to_excel(writer, sheet_name="Formulations + Norm Counts", index=False)
-    else: #save dataframe without outliers
-        return df_merged
+    return {"formulation_rows" : formulation_rows, "count_rows" : count_rows,\
+            "unmatched" : unmatched}
 
-def organize_cell_type(sample_columns, sorted_cells):
+def organize_cell_type(sample_columns, sorted_cells, sample_index=None):
     '''
-    organize_cell_type : gets data fram with normalized counts, creates a dataframe without outliers
-    based on given percentile
+    organize_cell_type : orders sample columns by the cell types of sorted cells
         inputs:
             sample_columns :  list of the names of the columns on the dataframe of normalized counts
                             with no outliers(names of samples)
             sorted_cells : user specified list of cells that were sorted
+            sample_index : index of sample names returned by index_samples (default = None,
+                            indexes sample_columns)
         output:
             organized_columns : list of samples organized by cell types of sorted cells
     '''
-    # organize columns
+    if sample_index is None:
+        sample_index = index_samples(sample_columns)
+
+    # organize columns, samples of each cell type (e.g. "AD SB102" of "SB") in header order
     organized_columns = []
     for sort_by in sorted_cells:
-        for column in sample_columns:
-            # if current sort_by is in the name of the current column (e.g: if "SB" in "AD SB102")
-            if sort_by in column:
-                organized_columns.append(column)
+        organized_columns.extend(sample_index["cell_types"].get(sort_by, []))
+
+    # columns that could not be parsed, or that name a sorted cell without being parsed as one
+    # (e.g. "ADSB102", no separator between prefix and cell type)
+    grouped = set(organized_columns)
+    skipped = [str(column) for column in sample_index["columns"] if column not in grouped and\
+                (column not in sample_index["samples"] or\
+                any(cell in str(column) for cell in sorted_cells))]
+
+    # cell types without samples would be averaged and ranked on NaN
+    missing = [cell for cell in sorted_cells if cell not in sample_index["cell_types"]]
+    if missing:
+        raise ValueError("No sample columns of sorted cells " + ", ".join(missing) +\
+                        (" (sample columns not read: " + ", ".join(skipped) + ")" if skipped\
+                        else ""))
+    if skipped:
+        warnings.warn("Sample columns left out of the analysis: " + ", ".join(skipped))
 
     return organized_columns
 
-def create_df_norm_no_outliers(df_norm_counts, percentile):
+def parse_sample_name(column):
+    '''
+    parse_sample_name : reads organ, cell type and replicate from the end of a sample name
+        inputs:
+            column : name of a sample column (e.g. "AD SB102")
+        output:
+            sample : tuple of organ, cell type and replicate (e.g. ("S", "B", "102"), also for
+                    "AD SB102_S7" and "AD SB102.1"), None if the name does not end with them
+    '''
+    match = SAMPLE_NAME.search(str(column))
+    if match is None:
+        return None
+
+    return match.groups()
+
+def index_samples(sample_columns):
+    '''
+    index_samples : parses every sample name once and indexes the samples by cell type
+        inputs:
+            sample_columns : list of the names of the sample columns
+        output:
+            sample_index : dictionary with the sample columns ("columns"), the parsed (organ, cell
+                        type, replicate) of each column ("samples") and the columns of each cell
+                        type acronym in header order ("cell_types", e.g. {"SB" : ["AD SB102"]})
+    '''
+    samples = {}
+    cell_types = {}
+    for column in sample_columns:
+        sample = parse_sample_name(column)
+        if sample is None:
+            continue
+        samples[column] = sample
+        cell_types.setdefault(sample[0] + sample[1], []).append(column)
+
+    return {"columns" : list(sample_columns), "samples" : samples, "cell_types" : cell_types}
+
+def group_by_organ(sorted_cells):
+    '''
+    group_by_organ : groups cell type acronyms by their organ (first letter)
+        inputs:
+            sorted_cells : user specified list of cells that were sorted
+        output:
+            organs : dictionary with the cell types of each organ (e.g. {"S" : ["SB", "ST"]})
+    '''
+    organs = {}
+    for cell_type in sorted_cells:
+        organs.setdefault(cell_type[0], []).append(cell_type)
+
+    return organs
+
+def create_df_norm_no_outliers(df_norm_counts, percentile, exact_percentile=True, chunked=False):
     '''
     create_df_norm_no_outliers : gets data frame with normalized counts, creates a dataframe without
     outliers based on given percentile
         inputs:
             df_norm_counts :  data frame of normalized counts
             percentile : percentile of values accepted (default = 99.9%)
+            exact_percentile : finds exact value at percentile (default = True) or estimates it
+                                from the quantile sketch only
+            chunked : counts were read in chunks, the percentile is found reading them in blocks
+                    (default = False)
         output:
             df_norm_no_outliers : data frame with normalized counts without outliers
             sample_columns : list of the names of the columns on the dataframe (names of samples)
     '''
 
-    # get row names and save barcode column
-    rows = list(df_norm_counts.index)
+    # save barcode column
     barcodes = df_norm_counts["BC"]
 
+    # copy of the sample columns (without barcode column) to remove outliers from
+    sample_columns = df_norm_counts.columns.tolist()[1:]
+    counts = sample_counts(df_norm_counts)
+
     # calculate given percentile
-    df_norm_no_outliers = df_norm_counts.drop("BC", axis=1) # temporarily remove barcode column
-    n_at_percentile = get_n_percentile(df_norm_no_outliers, percentile)
+    n_at_percentile = get_n_percentile(counts, percentile, exact_percentile, chunked=chunked)
 
-    # set outliers to NaN (numbers greater than 99.9 percentile)
-    # get columns names again, because column's name changed
-    sample_columns = df_norm_no_outliers.columns.tolist()
-
-    for column in sample_columns:
-        df_norm_no_outliers = remove_outliers_by_column(df_norm_no_outliers, rows, column,\
-                                                        n_at_percentile)
+    # set outliers to 0 (numbers greater than 99.9 percentile) and renormalize every sample column
+    counts = remove_outliers(counts, n_at_percentile)
 
+    df_norm_no_outliers = pd.DataFrame(counts, index=df_norm_counts.index, columns=sample_columns,\
+                                        copy=False)
     df_norm_no_outliers.insert(loc=0, column="BC", value=barcodes) # add the BC column again
 
     return df_norm_no_outliers, sample_columns
 
-def remove_outliers_by_column(df_norm_no_outliers, rows, column, n_at_percentile):
+def sample_counts(df_norm_counts):
+    '''
+    sample_counts : returns a copy of the sample columns as an array, float32 if they are stored
+    as float32 (compact_counts) and float64 otherwise
+        inputs:
+            df_norm_counts : data frame of normalized counts
+        output:
+            counts : array of normalized counts (barcodes x samples)
+    '''
+    dtype = np.result_type(np.float32, *df_norm_counts.dtypes.iloc[1:])
+
+    return df_norm_counts.iloc[:, 1:].to_numpy(dtype=dtype, copy=True)
+
+def sweep_outlier_percentile(screen, sorted_cells, sort_targets, x_percent, percentiles):
+    '''
+    sweep_outlier_percentile : removes outliers at every percentile of the sweep and finds the
+                            averaged counts and net enrichment factors of each
+        inputs:
+            screen : dictionary returned by create_screen
+            sorted_cells : user specified list of cells that were sorted
+            sort_targets : list of cell types/organs/avg across organs to sort by
+            x_percent : user specified integer to find top and bottom performing LNPs (0-100)
+            percentiles : list of percentiles of values accepted
+        output:
+            sweep : dictionary with "df_summary" (threshold, number of outliers and largest
+                    percent removed from a sample at each percentile), "df_averaged" (averaged
+                    counts of each sort_by at each percentile) and "d_df_net" (dictionary by
+                    sort_by of net enrichment factors of every level at each percentile)
+    '''
+
+    df_norm_counts = screen["df_norm_counts"]
+    sample_columns = df_norm_counts.columns.tolist()[1:]
+    counts = sample_counts(df_norm_counts)
+
+    summary = {}
+    averaged = {}
+    net = {sort_by : {} for sort_by in sort_targets}
+    for percentile, n_at_percentile, n_outliers, removed, counts_no_outliers in\
+        remove_outliers_sweep(counts, percentiles):
+        summary[percentile] = [percentile, n_at_percentile, n_outliers,\
+                                removed.max() if len(removed) else 0.0]
+
+        df_norm_no_outliers = pd.DataFrame(counts_no_outliers, index=df_norm_counts.index,\
+                                            columns=sample_columns, copy=False)
+        df_norm_no_outliers.insert(loc=0, column="BC", value=df_norm_counts["BC"])
+        df_merged = merge_formulations_and_norm_counts(screen["df_formulations"],\
+                    df_norm_no_outliers, screen["organized_columns"], screen["barcode_join"])
+        df_averaged = average_normalized_counts(df_merged, screen["organized_columns"],\
+                                                sorted_cells, sort_targets, screen["sample_index"])
+
+        # net enrichment factors as the Net Enrichment Factors sheet, all LNPs and the top and
+        # bottom LNPs of every sort_by counted in one pass
+        subsets = {"Averaged" : None}
+        for sort_by in sort_targets:
+            averaged[(sort_by, percentile)] = df_averaged[sort_by].to_numpy()
+            subsets[sort_by + " Top"], subsets[sort_by + " Bottom"] = top_and_bottom_percent(\
+                        df_averaged, sort_by, x_percent, rank_norm_counts(sort_by, df_averaged))
+        dict_subset_levels = get_all_enrichments(df_averaged, screen["dict_components"], subsets)
+        for sort_by in sort_targets:
+            net[sort_by][percentile] = enrichment_model(dict_subset_levels["Averaged"],\
+                        dict_subset_levels[sort_by + " Top"],\
+                        dict_subset_levels[sort_by + " Bottom"])["Net Enrichment Factor"]
+
+    # tables in the order the percentiles were given
+    percentiles = list(dict.fromkeys(percentiles))
+    df_summary = pd.DataFrame([summary[percentile] for percentile in percentiles],\
+                            columns=["Percentile", "Threshold", "Outliers", "Max % Removed"])
+
+    df_averaged = screen["df_averaged"][["LNP", "BC"]].reset_index(drop=True)
+    for sort_by in sort_targets:
+        for percentile in percentiles:
+            df_averaged[sort_by + " " + str(percentile)] = averaged[(sort_by, percentile)]
+
+    # levels of each component, without the TOTAL rows
+    d_df_net = {}
+    for sort_by in sort_targets:
+        df_net = pd.DataFrame({str(percentile) : net[sort_by][percentile] for percentile in\
+                                percentiles})
+        df_net = df_net[df_net.index.get_level_values("Level") != "TOTAL"].reset_index()
+        d_df_net[sort_by] = df_net
+
+    return {"df_summary" : df_summary, "df_averaged" : df_averaged, "d_df_net" : d_df_net}
+
+def remove_outliers_sweep(counts, percentiles):
+    '''
+    remove_outliers_sweep : removes outliers at several percentiles with remove_outliers, finding
+    the value at every percentile and the number of outliers from a single sorted copy of the values
+        inputs:
+            counts : array of normalized counts (barcodes x samples), not modified
+            percentiles : list of percentiles of values accepted
+        output:
+            generator of (percentile, n_at_percentile, number of outliers, addition of outliers
+            removed from each column, renormalized counts without outliers) by percentile
+    '''
+
+    sorted_values = np.sort(counts, axis=None) # ascending, nan last
+    n_valid = len(sorted_values) - np.count_nonzero(np.isnan(sorted_values))
+
+    for percentile in dict.fromkeys(percentiles):
+        n_at_percentile = sorted_percentile(sorted_values, percentile)
+
+        # outliers are the values >= n_at_percentile, the last ones of the sorted values
+        n_outliers = 0
+        if not np.isnan(n_at_percentile):
+            n_outliers = n_valid - np.searchsorted(sorted_values[:n_valid], n_at_percentile,\
+                                                    side="left")
+
+        # mask and sums found once, shared by the summary and the outlier removal
+        outliers = counts >= n_at_percentile
+        removed = outlier_sums(counts, outliers)
+        yield percentile, n_at_percentile, n_outliers, removed,\
+                remove_outliers(counts.copy(), n_at_percentile, outliers, removed)
+
+def remove_outliers(counts, n_at_percentile, outliers=None, removed=None):
     '''
-    remove_outliers_by_column : removes outliers by outliers using renormalize function
+    remove_outliers : removes outliers of every sample column at once and renormalizes the columns
+    using renormalize function
         inputs:
-            df_norm_no_outliers :  data frame of normalized counts to remove outliers
-            rows : list of all the rows (barcodes)
-            column : column name of sample
+            counts : array of normalized counts (barcodes x samples), modified in place
             n_at_percentile : value at given percentile
+            outliers : boolean array of the values >= n_at_percentile (default = None, finds it)
+            removed : addition of the outliers of each column from outlier_sums (default = None,
+                    adds them up)
         output:
-            df_norm_no_outliers : data frame without outliers and renormalized counts
+            counts : array without outliers and renormalized counts
     '''
 
-    count = 0 # saves addition of all outliers removed in a column
+    if outliers is None:
+        outliers = counts >= n_at_percentile
+    if removed is None:
+        removed = outlier_sums(counts, outliers)
+    counts[outliers] = 0
 
-    for row in rows:
-        value = df_norm_no_outliers.at[row, column]
-        if value >= n_at_percentile:
-            count += value
-            df_norm_no_outliers.at[row, column] = 0
+    return renormalize(counts, removed)
+
+def outlier_sums(counts, outliers):
+    '''
+    outlier_sums : addition of all outliers of each column, only the outliers are added, one at a
+    time in barcode order down each column so the totals match adding them one by one
+        inputs:
+            counts : array of normalized counts (barcodes x samples)
+            outliers : boolean array of the outliers of counts
+        output:
+            removed : array with the addition of the outliers of each column
+    '''
 
-    df_norm_no_outliers = renormalize(df_norm_no_outliers, rows, column, count)
+    removed = np.zeros(counts.shape[1])
+    columns, rows = np.nonzero(outliers.T)
+    np.add.at(removed, columns, counts[rows, columns])
 
-    return df_norm_no_outliers
+    return removed
 
-def renormalize(df_norm_no_outliers, rows, column, count):
+def renormalize(counts, removed):
     '''
     renormalize : renormalizes data by cell type run
         inputs:
-            df_norm_no_outliers :  data frame of normalized counts to remove outliers
-            rows : list of all the rows (barcodes)
-            column : column name of sample
-            count : addition of all outliers removed from a column
+            counts : array of normalized counts without outliers, modified in place
+            removed : addition of all outliers removed from each column
         output:
-            df_norm_no_outliers : data frame of renormalized counts
+            counts : array of renormalized counts
     '''
 
-    if count != 0:
-        for row in rows:
-            value = df_norm_no_outliers.at[row, column]
-            if value != 0:
-                df_norm_no_outliers.at[row, column] = value / (100 - count) * 100
+    # only non-zero counts of columns that had outliers removed are rescaled
+    rescale = (counts != 0) & (removed != 0)
+    np.divide(counts, 100 - removed, out=counts, where=rescale)
+    np.multiply(counts, 100, out=counts, where=rescale)
 
-    return df_norm_no_outliers
+    return counts
 
-
-def get_n_percentile(df_norm_no_outliers, percentile):
+def get_n_percentile(counts, percentile, exact=True, block_size=1 << 18, chunked=False):
     '''
-    get_n_percentile : finds value at given percentile from all data
+    get_n_percentile : finds value at given percentile from all data with np.percentile, or reading
+    it in blocks of rows so the data is never copied as a whole if it was read in chunks, is
+    larger than PERCENTILE_COPY_BYTES or is float32 (np.percentile interpolates float32 in float32)
         inputs:
-            df_norm_counts :  data frame of normalized counts
+            counts : array (or data frame) of normalized counts
             percentile : percentile of values accepted (default = 99.9%)
+            exact : returns the same value as np.percentile (default = True), otherwise the
+                    estimate of the quantile sketch
+            block_size : number of values processed at a time (default = 262144)
+            chunked : counts were read in chunks (default = False)
         output:
             n_at_percentile : value at given percentile
     '''
-    return np.percentile(df_norm_no_outliers.to_numpy(), percentile)
+    counts = np.asarray(counts)
+    if exact and not chunked and counts.dtype == np.float64 and\
+        counts.nbytes <= PERCENTILE_COPY_BYTES:
+        # a single copy partitioned by np.percentile is faster than the sketch
+        return np.percentile(counts, percentile)
+    block_rows = max(1, block_size//max(1, counts[0:1].size))
+
+    # sketches of each block are merged into the sketch of all data
+    sketch = QuantileSketch()
+    for start in range(0, len(counts), block_rows):
+        block_sketch = QuantileSketch()
+        block_sketch.update(counts[start:start + block_rows])
+        sketch.merge(block_sketch)
+
+    if sketch.count == 0 or sketch.nan_count != 0: # same as np.percentile
+        return np.percentile(counts, percentile)
+    if not exact:
+        return sketch.percentile(percentile)
+
+    # rank of the values interpolated by np.percentile ("linear" method)
+    virtual_index = (sketch.count - 1)*np.true_divide(percentile, 100)
+    previous_index = min(int(np.floor(virtual_index)), sketch.count - 1)
+    next_index = min(previous_index + 1, sketch.count - 1)
+
+    # only values between the sketch bounds of both ranks are kept and sorted
+    low = sketch.value_bounds(previous_index)[0]
+    high = sketch.value_bounds(next_index)[1]
+    count_below = 0
+    candidates = []
+    for start in range(0, len(counts), block_rows):
+        block = counts[start:start + block_rows]
+        count_below += np.count_nonzero(block < low)
+        candidates.append(block[(block >= low) & (block <= high)])
+    candidates = np.sort(np.concatenate(candidates))
+
+    if count_below > previous_index or count_below + len(candidates) <= next_index:
+        # bounds missed the ranks, fall back to sorting all data
+        return np.percentile(counts, percentile)
+
+    return interpolate_percentile(candidates[previous_index - count_below],\
+                                candidates[next_index - count_below], virtual_index, sketch.count)
+
+def sorted_percentile(sorted_values, percentile):
+    '''
+    sorted_percentile : returns the same value as np.percentile from values already sorted
+    '''
+    if len(sorted_values) == 0 or np.isnan(sorted_values[-1]):
+        return np.percentile(sorted_values, percentile)
+
+    virtual_index = (len(sorted_values) - 1)*np.true_divide(percentile, 100)
+    previous_index = min(int(np.floor(virtual_index)), len(sorted_values) - 1)
+    next_index = min(previous_index + 1, len(sorted_values) - 1)
 
-def create_df_norm_counts(csv_filepath, destination_file):
+    return interpolate_percentile(sorted_values[previous_index], sorted_values[next_index],\
+                                virtual_index, len(sorted_values))
+
+def interpolate_percentile(previous, following, virtual_index, count):
+    '''
+    interpolate_percentile : linear interpolation between the values at the ranks around
+    virtual_index, as np.percentile does it ("linear" method)
     '''
-    create_df_norm_counts : gets csv file path with normalized counts, creates a dataframe and
-    appends it to destination_file on a sheet named "Normalized Counts"
+    gamma = virtual_index - np.floor(virtual_index)
+    if virtual_index >= count - 1:
+        return following
+
+    difference = following - previous
+    if gamma >= 0.5:
+        return following - difference*(1 - gamma)
+    return previous + difference*gamma
+
+class QuantileSketch:
+    '''
+    QuantileSketch : mergeable sketch of the distribution of values. Counts values in buckets
+    whose bounds grow geometrically, so the value at any rank is known within relative_accuracy
+    and sketches of separate blocks of data can be added together
+    '''
+
+    OFFSET = 2**40 # keeps keys of positive and negative buckets apart from the zero bucket
+
+    def __init__(self, relative_accuracy=0.001):
+        '''
+        Saves bucket size and empty bucket counts
+        '''
+        self.gamma = (1 + relative_accuracy)/(1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.buckets = {} # bucket key : number of values
+        self.count = 0
+        self.nan_count = 0
+
+    def update(self, values):
+        '''
+        Adds values to the sketch
+        '''
+        values = np.asarray(values, dtype=float).ravel()
+        nans = np.isnan(values)
+        self.nan_count += int(np.count_nonzero(nans))
+        values = values[~nans]
+
+        keys, counts = np.unique(self.keys(values), return_counts=True)
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.count += len(values)
+
+    def merge(self, other):
+        '''
+        Adds the values of another sketch (with the same relative_accuracy) to the sketch
+        '''
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.count += other.count
+        self.nan_count += other.nan_count
+
+    def keys(self, values):
+        '''
+        Returns bucket keys of values, keys are ordered as the values
+        '''
+        keys = np.zeros(len(values), dtype=np.int64)
+        with np.errstate(divide="ignore"):
+            indexes = np.ceil(np.log(np.abs(values))/self.log_gamma)
+        positive = values > 0
+        negative = values < 0
+        keys[positive] = self.OFFSET + indexes[positive]
+        keys[negative] = -(self.OFFSET + indexes[negative])
+        return keys
+
+    def value_bounds(self, rank):
+        '''
+        Returns lowest and highest value the bucket containing the value at rank (0 = smallest)
+        can hold, nan if the sketch has no values (ranks past the last value are in the last
+        bucket)
+        '''
+        if not self.buckets:
+            return np.nan, np.nan
+
+        seen = 0
+        key = 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                break
+        if key == 0:
+            return 0.0, 0.0
+        index = abs(key) - self.OFFSET
+        low, high = self.gamma**(index - 1), self.gamma**index
+        # widened, so values on the edge of a bucket are not left out by rounding
+        low, high = low*(1 - 1e-9), high*(1 + 1e-9)
+        if key < 0:
+            return -high, -low
+        return low, high
+
+    def percentile(self, percentile):
+        '''
+        Returns estimate of value at given percentile, interpolated between the middle of the
+        buckets of the neighbouring ranks
+        '''
+        virtual_index = (self.count - 1)*percentile/100
+        previous_index = min(int(np.floor(virtual_index)), self.count - 1)
+        next_index = min(previous_index + 1, self.count - 1)
+        previous = sum(self.value_bounds(previous_index))/2
+        following = sum(self.value_bounds(next_index))/2
+        return previous + (following - previous)*(virtual_index - previous_index)
+
+def create_df_norm_counts(csv_filepath, chunksize=None):
+    '''
+    create_df_norm_counts : gets csv file path with normalized counts and creates a dataframe
         inputs:
-            csv_filepath : file path to csv file
-            destination_file :  name of the destination excel file
+            csv_filepath : file path to csv file, or to a screen file made from one (see
+                        Enrichment_store), opened memory-mapped
+            chunksize : number of rows read at a time as numeric counts, filling a single array of
+                        all counts (default = None, reads the whole file at once)
         output:
             df_norm_counts : data frame with normalized counts
     '''
-    new_sheet_name = "Normalized Counts"
-
     # Read CSV file and save as data frame
-    df_norm_counts = pd.read_csv(csv_filepath, sep=',', header=0)
+    if Enrichment_store.is_store(csv_filepath):
+        df_norm_counts = Enrichment_store.open_counts(csv_filepath)
+    elif chunksize is None:
+        df_norm_counts = pd.read_csv(csv_filepath, sep=',', header=0)
+    else:
+        df_norm_counts = read_csv_chunks(csv_filepath, chunksize)
 
     columns = df_norm_counts.columns.tolist() # get names of columns
-    #rename first column to BC for barcodes
-    df_norm_counts.rename(columns={columns[0]:"BC"}, inplace=True)
+    #rename first column to BC for barcodes (without copying the counts)
+    df_norm_counts.columns = ["BC"] + columns[1:]
 
-    # Copy csv data frame to excel sheet
-    with pd.ExcelWriter(destination_file, engine="openpyxl", mode="a")\
-    as writer: # pylint: disable=abstract-class-instantiated
-        df_norm_counts.to_excel(writer, sheet_name=new_sheet_name, index=False)
+    return df_norm_counts
+
+def read_csv_chunks(csv_filepath, chunksize):
+    '''
+    read_csv_chunks : reads csv file of normalized counts in chunks of rows into one array of counts
+        inputs:
+            csv_filepath : file path to csv file
+            chunksize : number of rows read at a time
+        output:
+            df_norm_counts : data frame with barcodes and normalized counts
+    '''
+    columns = pd.read_csv(csv_filepath, sep=',', header=0, nrows=0).columns.tolist()
+    dtypes = {column : np.float64 for column in columns[1:]}
+
+    # number of lines is an upper bound of the number of rows, unused rows are left out at the end
+    counts = np.empty((count_lines(csv_filepath), len(columns) - 1))
+    barcodes = []
+    n_rows = 0
+
+    for chunk in pd.read_csv(csv_filepath, sep=',', header=0, dtype=dtypes, chunksize=chunksize):
+        counts[n_rows:n_rows + len(chunk)] = chunk.iloc[:, 1:].to_numpy()
+        barcodes.append(chunk.iloc[:, 0].to_numpy())
+        n_rows += len(chunk)
+
+    df_norm_counts = pd.DataFrame(counts[:n_rows], columns=columns[1:], copy=False)
+    df_norm_counts.insert(loc=0, column=columns[0], value=np.concatenate(barcodes))
 
     return df_norm_counts
 
-def create_df_formulation_sheet(formulations_sheet, destination_file):
+def count_lines(filepath, block_size=1 << 20):
+    '''
+    count_lines : counts lines of a file without reading it as a whole
     '''
-    create_df_formulation_sheet : gets formulation sheet, creates a dataframe and appends it to
-    destination_file on a sheet named " Formulations"
+    lines = 1
+    with open(filepath, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            lines += block.count(b"\n")
+
+    return lines
+
+def create_df_formulation_sheet(formulations_sheet):
+    '''
+    create_df_formulation_sheet : gets formulation sheet and creates a dataframe
         inputs:
             formulations_sheet : file path to excel sheet of formulation sheet
-            destination_file : name of the destination excel file
         output:
             df_formulations : data frame with formulations sheet
     '''
@@ -748,16 +1859,48 @@ def create_df_formulation_sheet(formulations_sheet, destination_file):
     # Turn formulation sheet into data frames
     df_formulations = pd.read_excel(formulations_sheet, sheet_name="Formulations")
 
-    # Make spreadsheet with formulation sheet
-    with pd.ExcelWriter(destination_file, engine="openpyxl", mode="w")\
-    as writer: # pylint: disable=abstract-class-instantiated
-        df_formulations.to_excel(writer, sheet_name="Formulations", index=False)
-
     return df_formulations
 
-def create_excel_spreadsheet(destination_folder, sort_by, file_name="Enrichment Analysis "):
+def compact_formulations(df_formulations, compact=True):
+    '''
+    compact_formulations : stores component types and mole ratios as categoricals (integer codes
+    of a few distinct levels instead of a string or float per LNP)
+        inputs:
+            df_formulations : data frame with formulations sheet
+            compact : converts the components (default = True), returns df_formulations as it is
+                    if False
+        output:
+            df_formulations : data frame with categorical component columns
+    '''
+    if not compact:
+        return df_formulations
+
+    return df_formulations.astype({component : "category" for component in COMPONENTS\
+                                    if component in df_formulations.columns})
+
+def compact_counts(df_norm_counts, compact=True):
+    '''
+    compact_counts : stores sample columns as float32, one column at a time, halving the memory of
+    the counts and of the merged data frames. Counts keep about 7 significant digits (relative
+    error under 6e-8), outlier sums and averages are still added up as float64.
+        inputs:
+            df_norm_counts : data frame with normalized counts
+            compact : converts the counts (default = True), returns df_norm_counts as it is if
+                    False
+        output:
+            df_norm_counts : data frame with float32 sample columns
+    '''
+    if not compact:
+        return df_norm_counts
+
+    return df_norm_counts.astype({column : np.float32 for column, dtype in\
+                                df_norm_counts.dtypes.iloc[1:].items() if dtype.kind == "f"})
+
+def create_excel_spreadsheet(destination_folder, sort_by, file_name="Enrichment Analysis ",\
+                            extension=".xlsx"):
     '''
-    create_excel_spreadsheet : creates an excel spreadsheet
+    create_excel_spreadsheet : returns the path of the excel spreadsheet, the file itself is
+    created when the run's output session is closed
         inputs:
             destination_folder : directory of the folder where the user wants the file stored
             file_name : name of the file being created (default = "Enrichment Analysis")
@@ -767,9 +1910,7 @@ def create_excel_spreadsheet(destination_folder, sort_by, file_name="Enrichment
     if destination_folder[-1] != '/': # check to save file on correct folder
         destination_folder = destination_folder + '/'
 
-    destination_file = destination_folder + file_name + sort_by + ".xlsx"
-    w_b = Workbook()
-    w_b.save(destination_file)
+    destination_file = destination_folder + file_name + sort_by + extension
 
     return destination_file
 	
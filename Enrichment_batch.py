@@ -0,0 +1,199 @@
+'''
+Enrichment_batch: Command line batch runner for CSV2Excel. Runs the enrichment analysis of every
+screen listed on a manifest in parallel worker processes, without the graphical user interface.
+
+The manifest is a csv file with one screen per row and the columns:
+    formulations_sheet : file path to excel spreadsheet with formulation sheet
+    csv_filepath : file path to csv with normalized counts
+    sorted_cells : list of cells that were sorted (separate by commas)
+    x_percent : percent to find top and bottom performing LNPs (0-100)
+    sort_by : cell type/organ/AVG to sort by, several separated by commas or "all"
+    percentile : (OPTIONAL: Default = 99.9) outliers percentile
+    destination_folder : (OPTIONAL) folder to save the excel spreadsheets of the screen, by default
+                        a folder named after the row and csv file inside --destination
+
+With --store each csv is converted once into a binary screen file next to it (see
+Enrichment_store), the screens of the manifest open it memory-mapped and share its pages.
+
+usage: python3 Enrichment_batch.py manifest.csv --destination results --workers 8 [--profile]
+                                    [--store]
+'''
+import argparse
+import csv
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import path, makedirs, cpu_count
+
+import CSV2Excel
+import Enrichment_store
+
+REQUIRED_COLUMNS = ["formulations_sheet", "csv_filepath", "sorted_cells", "x_percent", "sort_by"]
+
+def main(argv=None):
+    '''
+    main : runs every screen on the manifest and prints a summary, returns exit status (0 if all
+    screens succeeded, 1 otherwise)
+    '''
+    parser = argparse.ArgumentParser(description="Run the enrichment analysis of every screen "\
+                                    "listed on a manifest csv file")
+    parser.add_argument("manifest", help="csv file with one screen per row")
+    parser.add_argument("--destination", default=".", help="folder where each screen's results "\
+                        "are saved when the manifest has no destination_folder (default = .)")
+    parser.add_argument("--workers", type=int, default=cpu_count(), help="number of worker "\
+                        "processes (default = number of CPUs)")
+    parser.add_argument("--profile", action="store_true", help="save the timing and memory of "\
+                        "each stage as a json report next to each screen's results")
+    parser.add_argument("--store", action="store_true", help="convert each csv once into a "\
+                        "binary screen file and run the screens from it")
+    args = parser.parse_args(argv)
+
+    jobs = read_manifest(args.manifest, args.destination)
+    for job in jobs:
+        job["profile_report"] = args.profile
+    if args.store:
+        convert_stores(jobs)
+    failures = 0
+    start = time.time()
+
+    for row, error, seconds in run_jobs(jobs, args.workers):
+        if error is None:
+            print("[row %d] OK (%.1f s)" % (row, seconds))
+        else:
+            failures += 1
+            print("[row %d] FAILED: %s" % (row, error))
+
+    print("%d of %d screens succeeded, %d failed (%.1f s)" % (len(jobs) - failures, len(jobs),\
+                                                            failures, time.time() - start))
+
+    return 1 if failures else 0
+
+def read_manifest(manifest, destination):
+    '''
+    read_manifest : reads manifest csv file into a list of jobs
+        inputs:
+            manifest : file path to manifest csv file
+            destination : default folder for screens without a destination_folder
+        output:
+            jobs : list of dictionaries with the arguments of each screen, rows that can not be
+                    read have an "error" instead
+    '''
+    jobs = []
+
+    with open(manifest, newline="") as manifest_file:
+        reader = csv.DictReader(manifest_file)
+        missing = [column for column in REQUIRED_COLUMNS if column not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError("Manifest is missing columns: " + ", ".join(missing))
+
+        for row_number, row in enumerate(reader, start=1):
+            job = {"row" : row_number}
+            try:
+                # short rows have None on the columns they do not reach
+                empty = [column for column in REQUIRED_COLUMNS if not row.get(column)]
+                if empty:
+                    raise ValueError("missing " + ", ".join(empty))
+                job["formulations_sheet"] = row["formulations_sheet"]
+                job["csv_filepath"] = row["csv_filepath"]
+                job["sorted_cells"] = string_to_list(row["sorted_cells"])
+                job["x_percent"] = float(row["x_percent"])
+                job["sort_by"] = get_sort_by(row["sort_by"])
+                job["percentile"] = float(row.get("percentile") or 99.9)
+                job["destination_folder"] = row.get("destination_folder") or\
+                        path.join(destination, "%d_%s" % (row_number,\
+                        path.splitext(path.basename(row["csv_filepath"]))[0]))
+            except (TypeError, ValueError) as error:
+                job["error"] = "invalid manifest row: %s" % error
+            jobs.append(job)
+
+    return jobs
+
+def convert_stores(jobs):
+    '''
+    convert_stores : converts the csv of every job once into a screen file and points the jobs to
+    it, jobs whose csv can not be converted get an "error" instead
+        inputs:
+            jobs : list of jobs from read_manifest, modified in place
+    '''
+    stores = {}
+    for job in jobs:
+        if "error" in job:
+            continue
+        csv_filepath = job["csv_filepath"]
+        if csv_filepath not in stores:
+            try:
+                stores[csv_filepath] = Enrichment_store.convert_counts(csv_filepath)
+            except Exception as error: # pylint: disable=broad-except
+                stores[csv_filepath] = error
+        if isinstance(stores[csv_filepath], Exception):
+            job["error"] = "could not convert csv: %s: %s" % (type(stores[csv_filepath]).__name__,\
+                                                            stores[csv_filepath])
+        else:
+            job["csv_filepath"] = stores[csv_filepath]
+
+def run_jobs(jobs, workers):
+    '''
+    run_jobs : runs jobs on a pool of worker processes
+        inputs:
+            jobs : list of jobs from read_manifest
+            workers : number of worker processes
+        output:
+            generator of (row, error, seconds) as each job finishes, error is None if succeeded
+    '''
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {}
+        for job in jobs:
+            if "error" in job:
+                yield job["row"], job["error"], 0.0
+            else:
+                futures[executor.submit(run_job, job)] = job["row"]
+
+        for future in as_completed(futures):
+            try:
+                yield future.result()
+            except Exception as error: # pylint: disable=broad-except
+                # worker process died (e.g. out of memory)
+                yield futures[future], "%s: %s" % (type(error).__name__, error), 0.0
+
+def run_job(job):
+    '''
+    run_job : runs the enrichment analysis of a single screen, on a worker process
+        inputs:
+            job : dictionary with the arguments of the screen
+        output:
+            row : manifest row of the job
+            error : error message, None if succeeded
+            seconds : time it took to run the job
+    '''
+    start = time.time()
+    try:
+        makedirs(job["destination_folder"], exist_ok=True)
+        CSV2Excel.run_enrichment_analysis(job["destination_folder"], job["formulations_sheet"],\
+            job["csv_filepath"], job["sorted_cells"], job["x_percent"], job["sort_by"],\
+            job["percentile"], profile_report=job.get("profile_report", False),\
+            permutation_workers=1) # screens already run in parallel
+    except Exception as error: # pylint: disable=broad-except
+        return job["row"], "%s: %s" % (type(error).__name__, error), time.time() - start
+
+    return job["row"], None, time.time() - start
+
+def get_sort_by(string1):
+    '''
+    Returns sort_by of a manifest row, a single cell type/organ/AVG, "all" or a list of them
+    '''
+    sort_targets = string_to_list(string1)
+    if len(sort_targets) == 1:
+        return sort_targets[0]
+    return sort_targets
+
+def string_to_list(string1):
+    '''
+    Creates a list out of a string of items separated by commas
+    '''
+    string1 = string1.replace(" ", "")
+    if string1 == "":
+        raise ValueError("empty list")
+    return list(string1.split(","))
+
+if __name__ == "__main__":
+    sys.exit(main())
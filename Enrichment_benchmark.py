@@ -0,0 +1,358 @@
+'''
+Enrichment_benchmark: Benchmark suite of CSV2Excel on synthetic screens. Generates formulation
+sheets (LNP, BC, Lipomer, Lipomer %, Cholesterol, Cholesterol %, PEG, PEG %, Phospholipid,
+Phospholipid % with NAKED1/NAKED2 controls) and normalized count csv files of any number of
+barcodes and samples, times every stage and the whole run_enrichment_analysis, and appends the
+results to a json lines file so runs can be compared over time.
+
+Generated screens are kept in the work folder and reused by later runs of the same size and seed.
+
+--startup times the cold start of new python processes instead: importing CSV2Excel (command line)
+and showing the GUI window and loading its analysis libraries (skipped without a display).
+
+usage: python3 Enrichment_benchmark.py --preset medium --repeats 3 --compare
+       python3 Enrichment_benchmark.py --barcodes 1000 20000 --samples 10 100 --backend npz
+       python3 Enrichment_benchmark.py --preset medium --compact --compare
+       python3 Enrichment_benchmark.py --startup --repeats 5 --compare
+'''
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from subprocess import PIPE
+from os import path, makedirs
+
+import numpy as np
+import pandas as pd
+
+import CSV2Excel
+
+# (barcodes, samples) of each preset
+PRESETS = {"small" : [(1000, 10)], "medium" : [(1000, 10), (50000, 100)],\
+            "large" : [(1000, 10), (50000, 100), (500000, 1000)]}
+
+# cell types of the synthetic screens, the organ of a cell type is its first letter
+CELL_TYPES = ["LE", "LK", "LH", "SB", "ST", "SM", "KE", "KP", "HE", "HC"]
+
+LIPOMERS = ["7C1", "C12-200", "cKK-E12", "DLin-MC3", "SM-102", "ALC-0315", "OF-02", "5A2-SC8",\
+            "306Oi10", "C14-4", "A6", "LP01"]
+CHOLESTEROLS = ["Cholesterol", "b-Sitosterol", "Stigmastanol"]
+PEGS = ["C14PEG2000", "C18PEG2000", "C14PEG1000", "C16PEG2000"]
+PHOSPHOLIPIDS = ["DOPE", "DSPC", "DOTAP", "DDAB"]
+
+def main(argv=None):
+    '''
+    main : generates synthetic screens, benchmarks them and saves the results
+    '''
+    parser = argparse.ArgumentParser(description="Benchmark the enrichment analysis on "\
+                                    "synthetic screens")
+    parser.add_argument("--preset", choices=PRESETS, default="small", help="screen sizes to "\
+                        "benchmark (default = small), ignored if --barcodes is given")
+    parser.add_argument("--barcodes", type=int, nargs="+", help="numbers of barcodes")
+    parser.add_argument("--samples", type=int, nargs="+", help="numbers of samples, one per "\
+                        "number of barcodes (default = 10)")
+    parser.add_argument("--repeats", type=int, default=3, help="runs per screen, the median is "\
+                        "saved (default = 3)")
+    parser.add_argument("--sort-by", default="AVG", help="cell type/organ/AVG to sort by, several "\
+                        "separated by commas or all (default = AVG)")
+    parser.add_argument("--x-percent", type=float, default=10, help="top/bottom percent "\
+                        "(default = 10)")
+    parser.add_argument("--backend", default="xlsx", help="output backend (default = xlsx)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the screens")
+    parser.add_argument("--workdir", default="benchmark", help="folder for generated screens and "\
+                        "outputs (default = benchmark)")
+    parser.add_argument("--results", default="benchmark_results.jsonl", help="json lines file "\
+                        "the results are appended to (default = benchmark_results.jsonl)")
+    parser.add_argument("--compact", action="store_true", help="run with compact dtypes "\
+                        "(categorical components, float32 counts)")
+    parser.add_argument("--compare", action="store_true", help="compare with the previous "\
+                        "result of the same screen and backend, and with the result of the other "\
+                        "dtypes (compact or not)")
+    parser.add_argument("--startup", action="store_true", help="time the cold start of the "\
+                        "command line import and of the GUI instead of screens")
+    args = parser.parse_args(argv)
+
+    if args.startup:
+        result = benchmark_startup(args.repeats)
+        save_result(args.results, result)
+        previous = [saved for saved in read_results(args.results)[:-1] if "startup" in saved]\
+                    if args.compare else []
+        print_startup(result, previous[-1] if previous else None)
+        return 0
+
+    if args.barcodes:
+        samples = args.samples or [10]*len(args.barcodes)
+        if len(samples) != len(args.barcodes):
+            parser.error("give one number of samples per number of barcodes")
+        sizes = list(zip(args.barcodes, samples))
+    else:
+        sizes = PRESETS[args.preset]
+
+    sort_by = args.sort_by.replace(" ", "").split(",")
+    sort_by = sort_by[0] if len(sort_by) == 1 else sort_by
+
+    previous = read_results(args.results) if args.compare else []
+    for n_barcodes, n_samples in sizes:
+        result = benchmark_screen(n_barcodes, n_samples, args.repeats, sort_by, args.x_percent,\
+                                    args.backend, args.seed, args.workdir, args.compact)
+        save_result(args.results, result)
+        print_result(result, find_previous(previous, result))
+        if args.compare:
+            print_memory(result, find_previous(previous, dict(result,\
+                                                compact_dtypes=not args.compact)))
+
+    return 0
+
+def benchmark_screen(n_barcodes, n_samples, repeats, sort_by, x_percent, backend, seed,\
+                    workdir, compact_dtypes=False):
+    '''
+    benchmark_screen : runs the enrichment analysis of a synthetic screen several times
+        inputs:
+            n_barcodes : number of barcodes (LNPs) of the screen, without the naked controls
+            n_samples : number of samples of the screen
+            repeats : number of runs
+            sort_by : cell type/organ/AVG to sort by, a list of them or "all"
+            x_percent : percent to find top and bottom performing LNPs
+            backend : output backend (see Enrichment_output)
+            seed : random seed of the screen
+            workdir : folder for generated screens and outputs
+            compact_dtypes : runs with categorical components and float32 counts (default =
+                            False)
+        output:
+            result : dictionary with the screen, environment and median time of every stage
+    '''
+    screen_folder = path.join(workdir, "screen_%d_%d_%d" % (n_barcodes, n_samples, seed))
+    start = time.perf_counter()
+    formulations_sheet, csv_filepath, sorted_cells = generate_screen(screen_folder, n_barcodes,\
+                                                                    n_samples, seed)
+    generate_seconds = time.perf_counter() - start
+
+    output_folder = path.join(workdir, "output")
+    makedirs(output_folder, exist_ok=True)
+
+    reports = []
+    for _ in range(repeats):
+        # formulation sheets are not cached so every run reads them
+        reports.append(CSV2Excel.run_enrichment_analysis(output_folder, formulations_sheet,\
+                        csv_filepath, sorted_cells, x_percent, sort_by, cache_folder=None,\
+                        output_backend=backend, compact_dtypes=compact_dtypes))
+
+    stages = {}
+    for record in reports[0]["stages"]:
+        stages[record["stage"]] = statistics.median(stage["wall_seconds"] for report in reports\
+                                for stage in report["stages"] if stage["stage"] == record["stage"])
+
+    result = {"time" : time.strftime("%Y-%m-%dT%H:%M:%S"), "commit" : git_commit(),\
+            "barcodes" : n_barcodes, "samples" : n_samples, "seed" : seed, "sort_by" : sort_by,\
+            "x_percent" : x_percent, "backend" : backend, "compact_dtypes" : compact_dtypes,\
+            "repeats" : repeats,\
+            "python" : platform.python_version(), "pandas" : pd.__version__,\
+            "numpy" : np.__version__, "machine" : platform.platform(),\
+            "generate_seconds" : generate_seconds,\
+            "wall_seconds" : statistics.median(report["wall_seconds"] for report in reports),\
+            "cpu_seconds" : statistics.median(report["cpu_seconds"] for report in reports),\
+            "peak_rss_bytes" : max(report["peak_rss_bytes"] or 0 for report in reports),\
+            "bytes_written" : reports[0]["bytes_written"], "stages" : stages}
+
+    return result
+
+def generate_screen(folder, n_barcodes, n_samples, seed=0):
+    '''
+    generate_screen : creates formulation sheet and normalized counts csv of a synthetic screen,
+                    unless they are already on folder
+        inputs:
+            folder : folder to save the screen in
+            n_barcodes : number of barcodes (LNPs), without the naked controls
+            n_samples : number of samples, spread over the cell types
+            seed : random seed (default = 0)
+        output:
+            formulations_sheet : file path to excel spreadsheet with formulation sheet
+            csv_filepath : file path to csv with normalized counts
+            sorted_cells : list of cells that were sorted
+    '''
+    formulations_sheet = path.join(folder, "formulations.xlsx")
+    csv_filepath = path.join(folder, "normalized_counts.csv")
+    n_cells = max(1, min(len(CELL_TYPES), n_samples//2))
+    sorted_cells = CELL_TYPES[:n_cells]
+    if path.exists(formulations_sheet) and path.exists(csv_filepath):
+        return formulations_sheet, csv_filepath, sorted_cells
+
+    makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    n_rows = n_barcodes + 2 # naked controls are the last two rows
+
+    df_formulations = pd.DataFrame({"LNP" : ["LNP" + str(i + 1) for i in range(n_barcodes)] +\
+                                    ["NAKED1", "NAKED2"],\
+                                    "BC" : ["BC%07d" % i for i in range(n_rows)]})
+    for component, names, ratios in [("Lipomer", LIPOMERS, [35.0, 50.0]),\
+                                    ("Cholesterol", CHOLESTEROLS, [38.5, 46.5]),\
+                                    ("PEG", PEGS, [1.5, 2.5, 5.0]),\
+                                    ("Phospholipid", PHOSPHOLIPIDS, [10.0, 16.0])]:
+        df_formulations[component] = np.append(rng.choice(names, n_barcodes), [None, None])
+        df_formulations[component + " %"] = np.append(rng.choice(ratios, n_barcodes),\
+                                                    [np.nan, np.nan])
+    df_formulations.to_excel(formulations_sheet, sheet_name="Formulations", index=False)
+
+    # log-normal counts with dropouts, each sample normalized to 100%, rows in random order
+    counts = rng.lognormal(0, 1.5, (n_rows, n_samples))
+    counts[-2:] = rng.uniform(0, 0.01, (2, n_samples))
+    counts[rng.random((n_rows, n_samples)) < 0.05] = 0
+    counts = counts/counts.sum(axis=0)*100
+
+    sample_names = ["AD %s%d" % (sorted_cells[index % n_cells], index//n_cells + 1)\
+                    for index in range(n_samples)]
+    df_norm_counts = pd.DataFrame(counts, columns=sample_names)
+    df_norm_counts.insert(loc=0, column="Barcode", value=df_formulations["BC"])
+    df_norm_counts = df_norm_counts.iloc[rng.permutation(n_rows)]
+    df_norm_counts.to_csv(csv_filepath, index=False)
+
+    return formulations_sheet, csv_filepath, sorted_cells
+
+# code run on new python processes, each prints a line as it reaches a step of the start
+STARTUP_SCRIPTS = {"command line" : "import CSV2Excel\nprint('import CSV2Excel', flush=True)",\
+                "gui" : "from tkinter import Tk\nimport Enrichment_interface\nroot = Tk()\n"\
+                        "gui = Enrichment_interface.MyGUI(root)\nroot.update()\n"\
+                        "print('window shown', flush=True)\ngui.worker.events.get()\n"\
+                        "print('libraries loaded', flush=True)\nroot.destroy()"}
+
+def benchmark_startup(repeats):
+    '''
+    benchmark_startup : times the cold start of the command line import and of the GUI on new
+    python processes several times
+        inputs:
+            repeats : number of times each start is timed, the median is saved
+        output:
+            result : dictionary with the environment and the median seconds from launching the
+                    process to each step ("python" is an empty interpreter), steps that could not
+                    be reached (e.g. GUI without a display) are None
+    '''
+    steps = {}
+    for _ in range(repeats):
+        for script in ["print('python', flush=True)"] + list(STARTUP_SCRIPTS.values()):
+            for step, seconds in time_process(script).items():
+                steps.setdefault(step, []).append(seconds)
+
+    startup = {"python" : None, "import CSV2Excel" : None, "window shown" : None,\
+                "libraries loaded" : None}
+    for step, times in steps.items():
+        times = [seconds for seconds in times if seconds is not None]
+        if step in startup and len(times) == repeats:
+            startup[step] = statistics.median(times)
+
+    return {"time" : time.strftime("%Y-%m-%dT%H:%M:%S"), "commit" : git_commit(),\
+            "repeats" : repeats, "python" : platform.python_version(),\
+            "pandas" : pd.__version__, "numpy" : np.__version__,\
+            "machine" : platform.platform(), "startup" : startup}
+
+def time_process(script):
+    '''
+    time_process : runs script on a new python process from the folder of CSV2Excel
+        inputs:
+            script : python code printing a line as it reaches each step
+        output:
+            steps : dictionary with the seconds from launching the process to each line printed,
+                    empty if the process failed
+    '''
+    steps = {}
+    start = time.perf_counter()
+    with subprocess.Popen([sys.executable, "-c", script], stdout=PIPE, stderr=PIPE, text=True,\
+                        cwd=path.dirname(path.abspath(__file__))) as process:
+        for line in process.stdout:
+            steps[line.strip()] = time.perf_counter() - start
+        process.communicate()
+
+    return steps if process.returncode == 0 else {}
+
+def print_startup(result, previous=None):
+    '''
+    print_startup : prints the cold start time of every step, with the change from the previous
+    result if given
+    '''
+    print("cold start (median of %d)" % result["repeats"])
+    for step, seconds in result["startup"].items():
+        if seconds is None:
+            print("    %-20s not measured" % step)
+            continue
+        line = "    %-20s %.3f s" % (step, seconds)
+        before = previous["startup"].get(step) if previous else None
+        if before:
+            line += " (%+.1f%% vs %s)" % (100*(seconds/before - 1), previous.get("commit") or\
+                                        previous["time"])
+        print(line)
+
+def read_results(results_file):
+    '''
+    read_results : returns list of all results saved on a json lines file
+    '''
+    if not path.exists(results_file):
+        return []
+    with open(results_file) as json_file:
+        return [json.loads(line) for line in json_file if line.strip()]
+
+def save_result(results_file, result):
+    '''
+    save_result : appends result to a json lines file
+    '''
+    with open(results_file, "a") as json_file:
+        json_file.write(json.dumps(result) + "\n")
+
+def find_previous(results, result):
+    '''
+    find_previous : returns last result of the same screen and options, None if there is none
+    '''
+    keys = ["barcodes", "samples", "seed", "sort_by", "x_percent", "backend", "compact_dtypes"]
+    # results saved before compact dtypes were added ran without them
+    matches = [previous for previous in results\
+                if all(previous.get(key, False if key == "compact_dtypes" else None) == result[key]\
+                for key in keys)]
+    return matches[-1] if matches else None
+
+def print_result(result, previous=None):
+    '''
+    print_result : prints time of every stage, with the change from the previous result if given
+    '''
+    print("%d barcodes x %d samples, %s%s: %.3f s, peak RSS %.0f MB" % (result["barcodes"],\
+            result["samples"], result["backend"], ", compact" if result["compact_dtypes"] else "",\
+            result["wall_seconds"], result["peak_rss_bytes"]/2**20))
+
+    stages = [("total", result["wall_seconds"])] + list(result["stages"].items())
+    previous_stages = {}
+    if previous is not None:
+        previous_stages = dict(previous["stages"], total=previous["wall_seconds"])
+    for stage, seconds in stages:
+        line = "    %-28s %9.3f s" % (stage, seconds)
+        if previous_stages.get(stage):
+            line += "  %+7.1f%% vs %s" % (100*(seconds/previous_stages[stage] - 1),\
+                                        previous.get("commit") or previous["time"])
+        print(line)
+
+def print_memory(result, other):
+    '''
+    print_memory : prints peak memory and time with and without compact dtypes, if the other result
+                    was saved
+    '''
+    if other is None or not other["peak_rss_bytes"]:
+        return
+
+    default, compact = (other, result) if result["compact_dtypes"] else (result, other)
+    print("    peak RSS %.0f MB -> %.0f MB compact (%+.1f%%), time %.3f s -> %.3f s" %\
+            (default["peak_rss_bytes"]/2**20, compact["peak_rss_bytes"]/2**20,\
+            100*(compact["peak_rss_bytes"]/default["peak_rss_bytes"] - 1),\
+            default["wall_seconds"], compact["wall_seconds"]))
+
+def git_commit():
+    '''
+    git_commit : returns short hash of the checked out commit, None if not in a git repository
+    '''
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,\
+                            text=True, check=True, cwd=path.dirname(path.abspath(__file__)))\
+                            .stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == "__main__":
+    sys.exit(main())
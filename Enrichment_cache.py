@@ -0,0 +1,234 @@
+'''
+Enrichment_cache: On-disk cache for CSV2Excel. Entries are keyed by the content hash of the input
+files they were made from, so an entry is never used once its file changes. The least recently used
+entries are removed when the cache grows over its size limit.
+
+StageGraph runs a pipeline as stages with declared inputs (parameters and upstream stages), each
+stage is keyed by its parameters and the keys of its upstream stages, so a re-run loads every stage
+whose inputs did not change and only runs the stages downstream of what changed.
+
+The cache folder is ~/.cache/enrichment_analysis unless the ENRICHMENT_CACHE environment variable
+points somewhere else.
+'''
+import hashlib
+import json
+import os
+import pickle
+import sys
+import tempfile
+from contextlib import nullcontext, suppress
+from os import path
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_CACHE_FOLDER = os.environ.get("ENRICHMENT_CACHE",\
+                        path.join(path.expanduser("~"), ".cache", "enrichment_analysis"))
+DEFAULT_MAX_BYTES = 512*2**20 # 512 MB
+DEFAULT_MAX_ENTRY_BYTES = 128*2**20 # 128 MB, larger results are not cached
+STAGE_VERSION = "2" # change when the result of any stage changes, so old entries are not used
+
+class DiskCache:
+    '''
+    DiskCache : size bounded cache of python objects (e.g. dataframes) saved as binary files
+    '''
+
+    def __init__(self, folder=DEFAULT_CACHE_FOLDER, max_bytes=DEFAULT_MAX_BYTES,\
+                max_entry_bytes=DEFAULT_MAX_ENTRY_BYTES):
+        '''
+        Saves cache folder, size limit and size limit of a single entry, creates cache folder
+        '''
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        os.makedirs(folder, exist_ok=True)
+
+    def entry_path(self, key):
+        '''
+        Returns file path of the entry with given key
+        '''
+        return path.join(self.folder, key + ".pkl")
+
+    def get(self, key):
+        '''
+        Returns cached object with given key, None if it is not in the cache
+        '''
+        entry = self.entry_path(key)
+        try:
+            with open(entry, "rb") as entry_file:
+                value = pickle.load(entry_file)
+        except FileNotFoundError:
+            return None
+        except Exception: # pylint: disable=broad-except
+            # unreadable entry (e.g. written by another pandas version), drop it
+            self.remove(entry)
+            return None
+
+        # mark as recently used, unless another process sharing the folder evicted it meanwhile
+        with suppress(FileNotFoundError):
+            os.utime(entry)
+        return value
+
+    def put(self, key, value):
+        '''
+        Saves object with given key and evicts least recently used entries over the size limit,
+        objects estimated larger than the entry size limit are not saved (returns False)
+        '''
+        # large results (e.g. counts of large screens) are not pickled at all, writing them would
+        # cost more than reading them again and would evict every other entry
+        if estimated_size(value) > self.max_entry_bytes:
+            return False
+
+        # written to a temporary file first so readers never see half written entries
+        file_descriptor, temporary = tempfile.mkstemp(dir=self.folder, suffix=".tmp")
+        with os.fdopen(file_descriptor, "wb") as entry_file:
+            pickle.dump(value, entry_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, self.entry_path(key))
+
+        # the estimate missed (e.g. objects pandas does not measure), entry is not kept
+        if os.path.getsize(self.entry_path(key)) > self.max_entry_bytes:
+            self.remove(self.entry_path(key))
+            return False
+
+        self.evict()
+        return True
+
+    def evict(self):
+        '''
+        Removes least recently used entries until the cache is under its size limit
+        '''
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith(".pkl"):
+                try:
+                    stat = os.stat(path.join(self.folder, name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path.join(self.folder, name)))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.remove(entry)
+            total -= size
+
+    @staticmethod
+    def remove(entry):
+        '''
+        Removes entry file if it still exists
+        '''
+        try:
+            os.remove(entry)
+        except FileNotFoundError:
+            pass
+
+class StageGraph:
+    '''
+    StageGraph : stages of a pipeline, each run at most once and memoized on a DiskCache
+    '''
+
+    def __init__(self, cache=None, profiler=None):
+        '''
+        Saves cache (None to not memoize) and Enrichment_profile.Profiler recording each stage
+        '''
+        self.cache = cache
+        self.profiler = profiler
+        self.stages = {} # stage name : (compute, parameters, upstream stages, memoize)
+        self.results = {}
+        self.keys = {}
+
+    def add(self, name, compute, parameters=(), upstream=(), memoize=True):
+        '''
+        Adds stage, compute is called with the results of the upstream stages (in order) and
+        its result depends only on them and on the parameters (json serializable values, e.g.
+        file hashes and user inputs)
+        '''
+        self.stages[name] = (compute, list(parameters), list(upstream), memoize)
+
+    def key(self, name):
+        '''
+        Returns cache key of stage, changes when its parameters or any upstream stage change
+        '''
+        if name not in self.keys:
+            _, parameters, upstream, _ = self.stages[name]
+            # pickles of one pandas/numpy version are not loaded by another
+            description = json.dumps([STAGE_VERSION, pd.__version__, np.__version__, name,\
+                                    parameters, [self.key(stage) for stage in upstream]],\
+                                    default=str)
+            self.keys[name] = "stage-" + hashlib.sha256(description.encode()).hexdigest()
+        return self.keys[name]
+
+    def get(self, name):
+        '''
+        Returns result of stage, loaded from the cache or run (with its upstream stages)
+        '''
+        if name in self.results:
+            return self.results[name]
+
+        compute, _, upstream, memoize = self.stages[name]
+        memoized = self.cache is not None and memoize
+
+        result = None
+        if memoized and path.exists(self.cache.entry_path(self.key(name))):
+            with self.record(name) as record:
+                result = self.cache.get(self.key(name))
+                record["cached"] = result is not None
+                record_shape(record, result)
+        if result is None:
+            # upstream stages are loaded or run (and recorded) before this stage
+            inputs = [self.get(stage) for stage in upstream]
+            with self.record(name) as record:
+                result = compute(*inputs)
+                record["cached"] = False
+                record_shape(record, result)
+                if memoized:
+                    self.cache.put(self.key(name), result)
+        self.results[name] = result
+
+        return result
+
+    def record(self, name):
+        '''
+        Returns profiler stage of name (a record that is not kept if there is no profiler)
+        '''
+        if self.profiler is None:
+            return nullcontext({})
+        return self.profiler.stage(name)
+
+def record_shape(record, result):
+    '''
+    Saves rows and columns of the table of a stage result (the first item of tuples) on its record
+    '''
+    table = result[0] if isinstance(result, tuple) else result
+    if len(getattr(table, "shape", ())) == 2:
+        record["rows"], record["columns"] = table.shape
+
+def estimated_size(value):
+    '''
+    estimated_size : returns estimated size in bytes of a stage result (dataframes, series, arrays
+    and tuples, lists and dictionaries of them) without pickling it
+    '''
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (pd.Series, pd.Index)):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(estimated_size(key) + estimated_size(item) for key, item in value.items())
+    if isinstance(value, (tuple, list)):
+        return sum(estimated_size(item) for item in value)
+
+    return sys.getsizeof(value)
+
+def file_hash(filepath, block_size=1 << 20):
+    '''
+    file_hash : returns sha256 hash of the contents of a file
+    '''
+    sha256 = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            sha256.update(block)
+
+    return sha256.hexdigest()
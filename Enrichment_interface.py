@@ -6,10 +6,19 @@ Jan.2021
 Enrichment_interface: Graphical user interface (GUI) for CSV2Excel_Functionalized.py
 '''
 from tkinter import filedialog, Tk, StringVar, Label, Button, Entry, OptionMenu
+from tkinter.ttk import Progressbar
 from os import path
+from multiprocessing import freeze_support
+import functools
+import queue
 import sys
+import threading
+import time
 
-import CSV2Excel
+# CSV2Excel (with pandas, numpy and openpyxl) is imported on the background thread of
+# AnalysisWorker while the user fills in the form, so the window shows up right away
+
+POLL_MS = 100 # how often the window checks for events of the running analysis
 
 class MyGUI: # pylint: disable=too-many-instance-attributes
     '''
@@ -22,9 +31,14 @@ class MyGUI: # pylint: disable=too-many-instance-attributes
         '''
 
         self.master = master
-        master.geometry("600x500")
+        master.geometry("600x560")
         master.title("Enrichment Analysis Tool")
 
+        # analyses run one after another on a background thread, the window stays responsive
+        self.worker = AnalysisWorker()
+        self.queued = 0 # analyses submitted and not finished
+        self.status = StringVar(value="Loading analysis libraries...")
+
         # string variables from user input
         self.fsp = StringVar() # Formulation Sheet file Path
         self.ncp = StringVar() # Normalized Counts file Path
@@ -98,7 +112,15 @@ class MyGUI: # pylint: disable=too-many-instance-attributes
         Button(master, text="ENTER", width=16, fg="blue", font=("arial", 16),\
             command=self.enrichment_analysis).place(x=150, y=310)
         Button(master, text="CANCEL", width=16, fg="blue", font=("arial", 16),\
-            command=exit1).place(x=300, y=310)
+            command=self.cancel).place(x=300, y=310)
+
+        # maximum is set to the number of stages of the run as it reports them
+        self.progress = Progressbar(master, length=560)
+        self.progress.place(x=20, y=500)
+        self.status_label = Label(master, textvariable=self.status, font=("arial", 12, "bold"))
+        self.status_label.place(x=20, y=527)
+
+        master.after(POLL_MS, self.poll_events)
 
     def open_excel_file(self):
         '''
@@ -115,7 +137,7 @@ class MyGUI: # pylint: disable=too-many-instance-attributes
     def enrichment_analysis(self): # pylint: disable=too-many-branches
     # pylint: disable=too-many-statements
         '''
-        Checks for any entry errors, returns list of errors or runs the enrichment analysis
+        Checks for any entry errors, returns list of errors or queues the enrichment analysis
         '''
         errors = False
 
@@ -160,7 +182,7 @@ class MyGUI: # pylint: disable=too-many-instance-attributes
             font=("arial", 12, "bold")).place(x=20, y=350)
 
         # check for errors with normalized counts csv file
-        if ".csv" in self.ncp and path_exists(self.ncp):
+        if (".csv" in self.ncp or ".screen" in self.ncp) and path_exists(self.ncp):
             color2 = "white"
         else:
             color2 = "red"
@@ -235,12 +257,179 @@ class MyGUI: # pylint: disable=too-many-instance-attributes
             fg=color0, font=("arial", 12, "bold")).place(x=20, y=470)
 
         if not errors:
-            CSV2Excel.run_enrichment_analysis(fold_path, self.fsp, self.ncp,
-                cell_types, percent, sort_by, percentile)
-            print("Enrichment analysis performed!")
+            self.worker.submit(sort_by, (fold_path, self.fsp, self.ncp, cell_types, percent,\
+                                        sort_by, percentile))
+            self.queued += 1
+            if self.queued > 1:
+                self.status.set("Enrichment analysis " + sort_by + " queued (" +\
+                                str(self.queued - 1) + " waiting)")
+
+    def cancel(self):
+        '''
+        Cancels the running analysis and the queued ones, closes the GUI if none is running
+        '''
+        if self.queued == 0:
             exit1()
+
+        self.queued -= self.worker.cancel()
+        self.status.set("Cancelling after the current step...")
+        self.status_label.config(fg="black")
+
+    def poll_events(self):
+        '''
+        Shows events of the background analyses on the progress bar and status line
+        '''
+        try:
+            while True:
+                event, detail = self.worker.events.get_nowait()
+                if event == "loaded":
+                    self.show_loaded(detail)
+                elif event == "start":
+                    self.progress["value"] = 0
+                    self.status.set("Running enrichment analysis " + detail + "...")
+                    self.status_label.config(fg="black")
+                elif event == "stage":
+                    stage, expected_stages = detail
+                    self.progress["maximum"] = expected_stages
+                    self.progress["value"] = min(self.progress["value"] + 1, expected_stages - 1)
+                    self.status.set("Running: " + stage)
+                else:
+                    self.queued -= 1
+                    self.show_result(event, detail)
+        except queue.Empty:
+            pass
+
+        self.master.after(POLL_MS, self.poll_events)
+
+    def show_loaded(self, detail):
+        '''
+        Shows how long the analysis libraries took to load, or why they could not be loaded
+        '''
+        if isinstance(detail, str):
+            message = "Could not load analysis libraries: " + detail
+            self.status.set(message)
+            self.status_label.config(fg="red")
+        else:
+            message = "Analysis libraries loaded in %.1f s" % detail
+            if self.queued == 0:
+                self.status.set("Ready (" + message + ")")
+        print(message)
+
+    def show_result(self, event, detail):
+        '''
+        Shows how an analysis ended ("done", "cancelled" or "error")
+        '''
+        waiting = " (" + str(self.queued) + " waiting)" if self.queued else ""
+        if event == "done":
+            self.progress["value"] = self.progress["maximum"]
+            self.status.set("Enrichment analysis " + detail + " performed!" + waiting)
+            self.status_label.config(fg="green")
+            print("Enrichment analysis performed!")
+        elif event == "cancelled":
+            self.progress["value"] = 0
+            self.status.set("Enrichment analysis " + detail + " cancelled" + waiting)
+            self.status_label.config(fg="black")
+        else:
+            self.progress["value"] = 0
+            self.status.set("Enrichment analysis failed: " + detail + waiting)
+            self.status_label.config(fg="red")
+
+class Cancelled(Exception):
+    '''
+    Raised on the background thread to stop the running analysis after its current step
+    '''
+
+class AnalysisWorker:
+    '''
+    Runs queued enrichment analyses one after another on a background thread, reporting "loaded"
+    (seconds CSV2Excel took to import, or the import error), "start", "stage" (name of every
+    finished stage and number of stages of the run) and "done", "cancelled" or "error" events on a
+    queue
+    '''
+
+    def __init__(self):
+        '''
+        Saves job and event queues and starts the background thread
+        '''
+        self.jobs = queue.Queue()
+        self.events = queue.Queue()
+        # cancel events of the analyses submitted and not finished, each analysis has its own so a
+        # cancel is never lost or carried over to the next analysis
+        self.pending = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, name, arguments):
+        '''
+        Queues an analysis with the arguments of CSV2Excel.run_enrichment_analysis
+        '''
+        cancelled = threading.Event()
+        with self.lock:
+            self.pending.append(cancelled)
+        self.jobs.put((name, arguments, cancelled))
+
+    def cancel(self):
+        '''
+        Removes queued analyses and stops the running one after its current step, returns the
+        number of queued analyses removed
+        '''
+        removed = 0
+        with self.lock:
+            try:
+                while True:
+                    self.pending.remove(self.jobs.get_nowait()[2])
+                    removed += 1
+            except queue.Empty:
+                pass
+
+            # the running analysis, also if it was taken off the queue but did not start yet
+            for cancelled in self.pending:
+                cancelled.set()
+        return removed
+
+    def run(self):
+        '''
+        Imports CSV2Excel, then runs analyses as they are queued, on the background thread
+        '''
+        start = time.perf_counter()
+        load_error = None
+        try:
+            import CSV2Excel # pylint: disable=import-outside-toplevel
+        except Exception as error: # pylint: disable=broad-except
+            load_error = type(error).__name__ + ": " + str(error)
+            self.events.put(("loaded", load_error))
         else:
-            self.master.mainloop()
+            self.events.put(("loaded", time.perf_counter() - start))
+
+        while True:
+            name, arguments, cancelled = self.jobs.get()
+            self.events.put(("start", name))
+            try:
+                if load_error is not None:
+                    self.events.put(("error", load_error))
+                    continue
+                if cancelled.is_set():
+                    raise Cancelled()
+                CSV2Excel.run_enrichment_analysis(*arguments, hooks=[functools.partial(\
+                                                self.stage_finished, cancelled=cancelled)])
+            except Cancelled:
+                self.events.put(("cancelled", name))
+            except Exception as error: # pylint: disable=broad-except
+                self.events.put(("error", type(error).__name__ + ": " + str(error)))
+            else:
+                self.events.put(("done", name))
+            finally:
+                with self.lock:
+                    self.pending.remove(cancelled)
+
+    def stage_finished(self, record, cancelled):
+        '''
+        Reports a finished stage, stops the analysis if its cancel event is set
+        '''
+        self.events.put(("stage", (record["stage"], record["expected_stages"])))
+        if cancelled.is_set():
+            raise Cancelled()
 
 def get_cell_type(option, organ="", cell_type=""):
     '''
@@ -298,6 +487,8 @@ def path_exists(path1):
     '''
     return path.exists(path1)
 
-root = Tk()
-my_gui = MyGUI(root)
-root.mainloop()
+if __name__ == "__main__":
+    freeze_support() # permutation test worker processes on executables made with pyinstaller
+    root = Tk()
+    my_gui = MyGUI(root)
+    root.mainloop()
@@ -0,0 +1,319 @@
+'''
+Enrichment_output: Output backends of CSV2Excel. Every backend receives the same sheets with
+write_sheet:
+    sheet name : name of the sheet (e.g. "Net Enrichment Factors LE")
+    blocks : list of (dataframe, startrow, startcol) laid out on the sheet as on the excel output
+    table : the sheet as a single table, or a dictionary of tables by name for sheets that lay out
+            more than one (e.g. the sorted LNPs beside the levels of "Form Enrichment LE Top"), for
+            outputs that are not spreadsheets
+    cells : dictionary of single cells (e.g. {"A1" : "Top"}) written over the blocks
+and write a single table with write_table. Outputs are used as context managers, the output is saved
+when the with block ends, or removed if it ends with an error so no partial output is left.
+
+Backends:
+    xlsx : excel spreadsheet written with pandas and openpyxl (default)
+    xlsx-stream : excel spreadsheet written row by row with openpyxl in write only mode
+    csv : folder with one csv file per sheet
+    parquet : folder with one parquet file per sheet (requires pyarrow or fastparquet)
+    hdf5 : single hdf5 file with one table per sheet (requires pytables)
+    npz : single numpy npz file with one array per column of each sheet
+'''
+import importlib.util
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+EXCEL_MAX_ROWS = 1048576
+
+# file extension of the destination of each backend ("" for folders)
+OUTPUT_EXTENSIONS = {"xlsx" : ".xlsx", "xlsx-stream" : ".xlsx", "csv" : "", "parquet" : "",\
+                    "hdf5" : ".h5", "npz" : ".npz"}
+
+# optional packages of each backend, any one of them is enough
+OUTPUT_REQUIREMENTS = {"parquet" : ["pyarrow", "fastparquet"], "hdf5" : ["tables"]}
+
+def open_output(destination, backend="xlsx"):
+    '''
+    open_output : returns output of given backend saving to destination (file or folder path)
+    '''
+    check_backend(backend)
+    outputs = {"xlsx" : ExcelOutput, "xlsx-stream" : StreamingExcelOutput, "csv" : CSVOutput,\
+            "parquet" : ParquetOutput, "hdf5" : HDF5Output, "npz" : NPZOutput}
+
+    return outputs[backend](destination)
+
+def check_backend(backend):
+    '''
+    check_backend : raises ValueError if backend is unknown and ImportError if the packages it
+    requires are not installed, so a run fails before the analysis instead of when writing
+    '''
+    if backend not in OUTPUT_EXTENSIONS:
+        raise ValueError("Unknown output backend " + str(backend) + ", use one of: " +\
+                        ", ".join(OUTPUT_EXTENSIONS))
+
+    requirements = OUTPUT_REQUIREMENTS.get(backend, [])
+    if requirements and not any(importlib.util.find_spec(package) for package in requirements):
+        raise ImportError("Output backend " + backend + " requires " +\
+                        " or ".join(requirements) + ", install it with pip3 install " +\
+                        requirements[0])
+
+class Output:
+    '''
+    Output : base class of output backends, used as a context manager that saves all sheets when
+    closed and removes what was written if the with block raised
+    '''
+
+    def __init__(self, destination):
+        '''
+        Saves destination file or folder path
+        '''
+        self.destination = destination
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif not self.closed:
+            self.closed = True
+            self.discard()
+
+    def write_sheet(self, sheet_name, blocks, table=None, cells=None):
+        '''
+        Writes a sheet as its tables (default = the first block), each named by its key if table
+        is a dictionary
+        '''
+        if table is None:
+            table = blocks[0][0]
+        tables = table if isinstance(table, dict) else {sheet_name : table}
+        for table_name, df_table in tables.items():
+            self.write_table(table_name, plain_dtypes(df_table))
+
+    def write_table(self, sheet_name, table):
+        '''
+        Writes a sheet as a single table, implemented by every backend
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        '''
+        Saves output, once
+        '''
+        if not self.closed:
+            self.closed = True
+            self.save()
+
+    def save(self):
+        '''
+        Saves sheets kept in memory (backends that write each sheet as it comes save nothing)
+        '''
+
+    def discard(self):
+        '''
+        Removes what was written of an output that will not be completed
+        '''
+
+class ExcelOutput(Output):
+    '''
+    ExcelOutput : excel spreadsheet kept open in a single pandas/openpyxl writer session
+    '''
+
+    def __init__(self, destination):
+        super().__init__(destination)
+        # the file is opened here and given to the writer, so it is closed even if the workbook
+        # is never saved
+        self.file = open(destination, "wb") # pylint: disable=consider-using-with
+        self.writer = pd.ExcelWriter(self.file, engine="openpyxl",\
+                                    mode="w") # pylint: disable=abstract-class-instantiated
+
+    def write_sheet(self, sheet_name, blocks, table=None, cells=None):
+        for df_block, startrow, startcol in blocks:
+            df_block.to_excel(self.writer, sheet_name=sheet_name, startrow=startrow,\
+                            startcol=startcol, index=False)
+
+        # cells are set on the open session, saved with the rest of the workbook
+        sheet = self.writer.sheets[sheet_name]
+        for cell, value in (cells or {}).items():
+            sheet[cell] = value
+
+    def write_table(self, sheet_name, table):
+        self.write_sheet(sheet_name, [(table, 0, 0)])
+
+    def save(self):
+        try:
+            self.writer.close()
+        finally:
+            self.file.close()
+
+    def discard(self):
+        self.file.close()
+        remove_file(self.destination)
+
+class StreamingExcelOutput(Output):
+    '''
+    StreamingExcelOutput : excel spreadsheet written row by row in openpyxl write only mode, only
+    the row being written is kept in memory as cells
+    '''
+
+    def __init__(self, destination):
+        super().__init__(destination)
+        # openpyxl is imported by the backends that use it, not when the module is imported
+        from openpyxl import Workbook # pylint: disable=import-outside-toplevel
+        self.workbook = Workbook(write_only=True)
+
+    def write_sheet(self, sheet_name, blocks, table=None, cells=None):
+        n_rows = max(startrow + len(df_block) + 1 for df_block, startrow, _ in blocks)
+        if n_rows > EXCEL_MAX_ROWS:
+            raise ValueError("Sheet " + sheet_name + " has " + str(n_rows) + " rows, more than "\
+                            "excel allows, use a csv, parquet, hdf5 or npz output instead")
+
+        # pylint: disable=import-outside-toplevel
+        from openpyxl.utils.cell import coordinate_to_tuple
+
+        n_columns = max(startcol + len(df_block.columns) for df_block, _, startcol in blocks)
+        cells_by_row = {}
+        for cell, value in (cells or {}).items():
+            row, column = coordinate_to_tuple(cell)
+            cells_by_row.setdefault(row - 1, {})[column - 1] = value
+
+        # rows of each block are read one at a time as the sheet is written
+        rows = [(startrow, startcol, df_block.columns.tolist(), len(df_block),\
+                plain_dtypes(df_block).itertuples(index=False, name=None)) for df_block, startrow,\
+                startcol in sorted(blocks, key=lambda block: block[1])]
+
+        sheet = self.workbook.create_sheet(sheet_name)
+        for row in range(n_rows):
+            values = [None]*n_columns
+            for startrow, startcol, columns, n_block_rows, block_rows in rows:
+                if row == startrow:
+                    values[startcol:startcol + len(columns)] = columns
+                elif startrow < row <= startrow + n_block_rows:
+                    values[startcol:startcol + len(columns)] = [cell_value(value) for value in\
+                                                                next(block_rows)]
+            for column, value in cells_by_row.get(row, {}).items():
+                values[column] = value
+            sheet.append(values)
+
+    def write_table(self, sheet_name, table):
+        self.write_sheet(sheet_name, [(table, 0, 0)])
+
+    def save(self):
+        self.workbook.save(self.destination)
+
+    def discard(self):
+        # rows written so far are on temporary files of openpyxl, removed when python exits
+        for sheet in self.workbook.worksheets:
+            sheet.close()
+
+class CSVOutput(Output):
+    '''
+    CSVOutput : folder with one csv file per sheet
+    '''
+
+    def __init__(self, destination):
+        super().__init__(destination)
+        os.makedirs(destination, exist_ok=True)
+        self.written = [] # files of this output, the folder may hold other files
+
+    def write_table(self, sheet_name, table):
+        self.written.append(os.path.join(self.destination, sheet_name + ".csv"))
+        table.to_csv(self.written[-1], index=False)
+
+    def discard(self):
+        for table_file in self.written:
+            remove_file(table_file)
+
+class ParquetOutput(CSVOutput):
+    '''
+    ParquetOutput : folder with one parquet file per sheet
+    '''
+
+    def write_table(self, sheet_name, table):
+        table = table.copy()
+        table.columns = [str(column) for column in table.columns]
+        self.written.append(os.path.join(self.destination, sheet_name + ".parquet"))
+        table.to_parquet(self.written[-1], index=False)
+
+class HDF5Output(Output):
+    '''
+    HDF5Output : single hdf5 file with one table per sheet, named after the sheet
+    '''
+
+    def __init__(self, destination):
+        super().__init__(destination)
+        if os.path.exists(destination):
+            os.remove(destination)
+
+    def write_table(self, sheet_name, table):
+        table = table.copy()
+        table.columns = [str(column) for column in table.columns]
+        table.to_hdf(self.destination, key=table_key(sheet_name), format="table")
+
+    def discard(self):
+        remove_file(self.destination)
+
+class NPZOutput(Output):
+    '''
+    NPZOutput : single numpy npz file with an array per column of each sheet named
+    "<sheet>/<column>", and the column order of each sheet on "<sheet>/__columns__"
+    '''
+
+    def __init__(self, destination):
+        super().__init__(destination)
+        self.arrays = {}
+
+    def write_table(self, sheet_name, table):
+        key = table_key(sheet_name)
+        self.arrays[key + "/__columns__"] = np.array([str(column) for column in table.columns])
+        for column in table.columns:
+            values = table[column].to_numpy()
+            if values.dtype == object:
+                # text columns are saved as fixed width strings, readable without pickle
+                values = table[column].astype(str).to_numpy().astype(str)
+            self.arrays[key + "/" + str(column)] = values
+
+    def save(self):
+        np.savez(self.destination, **self.arrays)
+
+def plain_dtypes(table):
+    '''
+    Returns table with categorical columns as their values and float32 columns as float64, so
+    compact dataframes are saved as the same values and types as the others
+    '''
+    dtypes = {}
+    for column, dtype in table.dtypes.items():
+        if isinstance(dtype, pd.CategoricalDtype):
+            dtypes[column] = dtype.categories.dtype
+        elif dtype == np.float32:
+            dtypes[column] = np.float64
+    if not dtypes:
+        return table
+
+    return table.astype(dtypes)
+
+def cell_value(value):
+    '''
+    Returns value as written by pandas on excel cells (missing values as empty cells)
+    '''
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    return value
+
+def remove_file(filepath):
+    '''
+    Removes file if it exists
+    '''
+    try:
+        os.remove(filepath)
+    except FileNotFoundError:
+        pass
+
+def table_key(sheet_name):
+    '''
+    Returns sheet name as a key usable on hdf5 and npz files
+    '''
+    return re.sub(r"\W+", "_", sheet_name).strip("_")
@@ -0,0 +1,247 @@
+'''
+Enrichment_permutation: Permutation test of the net enrichment factors of CSV2Excel. The top and
+bottom performing LNPs are replaced by random LNPs (same sizes, naked barcodes excluded) many times,
+and the net enrichment factor of every component level is recalculated for each permutation. The
+p-value of a level is the fraction of permutations with a net enrichment factor at least as far from
+zero as the observed one, the FDR is the Benjamini-Hochberg adjusted p-value over all levels.
+
+Shuffling the ranking only changes how many LNPs of each level fall on the top and bottom sets, so
+instead of shuffling all LNPs those counts are drawn directly from their (multivariate
+hypergeometric) distribution, the same for any number of LNPs. Permutations are drawn in batches,
+a vector operation per level for the whole batch, and batches are spread over a pool of worker
+processes when there are many permutations.
+'''
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+
+import numpy as np
+import pandas as pd
+
+BATCH_ELEMENTS = 1 << 20 # permutations x bins drawn per batch, bounds memory of a batch
+PARALLEL_ELEMENTS = 1 << 26 # permutations x bins from which batches run on worker processes
+
+_STATE = {} # counts and set sizes of the test running on this process
+
+def permutation_test(df_averaged, dict_components, top, bottom, permutations=1000, workers=None,\
+                    seed=0):
+    '''
+    permutation_test : finds p-value and FDR of the net enrichment factor of every component level
+        inputs:
+            df_averaged : dataframe with averaged normalized counts by cell type
+            dict_components : dictionary containing list of all the component mole ratios and
+                            types
+            top : positions on df_averaged of top performing LNPs
+            bottom : positions on df_averaged of bottom performing LNPs
+            permutations : number of random top/bottom sets (default = 1000)
+            workers : number of worker processes (default = None, one per CPU for many
+                    permutations and none for few)
+            seed : random seed, results do not depend on the number of workers (default = 0)
+        output:
+            df_significance : dataframe of "P-value" and "FDR" with a row per bin of
+                            encode_components (every level of each component, then an empty TOTAL
+                            row), in the row order of the enrichment table of CSV2Excel
+    '''
+    codes, offsets = encode_components(df_averaged, dict_components)
+
+    # random sets are drawn from the LNPs only, as many as there are in the observed sets
+    is_naked = df_averaged["LNP"].isin(["NAKED1", "NAKED2"]).to_numpy()
+    population = np.flatnonzero(~is_naked)
+    n_top = int((~is_naked[top]).sum())
+    n_bottom = int((~is_naked[bottom]).sum())
+
+    counts_all = np.bincount(codes[population].ravel(), minlength=offsets[-1])
+    observed = net_enrichment(count_sets(codes, np.asarray(top)[None, :], offsets[-1]),\
+                            count_sets(codes, np.asarray(bottom)[None, :], offsets[-1]),\
+                            counts_all, offsets)[0]
+
+    state = {"counts_all" : counts_all, "offsets" : offsets, "n_top" : n_top,\
+            "n_bottom" : n_bottom, "observed" : observed}
+
+    exceed = np.zeros(offsets[-1], dtype=np.int64)
+    if n_top > 0 and n_bottom > 0 and n_top + n_bottom <= len(population) and permutations > 0:
+        # batches and their seeds only depend on the screen, not on the number of workers
+        batch_size = max(1, min(permutations, BATCH_ELEMENTS//offsets[-1]))
+        sizes = [min(batch_size, permutations - start) for start in\
+                range(0, permutations, batch_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+        if workers is None:
+            workers = cpu_count() if permutations*offsets[-1] >= PARALLEL_ELEMENTS else 1
+        workers = max(1, min(workers, len(sizes)))
+
+        if workers == 1:
+            set_state(state)
+            for batch_seed, size in zip(seeds, sizes):
+                exceed += permutation_batch(batch_seed, size)
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=set_state,\
+                                    initargs=(state,)) as executor:
+                for batch_exceed in executor.map(permutation_batch, seeds, sizes):
+                    exceed += batch_exceed
+
+    # last bin of each component are the LNPs without it, shown as the TOTAL row (nan observed)
+    p_values = (exceed + 1)/(permutations + 1)
+    p_values[np.isnan(observed)] = np.nan
+    fdr = false_discovery_rate(p_values)
+
+    return pd.DataFrame({"P-value" : p_values, "FDR" : fdr})
+
+def encode_components(df_averaged, dict_components):
+    '''
+    encode_components : numbers the levels of all components in a single range of bins
+        inputs:
+            df_averaged : dataframe with averaged normalized counts by cell type
+            dict_components : dictionary containing list of all the component mole ratios and
+                            types
+        output:
+            codes : array (LNPs x components) with the bin of each LNP on each component, LNPs
+                    without a level of the component (e.g. naked barcodes) on its last bin
+            offsets : first bin of each component, and total number of bins
+    '''
+    columns = []
+    offsets = [0]
+    for component, component_list in dict_components.items():
+        codes = component_codes(df_averaged[component], component_list).astype(np.int64)
+        codes[codes < 0] = len(component_list)
+        columns.append(codes + offsets[-1])
+        offsets.append(offsets[-1] + len(component_list) + 1)
+
+    return np.stack(columns, axis=1), np.array(offsets)
+
+def component_codes(column, component_list):
+    '''
+    component_codes : position on component_list of every value of a component column, from the
+                    codes of the column when it is categorical
+        inputs:
+            column : series of component types or mole ratios
+            component_list : list of all component types and component ratios of the component
+        output:
+            codes : array with the position of each value on component_list (-1 if not on it)
+    '''
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        # categories are looked up once, missing values (code -1) take the appended -1
+        positions = pd.Categorical(column.cat.categories, categories=component_list).codes
+        return np.append(positions, -1)[column.cat.codes.to_numpy()]
+
+    return pd.Categorical(column.to_numpy(), categories=component_list).codes
+
+def count_sets(codes, sets, n_bins):
+    '''
+    count_sets : counts LNPs on every bin of every set with a single bincount
+        inputs:
+            codes : array (LNPs x components) of bins from encode_components
+            sets : array (sets x LNPs per set) of positions on codes
+            n_bins : total number of bins
+        output:
+            counts : array (sets x bins) with the number of LNPs of each set on each bin
+    '''
+    bins = codes[sets] + (np.arange(len(sets))*n_bins)[:, None, None]
+    return np.bincount(bins.ravel(), minlength=len(sets)*n_bins).reshape(len(sets), n_bins)
+
+def net_enrichment(counts_top, counts_bottom, counts_all, offsets):
+    '''
+    net_enrichment : calculates net enrichment factors as enrichment_model of CSV2Excel
+        inputs:
+            counts_top : array (sets x bins) of counts of top performing sets
+            counts_bottom : array (sets x bins) of counts of bottom performing sets
+            counts_all : array (bins) of counts of all LNPs
+            offsets : first bin of each component, and total number of bins
+        output:
+            net : array (sets x bins) of net enrichment factors (nan on the last bin of each
+                component)
+    '''
+    return enrichment_factors(counts_top, counts_all, offsets) -\
+            enrichment_factors(counts_bottom, counts_all, offsets)
+
+def enrichment_factors(counts, counts_all, offsets):
+    '''
+    enrichment_factors : calculates raw enrichment factors as enrichment_model of CSV2Excel
+        inputs:
+            counts : array (sets x bins) of counts of sets of LNPs
+            counts_all : array (bins) of counts of all LNPs
+            offsets : first bin of each component, and total number of bins
+        output:
+            factors : array (sets x bins) of fraction of each set on each level over fraction of
+                    all LNPs (nan on the last bin of each component)
+    '''
+    factors = np.full(counts.shape, np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for start, end in zip(offsets[:-1], offsets[1:] - 1):
+            fraction_all = counts_all[start:end]/counts_all[start:end].sum()
+            factors[:, start:end] = counts[:, start:end]/counts[:, start:end].sum(axis=1,\
+                                                                keepdims=True)/fraction_all
+
+    return factors
+
+def set_state(state):
+    '''
+    set_state : saves counts and set sizes of the test on this process
+    '''
+    _STATE.clear()
+    _STATE.update(state)
+
+def permutation_batch(seed, n_permutations):
+    '''
+    permutation_batch : draws a batch of random top/bottom sets and counts the permutations with a
+                        net enrichment factor at least as extreme as observed
+        inputs:
+            seed : seed sequence of the batch
+            n_permutations : number of permutations of the batch
+        output:
+            exceed : array (bins) of number of permutations at least as extreme as observed
+    '''
+    counts_all, offsets = _STATE["counts_all"], _STATE["offsets"]
+    rng = np.random.default_rng(seed)
+
+    # top sets are drawn from all LNPs, bottom sets from the LNPs left out of the top set
+    counts_top = np.zeros((n_permutations, offsets[-1]), dtype=np.int64)
+    counts_bottom = np.zeros((n_permutations, offsets[-1]), dtype=np.int64)
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        counts_top[:, start:end] = draw_counts(rng, np.broadcast_to(counts_all[start:end],\
+                                    (n_permutations, end - start)), _STATE["n_top"])
+        counts_bottom[:, start:end] = draw_counts(rng, counts_all[start:end] -\
+                                    counts_top[:, start:end], _STATE["n_bottom"])
+
+    net = net_enrichment(counts_top, counts_bottom, counts_all, offsets)
+
+    # tolerance so permutations equal to the observed value count as extreme
+    observed = np.abs(_STATE["observed"]) - 1e-12
+    with np.errstate(invalid="ignore"):
+        return (np.abs(net) >= observed).sum(axis=0)
+
+def draw_counts(rng, levels, n_sample):
+    '''
+    draw_counts : draws how many LNPs of each level are on random sets, one level at a time from
+                the LNPs of the levels left (multivariate hypergeometric distribution)
+        inputs:
+            rng : numpy random generator
+            levels : array (sets x levels) of number of LNPs of each level to draw from
+            n_sample : number of LNPs of each set
+        output:
+            counts : array (sets x levels) of number of LNPs of each level on each set
+    '''
+    counts = np.zeros(levels.shape, dtype=np.int64)
+    left_sample = np.full(len(levels), n_sample)
+    left_lnps = levels.sum(axis=1)
+    for level in range(levels.shape[1] - 1):
+        left_lnps = left_lnps - levels[:, level]
+        counts[:, level] = rng.hypergeometric(levels[:, level], left_lnps, left_sample)
+        left_sample = left_sample - counts[:, level]
+    counts[:, -1] = left_sample # rest of the set is on the last level
+
+    return counts
+
+def false_discovery_rate(p_values):
+    '''
+    false_discovery_rate : Benjamini-Hochberg adjusted p-values (nan p-values are left out)
+    '''
+    fdr = np.full(len(p_values), np.nan)
+    tested = np.flatnonzero(~np.isnan(p_values))
+    if len(tested) == 0:
+        return fdr
+
+    order = tested[np.argsort(p_values[tested], kind="stable")]
+    adjusted = p_values[order]*len(tested)/np.arange(1, len(tested) + 1)
+    fdr[order] = np.minimum(np.minimum.accumulate(adjusted[::-1])[::-1], 1)
+
+    return fdr
@@ -0,0 +1,127 @@
+'''
+Enrichment_profile: Per stage timing and memory instrumentation of CSV2Excel. Each stage of the
+enrichment analysis (reading, outlier removal, merging, averaging, top/bottom, enrichment tables,
+net enrichment, winning LNPs, saving) is recorded as a dictionary with:
+    stage : name of the stage (e.g. "top/bottom LE")
+    wall_seconds : elapsed time
+    cpu_seconds : processor time of the process
+    peak_rss_bytes : peak resident memory of the process at the end of the stage (None if the
+                    platform does not report it)
+    peak_allocated_bytes : peak memory allocated by python and numpy during the stage (None unless
+                            trace_allocations is set, tracing slows the run down)
+    rows, columns : size of the table processed by the stage
+    bytes_written : bytes added to the output file or folder during the stage
+    expected_stages : number of stages the run is expected to record (None if it did not say, see
+                    Profiler.expect), for progress bars
+
+Every record is passed to the hooks (callables taking the record) as soon as its stage ends.
+'''
+import json
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # not available on windows
+    resource = None
+
+class Profiler:
+    '''
+    Profiler : records stages of a run and reports them to hooks
+    '''
+
+    def __init__(self, hooks=None, trace_allocations=False):
+        '''
+        Saves hooks (list of callables) and whether to trace allocations
+        '''
+        self.hooks = list(hooks or [])
+        self.trace_allocations = trace_allocations
+        self.stages = []
+        self.expected = None
+        self.start = time.perf_counter()
+
+    def expect(self, stages):
+        '''
+        Adds stages to the number of stages the run is expected to record
+        '''
+        self.expected = (self.expected or 0) + stages
+
+    @contextmanager
+    def stage(self, name, destination=None):
+        '''
+        Records the stage run inside the with block, the yielded record can be given the rows and
+        columns processed. Bytes written are measured on destination (file or folder path).
+        '''
+        record = {"stage" : name, "rows" : None, "columns" : None}
+        bytes_before = output_size(destination)
+        tracing = self.trace_allocations and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        elif self.trace_allocations:
+            tracemalloc.reset_peak()
+        wall, cpu = time.perf_counter(), time.process_time()
+
+        try:
+            yield record
+        finally:
+            record["wall_seconds"] = time.perf_counter() - wall
+            record["cpu_seconds"] = time.process_time() - cpu
+            record["peak_rss_bytes"] = peak_rss()
+            record["peak_allocated_bytes"] = None
+            if self.trace_allocations:
+                record["peak_allocated_bytes"] = tracemalloc.get_traced_memory()[1]
+            if tracing:
+                tracemalloc.stop()
+            record["bytes_written"] = output_size(destination) - bytes_before
+            record["expected_stages"] = self.expected
+
+            self.stages.append(record)
+            for hook in self.hooks:
+                hook(record)
+
+    def report(self):
+        '''
+        Returns dictionary with all stage records and totals of the run
+        '''
+        return {"wall_seconds" : time.perf_counter() - self.start,\
+                "cpu_seconds" : sum(record["cpu_seconds"] for record in self.stages),\
+                "peak_rss_bytes" : peak_rss(),\
+                "bytes_written" : sum(record["bytes_written"] for record in self.stages),\
+                "stages" : self.stages}
+
+    def write_report(self, report_file):
+        '''
+        Saves report as a json file
+        '''
+        with open(report_file, "w") as json_file:
+            json.dump(self.report(), json_file, indent=2)
+
+def peak_rss():
+    '''
+    Returns peak resident memory of the process in bytes, None if the platform does not report it
+    '''
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin": # bytes on macOS, kilobytes elsewhere
+        return peak
+    return peak*1024
+
+def output_size(destination):
+    '''
+    Returns size in bytes of an output file or folder (0 if it does not exist yet)
+    '''
+    if destination is None or not os.path.exists(destination):
+        return 0
+    if os.path.isfile(destination):
+        return os.path.getsize(destination)
+
+    size = 0
+    for folder, _, files in os.walk(destination):
+        for name in files:
+            size += os.path.getsize(os.path.join(folder, name))
+    return size
@@ -0,0 +1,364 @@
+'''
+Enrichment_server: Local query service for CSV2Excel. Loads screens once and keeps them in memory
+(counts without outliers, averaged counts, component levels and the ranking of the LNPs on every
+sort_by), then answers enrichment queries of any sort_by and x_percent as json without reading
+files or writing workbooks. The least recently used screens are unloaded when more than
+--max-screens are loaded.
+
+Requests (json bodies and responses):
+    POST /screens : loads a screen, body {"formulations_sheet", "csv_filepath", "sorted_cells"
+                    and optionally "percentile"}, returns its "screen" id and sort targets
+    GET /screens : lists loaded screens, most recently used last
+    GET /enrichment?screen=<id>&sort_by=<sort_by>&x_percent=<x_percent>[&replicates=1] : returns
+                    the top and bottom LNPs and a row per component level with the number and
+                    fraction of all, top and bottom LNPs, enrichment, depletion and net enrichment
+                    factors (and with replicates=1 the net enrichment factors ranked on each sample)
+    DELETE /screens/<id> : unloads a screen
+
+usage: python3 Enrichment_server.py [--port 8765] [--socket path] [--max-screens 4]
+                                    [--cache-folder folder]
+'''
+import argparse
+import hashlib
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import CSV2Excel
+import Enrichment_cache
+import Enrichment_permutation
+
+DEFAULT_PORT = 8765
+DEFAULT_MAX_SCREENS = 4
+REQUIRED_FIELDS = ["formulations_sheet", "csv_filepath", "sorted_cells"]
+
+def main(argv=None):
+    '''
+    main : serves enrichment queries on localhost (or a unix socket) until interrupted
+    '''
+    parser = argparse.ArgumentParser(description="Keep screens in memory and answer enrichment "\
+                                    "queries as json")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port on localhost "\
+                        "(default = %d)" % DEFAULT_PORT)
+    parser.add_argument("--socket", default=None, help="unix socket path to listen on instead "\
+                        "of a port")
+    parser.add_argument("--max-screens", type=int, default=DEFAULT_MAX_SCREENS, help="number of "\
+                        "screens kept in memory (default = %d)" % DEFAULT_MAX_SCREENS)
+    parser.add_argument("--cache-folder", default=Enrichment_cache.DEFAULT_CACHE_FOLDER,\
+                        help="folder of the cache of reading, outlier removal, merging and "\
+                        "averaging, \"none\" to not cache them (default = %s)" %\
+                        Enrichment_cache.DEFAULT_CACHE_FOLDER)
+    args = parser.parse_args(argv)
+
+    cache_folder = None if args.cache_folder.lower() == "none" else args.cache_folder
+    server = create_server(ScreenCache(args.max_screens, cache_folder), args.port, args.socket)
+    print("Serving enrichment queries on " + (args.socket or "http://127.0.0.1:%d" %\
+            server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+    return 0
+
+class ScreenCache:
+    '''
+    ScreenCache : screens loaded by load_screen, by id, the least recently used are unloaded when
+    more than max_screens are loaded
+    '''
+
+    def __init__(self, max_screens=DEFAULT_MAX_SCREENS, cache_folder=None):
+        '''
+        Saves number of screens kept and folder of the disk cache of create_screen (None to not
+        cache)
+        '''
+        self.max_screens = max(1, max_screens)
+        self.cache = None
+        if cache_folder is not None:
+            self.cache = Enrichment_cache.DiskCache(cache_folder)
+        self.screens = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, formulations_sheet, csv_filepath, sorted_cells, percentile=99.9):
+        '''
+        Returns loaded screen of the given files, loading it if it is not loaded
+        '''
+        screen_id = screen_key(formulations_sheet, csv_filepath, sorted_cells, percentile)
+        with self.lock:
+            if screen_id in self.screens:
+                self.screens.move_to_end(screen_id)
+                return self.screens[screen_id]
+
+        # loaded without the lock so queries of other screens are answered meanwhile
+        loaded = load_screen(formulations_sheet, csv_filepath, sorted_cells, percentile,\
+                            self.cache)
+        loaded["screen"] = screen_id
+        with self.lock:
+            self.screens[screen_id] = loaded
+            self.screens.move_to_end(screen_id)
+            while len(self.screens) > self.max_screens:
+                self.screens.popitem(last=False)
+
+        return loaded
+
+    def get(self, screen_id):
+        '''
+        Returns loaded screen of id, KeyError if it is not loaded
+        '''
+        with self.lock:
+            if screen_id not in self.screens:
+                raise KeyError("Screen " + str(screen_id) + " is not loaded")
+            self.screens.move_to_end(screen_id)
+            return self.screens[screen_id]
+
+    def unload(self, screen_id):
+        '''
+        Unloads screen of id, KeyError if it is not loaded
+        '''
+        with self.lock:
+            if screen_id not in self.screens:
+                raise KeyError("Screen " + str(screen_id) + " is not loaded")
+            del self.screens[screen_id]
+
+    def summaries(self):
+        '''
+        Returns summary of every loaded screen, most recently used last
+        '''
+        with self.lock:
+            return [screen_summary(loaded) for loaded in self.screens.values()]
+
+def screen_key(formulations_sheet, csv_filepath, sorted_cells, percentile):
+    '''
+    Returns id of a screen, the same for the same files, sorted cells and percentile, and a new one
+    once either file is modified (by its modification time and size)
+    '''
+    files = []
+    for filepath in (formulations_sheet, csv_filepath):
+        stat = os.stat(filepath)
+        files.append([os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size])
+    key = json.dumps([files, list(sorted_cells), float(percentile)])
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+def load_screen(formulations_sheet, csv_filepath, sorted_cells, percentile=99.9, cache=None):
+    '''
+    load_screen : reads, removes outliers, merges and averages a screen for every sort_by ("all")
+    and ranks its LNPs on each of them
+        inputs:
+            formulations_sheet : file path to excel spreadsheet with formulation sheet
+            csv_filepath : file path to csv (or screen file) with normalized counts
+            sorted_cells : list of cells that were sorted
+            percentile : percentile of values accepted (default = 99.9)
+            cache : Enrichment_cache.DiskCache of create_screen (default = None)
+        output:
+            loaded : dictionary with the merged counts without outliers ("df_merged"), averaged
+                    counts ("df_averaged"), sample index, component lists and level table of all
+                    LNPs, encoded components ("encoded"), the LNP order on each sort_by ("orders")
+                    and the seconds it took to load ("seconds")
+    '''
+    start = time.time()
+    sort_targets = CSV2Excel.get_sort_targets("all", list(sorted_cells))
+    screen = CSV2Excel.create_screen(formulations_sheet, csv_filepath, list(sorted_cells),\
+                                    sort_targets, percentile, cache=cache)
+
+    df_averaged = screen["df_averaged"]
+    loaded = {"files" : {"formulations_sheet" : formulations_sheet,\
+                        "csv_filepath" : csv_filepath, "sorted_cells" : list(sorted_cells),\
+                        "percentile" : percentile},\
+            "df_merged" : screen["df_merged"],\
+            "df_averaged" : df_averaged,\
+            "sample_index" : screen["sample_index"],\
+            "organized_columns" : screen["organized_columns"],\
+            "dict_components" : screen["dict_components"],\
+            "df_levels_averaged" : screen["df_levels_averaged"],\
+            "encoded" : Enrichment_permutation.encode_components(df_averaged,\
+                                                                screen["dict_components"]),\
+            "orders" : {sort_by : CSV2Excel.rank_norm_counts(sort_by, df_averaged)\
+                        for sort_by in sort_targets}}
+    loaded["seconds"] = time.time() - start
+
+    return loaded
+
+def screen_summary(loaded):
+    '''
+    Returns id, files, number of LNPs, sort targets and load time of a loaded screen
+    '''
+    return dict(loaded["files"], screen=loaded["screen"], lnps=len(loaded["df_averaged"]),\
+                sort_targets=list(loaded["orders"]), seconds=round(loaded["seconds"], 3))
+
+def query_enrichment(loaded, sort_by, x_percent, replicates=False):
+    '''
+    query_enrichment : calculates enrichment of the top and bottom x_percent of a loaded screen
+    sorted by sort_by, from its resident ranking
+        inputs:
+            loaded : dictionary returned by load_screen
+            sort_by : cell type/organ/avg across organs to sort by
+            x_percent : percent to find top and bottom performing LNPs (0-100)
+            replicates : adds net enrichment factors ranked on each sample of sort_by (default =
+                        False)
+        output:
+            result : dictionary with the LNPs of the top ("top") and bottom ("bottom") sets, a row
+                    per component level ("enrichment") as the Net Enrichment Factors sheet and, if
+                    replicates, a row per component level as the Replicate Enrichment sheet
+                    ("replicates")
+    '''
+    if sort_by not in loaded["orders"]:
+        raise KeyError("Unknown sort_by " + str(sort_by) + ", use one of: " +\
+                        ", ".join(loaded["orders"]))
+    if not 0 <= x_percent <= 100:
+        raise ValueError("x_percent must be between 0 and 100")
+
+    df_averaged = loaded["df_averaged"]
+    top, bottom = CSV2Excel.top_and_bottom_percent(df_averaged, sort_by, x_percent,\
+                                                    loaded["orders"][sort_by])
+    dict_subset_levels = CSV2Excel.get_all_enrichments(df_averaged, loaded["dict_components"],\
+                                    {"Top" : top, "Bottom" : bottom}, loaded["encoded"])
+    df_model = CSV2Excel.enrichment_model(loaded["df_levels_averaged"], dict_subset_levels["Top"],\
+                                        dict_subset_levels["Bottom"])
+
+    lnps = df_averaged["LNP"].to_numpy()
+    result = {"screen" : loaded["screen"], "sort_by" : sort_by, "x_percent" : x_percent,\
+            "top" : lnps[top].tolist(), "bottom" : lnps[bottom].tolist(),\
+            "enrichment" : json_records(df_model)}
+    if replicates:
+        samples = CSV2Excel.target_samples(sort_by, loaded["files"]["sorted_cells"],\
+                                        loaded["sample_index"], loaded["organized_columns"])
+        result["replicates"] = json_records(CSV2Excel.replicate_enrichment(loaded["df_merged"],\
+                                            samples, loaded["dict_components"], x_percent))
+
+    return result
+
+def json_records(df_model):
+    '''
+    Returns enrichment table as a list of rows that json can encode (missing values as null)
+    '''
+    return json.loads(CSV2Excel.tidy_table(df_model).to_json(orient="records"))
+
+class EnrichmentRequestHandler(BaseHTTPRequestHandler):
+    '''
+    EnrichmentRequestHandler : answers the requests of the module docstring with json, errors as
+    {"error" : message} with status 400 (bad request) or 404 (screen not loaded)
+    '''
+    screens = None # ScreenCache shared by all requests, set by create_server
+
+    def do_GET(self): # pylint: disable=invalid-name
+        '''
+        Lists loaded screens or answers an enrichment query
+        '''
+        url = urlparse(self.path)
+        if url.path == "/screens":
+            self.respond(200, {"screens" : self.screens.summaries()})
+        elif url.path == "/enrichment":
+            parameters = {name : values[-1] for name, values in parse_qs(url.query).items()}
+            self.answer(lambda: query_enrichment(self.screens.get(parameters.get("screen")),\
+                        parameters.get("sort_by"), float(parameters.get("x_percent", "nan")),\
+                        parameters.get("replicates", "0").lower() in ("1", "true", "yes")))
+        else:
+            self.respond(404, {"error" : "Unknown path " + url.path})
+
+    def do_POST(self): # pylint: disable=invalid-name
+        '''
+        Loads a screen
+        '''
+        if urlparse(self.path).path != "/screens":
+            self.respond(404, {"error" : "Unknown path " + self.path})
+            return
+
+        def load():
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or\
+                                b"{}")
+            missing = [name for name in REQUIRED_FIELDS if name not in body]
+            if missing:
+                raise ValueError("Missing " + ", ".join(missing))
+            sorted_cells = body["sorted_cells"]
+            if isinstance(sorted_cells, str):
+                sorted_cells = [cell.strip() for cell in sorted_cells.split(",")]
+            return screen_summary(self.screens.load(body["formulations_sheet"],\
+                                body["csv_filepath"], sorted_cells, float(body.get("percentile",\
+                                99.9))))
+        self.answer(load)
+
+    def do_DELETE(self): # pylint: disable=invalid-name
+        '''
+        Unloads a screen
+        '''
+        url = urlparse(self.path)
+        if not url.path.startswith("/screens/"):
+            self.respond(404, {"error" : "Unknown path " + url.path})
+            return
+        screen_id = url.path[len("/screens/"):]
+        self.answer(lambda: self.screens.unload(screen_id) or {"unloaded" : screen_id})
+
+    def answer(self, compute, missing_status=404):
+        '''
+        Responds with the result of compute, or its error
+        '''
+        try:
+            result = compute()
+        except KeyError as error:
+            self.respond(missing_status, {"error" : str(error.args[0]) if error.args else\
+                        "missing value"})
+        except (ValueError, TypeError, NameError, OSError) as error:
+            self.respond(400, {"error" : "%s: %s" % (type(error).__name__, error)})
+        except Exception as error: # pylint: disable=broad-except
+            # any other failure of the analysis is answered as json too, the server keeps running
+            self.log_error("%s: %s", type(error).__name__, error)
+            self.respond(500, {"error" : "%s: %s" % (type(error).__name__, error)})
+        else:
+            self.respond(200, result)
+
+    def respond(self, status, payload):
+        '''
+        Sends payload as json with status
+        '''
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        '''
+        Returns client address of log messages (unix sockets have no host)
+        '''
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return "unix"
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''
+    UnixHTTPServer : http server on a unix socket, a thread per request
+    '''
+    daemon_threads = True
+
+def create_server(screens, port=DEFAULT_PORT, socket_path=None):
+    '''
+    create_server : returns http server answering queries of screens on localhost or on a unix
+    socket
+        inputs:
+            screens : ScreenCache of the loaded screens
+            port : port on localhost (default = 8765, 0 for any free port)
+            socket_path : unix socket path to listen on instead of a port (default = None)
+        output:
+            server : server ready to serve_forever
+    '''
+    handler = type("Handler", (EnrichmentRequestHandler,), {"screens" : screens})
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        return UnixHTTPServer(socket_path, handler)
+
+    return ThreadingHTTPServer(("127.0.0.1", port), handler)
+
+if __name__ == "__main__":
+    sys.exit(main())
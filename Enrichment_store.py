@@ -0,0 +1,196 @@
+'''
+Enrichment_store: Binary screen files for CSV2Excel. A normalized-count csv is converted once into a
+screen file holding the counts as a float64 matrix, the barcodes and the sample names, so later runs
+open the counts memory-mapped instead of parsing the csv again. Processes that open the same screen
+file share its pages.
+
+Screen file layout:
+    magic (8 bytes), padding up to HEADER_ALIGNMENT
+    counts : float64 matrix (barcodes x samples), C order
+    barcodes : array of barcodes (fixed width strings or integers)
+    header : json with the shape, dtypes and offsets of the arrays, the column names and the size,
+            modification time and hash of the csv it was made from
+    header length (8 bytes, little endian), magic (8 bytes)
+
+usage: python3 Enrichment_store.py counts.csv [--output counts.screen] [--chunksize 100000]
+'''
+import argparse
+import json
+import os
+import struct
+import sys
+import tempfile
+from os import path
+
+import numpy as np
+import pandas as pd
+
+import Enrichment_cache
+
+STORE_EXTENSION = ".screen"
+STORE_MAGIC = b"ENRSCRN1"
+HEADER_ALIGNMENT = 64 # counts start on a 64 byte boundary
+DEFAULT_CHUNKSIZE = 100000
+
+def main(argv=None):
+    '''
+    main : converts a normalized-count csv into a screen file and prints its path
+    '''
+    parser = argparse.ArgumentParser(description="Convert a normalized-count csv into a binary "\
+                                    "screen file")
+    parser.add_argument("csv_filepath", help="csv file with normalized counts")
+    parser.add_argument("--output", default=None, help="screen file to save (default = csv file "\
+                        "path with " + STORE_EXTENSION + " extension)")
+    parser.add_argument("--chunksize", type=int, default=DEFAULT_CHUNKSIZE, help="number of rows "\
+                        "read at a time (default = %d)" % DEFAULT_CHUNKSIZE)
+    args = parser.parse_args(argv)
+
+    print(convert_counts(args.csv_filepath, args.output, args.chunksize))
+
+    return 0
+
+def is_store(filepath):
+    '''
+    Returns True if file path is a screen file
+    '''
+    if not path.isfile(filepath):
+        return False
+    with open(filepath, "rb") as store_file:
+        return store_file.read(len(STORE_MAGIC)) == STORE_MAGIC
+
+def store_path(csv_filepath):
+    '''
+    Returns default screen file path of a csv file (same path with the screen file extension)
+    '''
+    return path.splitext(csv_filepath)[0] + STORE_EXTENSION
+
+def convert_counts(csv_filepath, destination=None, chunksize=DEFAULT_CHUNKSIZE):
+    '''
+    convert_counts : converts a normalized-count csv into a screen file, reading it in chunks of
+    rows written straight to the file, an up to date screen file of the csv is reused
+        inputs:
+            csv_filepath : file path to csv file
+            destination : screen file path (default = None, csv file path with screen extension)
+            chunksize : number of rows read at a time (default = 100000)
+        output:
+            destination : screen file path
+    '''
+    if destination is None:
+        destination = store_path(csv_filepath)
+
+    source = source_stat(csv_filepath)
+    if is_store(destination):
+        stored = read_header(destination)["source"]
+        if (stored["size"], stored["mtime_ns"]) == (source["size"], source["mtime_ns"]):
+            return destination
+
+    columns = pd.read_csv(csv_filepath, sep=',', header=0, nrows=0).columns.tolist()
+    dtypes = {column : np.float64 for column in columns[1:]}
+
+    # written to a temporary file first so readers never open half written screen files
+    file_descriptor, temporary = tempfile.mkstemp(dir=path.dirname(path.abspath(destination)),\
+                                                suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "wb") as store_file:
+            store_file.write(STORE_MAGIC.ljust(HEADER_ALIGNMENT, b"\0"))
+
+            barcodes = []
+            n_rows = 0
+            for chunk in pd.read_csv(csv_filepath, sep=',', header=0, dtype=dtypes,\
+                                    chunksize=chunksize):
+                store_file.write(np.ascontiguousarray(chunk.iloc[:, 1:].to_numpy(\
+                                dtype=np.float64)).tobytes())
+                barcodes.append(chunk.iloc[:, 0].to_numpy())
+                n_rows += len(chunk)
+
+            barcodes = barcode_array(np.concatenate(barcodes) if barcodes else np.array([]))
+            barcodes_offset = store_file.tell()
+            store_file.write(barcodes.tobytes())
+
+            header = {"rows" : n_rows, "columns" : columns,\
+                    "counts_dtype" : np.dtype(np.float64).str, "counts_offset" : HEADER_ALIGNMENT,\
+                    "barcodes_dtype" : barcodes.dtype.str, "barcodes_offset" : barcodes_offset,\
+                    "source" : dict(source, sha256=Enrichment_cache.file_hash(csv_filepath))}
+            encoded = json.dumps(header).encode()
+            store_file.write(encoded)
+            store_file.write(struct.pack("<Q", len(encoded)) + STORE_MAGIC)
+        os.replace(temporary, destination)
+    except BaseException:
+        if path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+    return destination
+
+def barcode_array(barcodes):
+    '''
+    Returns barcodes as an array that can be saved as raw bytes (integers or fixed width strings)
+    '''
+    if barcodes.dtype.kind in "iu":
+        return barcodes.astype(np.int64)
+    return barcodes.astype(str)
+
+def source_stat(csv_filepath):
+    '''
+    Returns size and modification time of a csv file
+    '''
+    stat = os.stat(csv_filepath)
+    return {"path" : path.abspath(csv_filepath), "size" : stat.st_size,\
+            "mtime_ns" : stat.st_mtime_ns}
+
+def read_header(filepath):
+    '''
+    read_header : reads the header at the end of a screen file
+        inputs:
+            filepath : screen file path
+        output:
+            header : dictionary with the shape, dtypes and offsets of the arrays, the column names
+                    and the csv the screen file was made from ("source")
+    '''
+    with open(filepath, "rb") as store_file:
+        store_file.seek(-16, os.SEEK_END)
+        length, magic = struct.unpack("<Q8s", store_file.read(16))
+        if magic != STORE_MAGIC:
+            raise ValueError(filepath + " is not a complete screen file")
+        store_file.seek(-16 - length, os.SEEK_END)
+        return json.loads(store_file.read(length))
+
+def source_hash(filepath):
+    '''
+    Returns sha256 hash of the csv a screen file was made from
+    '''
+    return read_header(filepath)["source"]["sha256"]
+
+def open_counts(filepath):
+    '''
+    open_counts : opens the normalized counts of a screen file, the counts are memory-mapped (read
+    only) and not copied
+        inputs:
+            filepath : screen file path
+        output:
+            df_norm_counts : data frame with the barcode column and the counts as on the csv
+    '''
+    header = read_header(filepath)
+    columns = header["columns"]
+    shape = (header["rows"], len(columns) - 1)
+
+    counts = np.empty(shape)
+    if header["rows"] and shape[1]:
+        counts = np.memmap(filepath, dtype=header["counts_dtype"], mode="r",\
+                            offset=header["counts_offset"], shape=shape)
+    barcodes = np.empty(0, dtype=header["barcodes_dtype"])
+    if header["rows"]:
+        barcodes = np.memmap(filepath, dtype=header["barcodes_dtype"], mode="r",\
+                            offset=header["barcodes_offset"], shape=(header["rows"],))
+    if barcodes.dtype.kind == "U":
+        barcodes = barcodes.astype(object)
+    else:
+        barcodes = np.asarray(barcodes)
+
+    df_norm_counts = pd.DataFrame(counts, columns=columns[1:], copy=False)
+    df_norm_counts.insert(loc=0, column=columns[0], value=barcodes)
+
+    return df_norm_counts
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,518 @@
+'''
+test_CSV2Excel: Tests of CSV2Excel
+
+usage: python3 -m pytest test_CSV2Excel.py
+'''
+import numpy as np
+import pandas as pd
+import pytest
+
+import CSV2Excel
+import Enrichment_benchmark
+import Enrichment_permutation
+import Enrichment_store
+
+def remove_outliers_by_column(df_norm_no_outliers, rows, column, n_at_percentile):
+    '''
+    remove_outliers_by_column : removes outliers of a column one value at a time and renormalizes
+    it, as CSV2Excel did before removing them from the whole matrix at once
+    '''
+    count = 0 # saves addition of all outliers removed in a column
+
+    for row in rows:
+        value = df_norm_no_outliers.at[row, column]
+        if value >= n_at_percentile:
+            count += value
+            df_norm_no_outliers.at[row, column] = 0
+
+    if count != 0:
+        for row in rows:
+            value = df_norm_no_outliers.at[row, column]
+            if value != 0:
+                df_norm_no_outliers.at[row, column] = value / (100 - count) * 100
+
+    return df_norm_no_outliers
+
+def random_counts(rng, n_rows, n_columns):
+    '''
+    Returns random normalized counts with repeated values (ties at the percentile), zeros and a
+    column of only zeros
+    '''
+    counts = rng.gamma(0.5, 2.0, size=(n_rows, n_columns))
+    counts[rng.random(counts.shape) < 0.3] = 0
+    # few distinct values so the value at the percentile is repeated
+    repeated = rng.random(counts.shape) < 0.2
+    counts[repeated] = rng.choice([0.5, 1.25, 3.0], size=np.count_nonzero(repeated))
+    counts[:, rng.integers(n_columns)] = 0
+    return counts
+
+def random_averaged(rng, n_lnps, cells=("LE", "SB")):
+    '''
+    Returns random averaged counts of n_lnps LNPs with random components, and two naked barcodes
+    (without components and with the lowest counts) last
+    '''
+    df_averaged = pd.DataFrame({"LNP" : ["LNP" + str(i + 1) for i in range(n_lnps)] +\
+                                ["NAKED1", "NAKED2"],\
+                                "BC" : ["BC%05d" % i for i in range(n_lnps + 2)]})
+    for component, levels in [("Lipomer %", [35.0, 50.0]), ("Cholesterol %", [38.5, 46.5]),\
+                            ("PEG %", [1.5, 2.5, 5.0]), ("Phospholipid %", [10.0, 16.0]),\
+                            ("Lipomer", ["A1", "A2", "A3"]), ("Cholesterol", ["C1", "C2"]),\
+                            ("PEG", ["P1", "P2"]), ("Phospholipid", ["DOPE", "DSPC"])]:
+        df_averaged[component] = list(rng.choice(levels, n_lnps)) + [None, None]
+    for cell in cells:
+        df_averaged[cell] = np.append(rng.gamma(0.5, 2.0, n_lnps) + 0.1, [0.0, 0.0])
+    return df_averaged
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("percentile", [50, 90, 99, 99.9])
+def test_remove_outliers_matches_column_loop(seed, percentile):
+    '''
+    remove_outliers and renormalize give the same values as the loop over every column
+    '''
+    rng = np.random.default_rng(seed)
+    counts = random_counts(rng, 200, 7)
+    n_at_percentile = np.percentile(counts, percentile)
+
+    df_expected = pd.DataFrame(counts.copy())
+    rows = df_expected.index.tolist()
+    for column in df_expected.columns:
+        df_expected = remove_outliers_by_column(df_expected, rows, column, n_at_percentile)
+
+    result = CSV2Excel.remove_outliers(counts.copy(), n_at_percentile)
+
+    np.testing.assert_array_equal(result, df_expected.to_numpy())
+
+def test_remove_outliers_at_repeated_percentile_value():
+    '''
+    every value equal to the value at the percentile is an outlier
+    '''
+    counts = np.array([[1.0, 3.0], [3.0, 0.0], [3.0, 2.0], [0.0, 3.0]])
+
+    result = CSV2Excel.remove_outliers(counts.copy(), 3.0)
+
+    np.testing.assert_array_equal(result == 0, (counts >= 3.0) | (counts == 0))
+    np.testing.assert_array_equal(result[:, 0], [1.0/(100 - 6.0)*100, 0, 0, 0])
+
+def test_remove_outliers_without_rows_or_outliers():
+    '''
+    empty matrices and matrices without outliers are returned unchanged
+    '''
+    assert CSV2Excel.remove_outliers(np.zeros((0, 3)), 1.0).shape == (0, 3)
+
+    counts = np.array([[1.0, 0.0], [2.0, 0.0]])
+    np.testing.assert_array_equal(CSV2Excel.remove_outliers(counts.copy(), 5.0), counts)
+
+@pytest.mark.parametrize("chunked", [False, True])
+@pytest.mark.parametrize("percentile", [0, 50, 99.9, 100])
+def test_get_n_percentile_matches_np_percentile(chunked, percentile):
+    '''
+    value at the percentile is the same read in blocks (chunked) as with np.percentile
+    '''
+    counts = random_counts(np.random.default_rng(0), 5000, 6)
+
+    result = CSV2Excel.get_n_percentile(counts, percentile, block_size=1000, chunked=chunked)
+
+    assert result == np.percentile(counts, percentile)
+
+def test_remove_outliers_sweep_matches_remove_outliers():
+    '''
+    every percentile of the sweep gives the same threshold and counts as a run at that percentile
+    '''
+    counts = random_counts(np.random.default_rng(1), 300, 5)
+    percentiles = [99.9, 90, 99, 90]
+
+    results = list(CSV2Excel.remove_outliers_sweep(counts, percentiles))
+
+    assert [result[0] for result in results] == [99.9, 90, 99]
+    for percentile, n_at_percentile, n_outliers, removed, counts_no_outliers in results:
+        assert n_at_percentile == np.percentile(counts, percentile)
+        assert n_outliers == np.count_nonzero(counts >= n_at_percentile)
+        np.testing.assert_array_equal(removed, np.where(counts >= n_at_percentile, counts,\
+                                                        0).sum(axis=0))
+        np.testing.assert_array_equal(counts_no_outliers,\
+                                    CSV2Excel.remove_outliers(counts.copy(), n_at_percentile))
+
+def test_get_n_percentile_of_float32_counts():
+    '''
+    value at the percentile of float32 counts is interpolated in float64, as the sweep does
+    '''
+    counts = random_counts(np.random.default_rng(2), 3000, 6).astype(np.float32)
+
+    for percentile in [90, 97.3, 99.9]:
+        result = CSV2Excel.get_n_percentile(counts, percentile)
+        assert result == np.percentile(counts.astype(np.float64), percentile)
+        assert result == next(CSV2Excel.remove_outliers_sweep(counts, [percentile]))[1]
+
+def test_compact_counts_stores_samples_as_float32():
+    '''
+    sample columns are float32 within float32 precision of the counts, barcodes are left as they are
+    '''
+    counts = random_counts(np.random.default_rng(3), 100, 4)*np.pi
+    df_norm_counts = pd.DataFrame(counts, columns=["AD LE1", "AD LE2", "AD SB1", "AD SB2"])
+    df_norm_counts.insert(loc=0, column="BC", value=[str(row) for row in range(100)])
+
+    df_compact = CSV2Excel.compact_counts(df_norm_counts)
+
+    assert df_compact["BC"].equals(df_norm_counts["BC"])
+    assert (df_compact.dtypes.iloc[1:] == np.float32).all()
+    np.testing.assert_allclose(df_compact.iloc[:, 1:].to_numpy(dtype=np.float64), counts,\
+                                rtol=6e-8, atol=0)
+    assert CSV2Excel.compact_counts(df_norm_counts, compact=False) is df_norm_counts
+
+@pytest.mark.parametrize("column, sample", [("AD SB102", ("S", "B", "102")),\
+                                            ("AD LE1_S1", ("L", "E", "1")),\
+                                            ("AD LE102.1", ("L", "E", "102")),\
+                                            ("AD ALE1", ("A", "LE", "1"))])
+def test_parse_sample_name(column, sample):
+    '''
+    organ, cell type and replicate are read before sequencing and repeated column suffixes
+    '''
+    assert CSV2Excel.parse_sample_name(column) == sample
+
+def test_organize_cell_type_with_suffixed_names():
+    '''
+    samples named with a sequencing sample number are grouped by their cell type
+    '''
+    sample_columns = ["AD LE1_S1", "AD SB1_S3", "AD LE2_S2", "AD LE2.1"]
+
+    result = CSV2Excel.organize_cell_type(sample_columns, ["LE", "SB"])
+
+    assert result == ["AD LE1_S1", "AD LE2_S2", "AD LE2.1", "AD SB1_S3"]
+
+def test_organize_cell_type_names_columns_left_out():
+    '''
+    columns naming a sorted cell that are not parsed as one are reported, and sorted cells without
+    samples are an error instead of an empty group
+    '''
+    with pytest.warns(UserWarning, match="ADSB102"):
+        result = CSV2Excel.organize_cell_type(["AD LE1", "AD SB1", "ADSB102"], ["LE", "SB"])
+    assert result == ["AD LE1", "AD SB1"]
+
+    with pytest.raises(ValueError, match=r"SB \(sample columns not read: ADSB102\)"):
+        CSV2Excel.organize_cell_type(["AD LE1", "ADSB102"], ["LE", "SB"])
+
+@pytest.mark.parametrize("seed", range(3))
+def test_x_percent_sweep_matches_net_enrichment(seed):
+    '''
+    the sweep row of an x_percent has the factors of the Net Enrichment Factors sheet of that
+    x_percent, rounded the same way
+    '''
+    df_averaged = random_averaged(np.random.default_rng(seed), 997)
+    dict_components, df_levels_averaged = CSV2Excel.enrichment_all_LNPs(df_averaged)
+    order = CSV2Excel.rank_norm_counts("LE", df_averaged)
+    x_percents = [1, 5, 10, 33]
+
+    d_df_sweep = CSV2Excel.sweep_x_percent(df_averaged, "LE", dict_components, x_percents, order)
+
+    for row, x_percent in enumerate(x_percents):
+        top, bottom = CSV2Excel.top_and_bottom_percent(df_averaged, "LE", x_percent, order)
+        levels = CSV2Excel.get_all_enrichments(df_averaged, dict_components, {"Top" : top,\
+                                                "Bottom" : bottom})
+        df_model = CSV2Excel.enrichment_model(df_levels_averaged, levels["Top"], levels["Bottom"])
+        for component, component_list in dict_components.items():
+            for level in component_list:
+                for factor, column in [("Top", "Enrichment Factor Top"),\
+                                    ("Bottom", "Depletion Factor Bottom"),\
+                                    ("Net", "Net Enrichment Factor")]:
+                    assert d_df_sweep[component][str(level) + " " + factor][row] ==\
+                            df_model.loc[(component, level), column]
+
+def test_quantile_sketch_of_empty_and_single_row_blocks():
+    '''
+    empty sketches have no bounds, and sketches merged from empty and one-row blocks give the
+    bounds of their values
+    '''
+    sketch = CSV2Excel.QuantileSketch()
+    assert np.isnan(sketch.value_bounds(0)).all()
+    assert np.isnan(sketch.percentile(50))
+
+    for block in [np.zeros((0, 3)), np.array([[1.0, 0.0, 5.0]])]:
+        block_sketch = CSV2Excel.QuantileSketch()
+        block_sketch.update(block)
+        sketch.merge(block_sketch)
+
+    assert sketch.value_bounds(0) == (0.0, 0.0)
+    low, high = sketch.value_bounds(2)
+    assert low <= 5.0 <= high
+    assert sketch.value_bounds(10) == (low, high)
+    assert CSV2Excel.get_n_percentile(np.array([[1.0, 0.0, 5.0]]), 50, block_size=1,\
+                                        chunked=True) == 1.0
+
+def test_group_means_of_float32_values():
+    '''
+    groups are averaged adding their columns in order and leaving missing values out, float32
+    values give the means of the same values as float64
+    '''
+    values = random_counts(np.random.default_rng(4), 50, 6).astype(np.float32)
+    values[3, 1] = np.nan
+    groups = [[0, 1, 2], [5], [], [4, 3]]
+
+    result = CSV2Excel.group_means(values, groups)
+
+    expected = values.astype(np.float64)
+    np.testing.assert_array_equal(result[:, 0], np.nanmean(expected[:, [0, 1, 2]], axis=1))
+    np.testing.assert_array_equal(result[:, 1], expected[:, 5])
+    assert np.isnan(result[:, 2]).all()
+    np.testing.assert_array_equal(result[:, 3], (expected[:, 4] + expected[:, 3])/2)
+    np.testing.assert_array_equal(result, CSV2Excel.group_means(expected, groups))
+
+def test_get_all_enrichments_matches_counting_each_component():
+    '''
+    one counting pass gives the number and fraction of every level of every component of each
+    subset, as counting the levels of each component of each subset one at a time
+    '''
+    df_averaged = random_averaged(np.random.default_rng(5), 300)
+    dict_components, _ = CSV2Excel.enrichment_all_LNPs(df_averaged)
+    subsets = {"Averaged" : None, "Top" : np.arange(30), "Bottom" : np.arange(270, 302)}
+
+    result = CSV2Excel.get_all_enrichments(df_averaged, dict_components, subsets)
+
+    for name, positions in subsets.items():
+        df_subset = df_averaged if positions is None else df_averaged.iloc[positions]
+        for component, component_list in dict_components.items():
+            counts = df_subset[component].value_counts()
+            expected = [int(counts.get(level, 0)) for level in component_list]
+            df_levels = result[name].loc[component]
+            assert df_levels["Total #"].tolist() == expected + [sum(expected)]
+            np.testing.assert_allclose(df_levels["% of Total"].to_numpy()[:-1],\
+                                        np.array(expected)/sum(expected), atol=1e-9)
+
+def test_run_with_several_sort_targets(tmp_path):
+    '''
+    a run sorting by several targets writes the top/bottom, net enrichment and winning LNPs sheets
+    of each on one workbook, and reports every stage it expected
+    '''
+    formulations_sheet, csv_filepath, sorted_cells = Enrichment_benchmark.generate_screen(\
+                                                        str(tmp_path / "screen"), 200, 12)
+    records = []
+
+    CSV2Excel.run_enrichment_analysis(str(tmp_path), formulations_sheet, csv_filepath,\
+                                        sorted_cells[:2], 10, ["LE", "L"], cache_folder=None,\
+                                        output_backend="csv", hooks=[records.append],\
+                                        permutations=0)
+
+    folder = tmp_path / "Enrichment Analysis LE-L"
+    stages = {record["stage"] for record in records}
+    written = {path.name for path in folder.iterdir()}
+    for target in ["LE", "L"]:
+        assert {"Form Enrichment " + target + " Top.csv",\
+                "Form Enrichment " + target + " Top_lnps.csv",\
+                "Form Enrichment " + target + " Bottom.csv",\
+                "Form Enrichment " + target + " Bottom_lnps.csv",\
+                "Net Enrichment Factors " + target + ".csv",\
+                "Winning LNPs " + target + ".csv"} <= written
+
+        df_sorted = pd.read_csv(folder / ("Form Enrichment " + target + " Top_lnps.csv"))
+        assert df_sorted[target].is_monotonic_decreasing
+        assert {"top/bottom " + target, "net enrichment " + target,\
+                "winning LNPs " + target} <= stages
+
+    df_averaged = pd.read_csv(folder / "Averaged Norm Counts.csv")
+    assert sorted(df_sorted["LNP"]) == sorted(df_averaged["LNP"])
+    assert len(records) == records[-1]["expected_stages"]
+
+@pytest.mark.parametrize("x_percent", [1, 10, 50, 100])
+def test_top_and_bottom_percent_selection_matches_sorting(x_percent):
+    '''
+    top and bottom LNPs selected without sorting are the ones of the full ranking, in the same
+    order, with tied counts kept in order and missing counts last
+    '''
+    df_averaged = random_averaged(np.random.default_rng(6), 200)
+    df_averaged["LE"] = df_averaged["LE"].round(1)
+    df_averaged.loc[[3, 50, 120], "LE"] = np.nan
+    order = CSV2Excel.rank_norm_counts("LE", df_averaged)
+
+    top, bottom = CSV2Excel.top_and_bottom_percent(df_averaged, "LE", x_percent)
+    top_sorted, bottom_sorted = CSV2Excel.top_and_bottom_percent(df_averaged, "LE", x_percent,\
+                                                                order=order)
+
+    np.testing.assert_array_equal(top, top_sorted)
+    np.testing.assert_array_equal(bottom, bottom_sorted)
+    np.testing.assert_array_equal(bottom[-3:], [3, 50, 120])
+
+def test_net_enrichment_p_values_and_fdr():
+    '''
+    every level gets a p-value and FDR in (0, 1] (none on TOTAL rows), the same for a seed whatever
+    the number of workers, and a level planted on the top LNPs gets the smallest p-value
+    '''
+    df_averaged = random_averaged(np.random.default_rng(7), 300)
+    df_averaged.loc[df_averaged["Lipomer"] == "A1", "LE"] += 5
+    dict_components, df_levels_averaged = CSV2Excel.enrichment_all_LNPs(df_averaged)
+    top, bottom = CSV2Excel.top_and_bottom_percent(df_averaged, "LE", 10)
+    levels = CSV2Excel.get_all_enrichments(df_averaged, dict_components, {"Top" : top,\
+                                            "Bottom" : bottom})
+
+    df_significance = Enrichment_permutation.permutation_test(df_averaged, dict_components, top,\
+                                                                bottom, 200, workers=1, seed=3)
+    df_model = CSV2Excel.enrichment_model(df_levels_averaged, levels["Top"], levels["Bottom"],\
+                                            df_significance)
+
+    pd.testing.assert_frame_equal(df_significance, Enrichment_permutation.permutation_test(\
+                                    df_averaged, dict_components, top, bottom, 200, workers=2,\
+                                    seed=3))
+    is_total = df_model.index.get_level_values(1) == "TOTAL"
+    assert df_model.loc[is_total, ["P-value", "FDR"]].isna().all().all()
+    df_levels = df_model.loc[~is_total]
+    assert df_levels["P-value"].between(1/201, 1).all()
+    assert (df_levels["FDR"] >= df_levels["P-value"]).all()
+    assert (df_levels["FDR"] <= 1).all()
+    assert df_levels.loc[("Lipomer", "A1"), "P-value"] == 1/201
+
+@pytest.mark.parametrize("repeated", [False, True])
+def test_merge_by_barcode_index_matches_pandas_merge(repeated):
+    '''
+    formulations and counts joined on the barcode index are the inner merge of pandas around
+    barcodes, with repeated, missing and shuffled barcodes, and the unmatched barcodes are counted
+    '''
+    rng = np.random.default_rng(8)
+    df_formulations = random_averaged(rng, 100, cells=())
+    if repeated:
+        df_formulations.loc[15, "BC"] = df_formulations.loc[14, "BC"]
+    barcodes = np.append(rng.permutation(df_formulations["BC"].to_numpy()[10:]),\
+                        ["BC00020", "BC00021", "BC99998", "BC99999"])
+    samples = ["AD LE" + str(i) for i in range(1, 4)]
+    df_norm_counts = pd.DataFrame(random_counts(rng, len(barcodes), len(samples)),\
+                                columns=samples)
+    df_norm_counts.insert(0, "BC", barcodes)
+
+    join = CSV2Excel.join_barcodes(CSV2Excel.create_barcode_index(df_formulations),\
+                                    df_norm_counts["BC"])
+    df_merged = CSV2Excel.merge_formulations_and_norm_counts(df_formulations, df_norm_counts,\
+                                                            samples[::-1], join)
+
+    expected = df_formulations.merge(df_norm_counts, on="BC")
+    pd.testing.assert_frame_equal(df_merged, expected[expected.columns[:10].tolist() +\
+                                                        samples[::-1]])
+    assert join["unmatched"] == {"counts" : 2, "formulations" : 10}
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+def test_average_normalized_counts_matches_pandas_means(dtype):
+    '''
+    averages by cell type are the pandas means of their replicates (missing counts left out),
+    organs average their cell types and AVG all cell types
+    '''
+    rng = np.random.default_rng(9)
+    sorted_cells = ["LE", "LK", "SB"]
+    samples = ["AD SB1", "AD LE1", "AD LK1", "AD LE2", "AD SB2", "AD LE3", "AD LK2"]
+    df_merged = random_averaged(rng, 50, cells=())
+    df_merged[samples] = random_counts(rng, 52, len(samples)).astype(dtype)
+    df_merged.loc[7, "AD LE2"] = np.nan
+    organized_columns = CSV2Excel.organize_cell_type(samples, sorted_cells)
+
+    df_averaged = CSV2Excel.average_normalized_counts(df_merged, organized_columns, sorted_cells,\
+                                                    ["LE", "L", "S", "AVG"])
+
+    df_expected = df_merged[df_merged.columns[:10]].copy()
+    for cell_type in sorted_cells:
+        df_expected[cell_type] = df_merged.filter(like=cell_type).astype(float).mean(axis=1)
+    df_expected["L"] = df_expected[["LE", "LK"]].mean(axis=1)
+    df_expected["S"] = df_expected["SB"]
+    df_expected["AVG"] = df_expected[sorted_cells].mean(axis=1)
+    pd.testing.assert_frame_equal(df_averaged, df_expected)
+
+@pytest.mark.parametrize("chunksize", [1, 7, 1000])
+def test_create_df_norm_counts_in_chunks(tmp_path, chunksize):
+    '''
+    counts read in chunks into one array are the counts read at once, with missing values
+    '''
+    rng = np.random.default_rng(10)
+    df_counts = pd.DataFrame(random_counts(rng, 40, 5), columns=["AD LE" + str(i) for i in\
+                                                                range(1, 6)])
+    df_counts.iloc[3, 2] = np.nan
+    df_counts.insert(0, "Barcode", ["BC%05d" % i for i in range(40)])
+    csv_filepath = str(tmp_path / "normalized_counts.csv")
+    df_counts.to_csv(csv_filepath, index=False)
+
+    df_norm_counts = CSV2Excel.create_df_norm_counts(csv_filepath, chunksize)
+
+    pd.testing.assert_frame_equal(df_norm_counts, CSV2Excel.create_df_norm_counts(csv_filepath))
+    assert df_norm_counts.columns[0] == "BC"
+
+@pytest.mark.parametrize("barcodes", [["BC%05d" % i for i in range(40)], list(range(40))])
+def test_create_df_norm_counts_of_screen_file(tmp_path, barcodes):
+    '''
+    counts opened from a screen file are the counts of its csv, and the screen file is made again
+    once the csv changes
+    '''
+    rng = np.random.default_rng(11)
+    df_counts = pd.DataFrame(random_counts(rng, 40, 5), columns=["AD LE" + str(i) for i in\
+                                                                range(1, 6)])
+    df_counts.insert(0, "Barcode", barcodes)
+    csv_filepath = str(tmp_path / "normalized_counts.csv")
+    df_counts.to_csv(csv_filepath, index=False)
+
+    store_filepath = Enrichment_store.convert_counts(csv_filepath, chunksize=7)
+
+    assert store_filepath == str(tmp_path / "normalized_counts.screen")
+    pd.testing.assert_frame_equal(CSV2Excel.create_df_norm_counts(store_filepath),\
+                                CSV2Excel.create_df_norm_counts(csv_filepath))
+
+    df_counts.iloc[:20].to_csv(csv_filepath, index=False)
+    Enrichment_store.convert_counts(csv_filepath, chunksize=7)
+
+    assert len(CSV2Excel.create_df_norm_counts(store_filepath)) == 20
+
+def test_select_rank_sets_matches_select_ranks():
+    '''
+    every row of the rank sets holds the positions select_ranks finds on that row, with ties and
+    missing keys
+    '''
+    keys = -np.round(random_counts(np.random.default_rng(12), 5, 60), 1)
+    keys[1, [4, 9]] = np.inf
+
+    for n_ranks in [0, 1, 13, 60, 70]:
+        rank_sets = CSV2Excel.select_rank_sets(keys, n_ranks)
+        for row, row_keys in enumerate(keys):
+            np.testing.assert_array_equal(rank_sets[row],\
+                                        np.sort(CSV2Excel.select_ranks(row_keys, n_ranks)))
+
+def test_replicate_enrichment_matches_ranking_each_sample():
+    '''
+    net enrichment factors of each sample are the factors of the Net Enrichment Factors sheet
+    when LNPs are ranked on that sample, whatever the number of samples selected at once
+    '''
+    samples = ["AD LE1", "AD LE2", "AD LE3", "AD SB1", "AD SB2"]
+    df_merged = random_averaged(np.random.default_rng(13), 200, cells=samples)
+    df_merged["AD LE2"] = df_merged["AD LE2"].round(1)
+    df_merged.loc[[8, 30], "AD SB1"] = np.nan
+    dict_components, df_levels_averaged = CSV2Excel.enrichment_all_LNPs(df_merged)
+
+    df_replicates = CSV2Excel.replicate_enrichment(df_merged, samples, dict_components, 10,\
+                                                    block_size=2)
+
+    for sample in samples:
+        top, bottom = CSV2Excel.top_and_bottom_percent(df_merged, sample, 10)
+        levels = CSV2Excel.get_all_enrichments(df_merged, dict_components, {"Top" : top,\
+                                                "Bottom" : bottom})
+        df_model = CSV2Excel.enrichment_model(df_levels_averaged, levels["Top"], levels["Bottom"])
+        np.testing.assert_allclose(df_replicates[sample].to_numpy(),\
+                                df_model.loc[df_replicates.index, "Net Enrichment Factor"],\
+                                atol=1e-8)
+    np.testing.assert_allclose(df_replicates["Mean"], df_replicates[samples].mean(axis=1),\
+                                atol=1e-8)
+
+def test_enrichment_model_tables_keep_their_types(tmp_path):
+    '''
+    enrichment tables are counts and fractions by (Component, Level), laid out with the levels as
+    text, and read back from a csv as the same table
+    '''
+    df_averaged = random_averaged(np.random.default_rng(14), 100)
+    dict_components, df_levels_averaged = CSV2Excel.enrichment_all_LNPs(df_averaged)
+    top, bottom = CSV2Excel.top_and_bottom_percent(df_averaged, "LE", 10)
+    levels = CSV2Excel.get_all_enrichments(df_averaged, dict_components, {"Top" : top,\
+                                            "Bottom" : bottom})
+
+    df_model = CSV2Excel.enrichment_model(df_levels_averaged, levels["Top"], levels["Bottom"])
+    df_table = CSV2Excel.tidy_table(df_model)
+
+    assert df_model.index.names == ["Component", "Level"]
+    for column in ["Total #", "Top Total #", "Bottom Total #"]:
+        assert pd.api.types.is_integer_dtype(df_model[column])
+    assert (df_model.drop(columns=["Total #", "Top Total #", "Bottom Total #"]).dtypes ==\
+            np.float64).all()
+    assert df_table.columns[:2].tolist() == ["Component", "Level"]
+    assert {"35.0", "A1", "TOTAL"} <= set(df_table["Level"])
+
+    df_table.to_csv(tmp_path / "table.csv", index=False)
+    pd.testing.assert_frame_equal(CSV2Excel.numeric_table(pd.read_csv(tmp_path / "table.csv")),\
+                                df_table)
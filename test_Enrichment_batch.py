@@ -0,0 +1,24 @@
+'''
+test_Enrichment_batch: Tests of Enrichment_batch
+
+usage: python3 -m pytest test_Enrichment_batch.py
+'''
+import Enrichment_batch
+
+def test_read_manifest_reports_short_rows(tmp_path):
+    '''
+    rows missing required columns are failed jobs, the other rows are read
+    '''
+    manifest = tmp_path / "manifest.csv"
+    manifest.write_text("formulations_sheet,csv_filepath,sorted_cells,x_percent,sort_by\n"\
+                        "formulations.xlsx,counts.csv\n"\
+                        "formulations.xlsx,counts.csv,\"LE,SB\",5,all\n")
+
+    jobs = Enrichment_batch.read_manifest(str(manifest), str(tmp_path))
+
+    assert jobs[0] == {"row" : 1, "error" : "invalid manifest row: missing sorted_cells, "\
+                                            "x_percent, sort_by"}
+    assert "error" not in jobs[1]
+    assert jobs[1]["sorted_cells"] == ["LE", "SB"]
+    assert jobs[1]["x_percent"] == 5.0
+    assert jobs[1]["sort_by"] == "all"
@@ -0,0 +1,64 @@
+'''
+test_Enrichment_cache: Tests of Enrichment_cache
+
+usage: python3 -m pytest test_Enrichment_cache.py
+'''
+import os
+
+import numpy as np
+import pandas as pd
+
+import Enrichment_cache
+
+def test_put_skips_entries_over_entry_limit(tmp_path):
+    '''
+    results estimated over the entry size limit are not pickled, smaller ones are kept
+    '''
+    cache = Enrichment_cache.DiskCache(str(tmp_path), max_bytes=10**6, max_entry_bytes=10**5)
+    large = pd.DataFrame(np.zeros((20000, 2)))
+    small = pd.DataFrame(np.zeros((100, 2)))
+
+    assert not cache.put("large", large)
+    assert cache.put("small", small)
+
+    assert os.listdir(str(tmp_path)) == ["small.pkl"]
+    pd.testing.assert_frame_equal(cache.get("small"), small)
+
+def test_estimated_size_of_stage_results():
+    '''
+    sizes of tuples and dictionaries add up the sizes of their dataframes and arrays
+    '''
+    df_table = pd.DataFrame({"a" : np.zeros(1000)})
+    array = np.zeros(500)
+
+    assert Enrichment_cache.estimated_size((df_table, {"codes" : array})) >=\
+            df_table["a"].nbytes + array.nbytes
+
+def test_stage_key_changes_with_pandas_version(monkeypatch):
+    '''
+    stages cached by another pandas or numpy version are not loaded
+    '''
+    graph = Enrichment_cache.StageGraph()
+    graph.add("stage", lambda: 1, ["parameter"])
+    key = graph.key("stage")
+
+    monkeypatch.setattr(pd, "__version__", "0.0.0")
+    graph.keys = {}
+    assert graph.key("stage") != key
+
+def test_get_entry_evicted_while_loading(tmp_path, monkeypatch):
+    '''
+    an entry removed by another process after it was loaded is still returned
+    '''
+    cache = Enrichment_cache.DiskCache(str(tmp_path))
+    cache.put("entry", [1, 2])
+    load = Enrichment_cache.pickle.load
+
+    def load_and_evict(entry_file):
+        value = load(entry_file)
+        os.remove(cache.entry_path("entry"))
+        return value
+    monkeypatch.setattr(Enrichment_cache.pickle, "load", load_and_evict)
+
+    assert cache.get("entry") == [1, 2]
+    assert cache.get("entry") is None
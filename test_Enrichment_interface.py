@@ -0,0 +1,66 @@
+'''
+test_Enrichment_interface: Tests of Enrichment_interface
+
+usage: python3 -m pytest test_Enrichment_interface.py
+'''
+import subprocess
+import sys
+import threading
+import types
+from os import path
+
+import pytest
+
+pytest.importorskip("tkinter")
+
+import Enrichment_interface # pylint: disable=wrong-import-position
+
+def test_interface_import_leaves_out_analysis_modules():
+    '''
+    the GUI module does not import CSV2Excel or pandas, they are imported by the worker, and
+    CSV2Excel does not import openpyxl until a workbook is written
+    '''
+    result = subprocess.run([sys.executable, "-c", "import sys, Enrichment_interface; "\
+                            "print('CSV2Excel' in sys.modules, 'pandas' in sys.modules); "\
+                            "import CSV2Excel; print('openpyxl' in sys.modules)"],\
+                            cwd=path.dirname(path.abspath(__file__)), capture_output=True,\
+                            text=True, check=True)
+
+    assert result.stdout.split() == ["False", "False", "False"]
+
+def test_worker_cancels_running_and_queued_analyses(monkeypatch):
+    '''
+    cancel stops the running analysis after its current stage and removes the queued ones, the
+    next analysis submitted runs to the end
+    '''
+    started = threading.Event()
+    proceed = threading.Event()
+
+    def run_enrichment_analysis(name, hooks):
+        for stage in ["read", "average", "save"]:
+            if stage == "average" and name == "first":
+                started.set()
+                assert proceed.wait(10)
+            for hook in hooks:
+                hook({"stage" : stage, "expected_stages" : 3})
+
+    monkeypatch.setitem(sys.modules, "CSV2Excel", types.SimpleNamespace(\
+                        run_enrichment_analysis=run_enrichment_analysis))
+    worker = Enrichment_interface.AnalysisWorker()
+
+    worker.submit("first", ("first",))
+    assert started.wait(10)
+    worker.submit("second", ("second",))
+    assert worker.cancel() == 1
+    proceed.set()
+    worker.submit("third", ("third",))
+
+    events = []
+    while not events or events[-1][0] not in ("done", "error"):
+        events.append(worker.events.get(timeout=10))
+
+    assert events[0][0] == "loaded" and isinstance(events[0][1], float)
+    assert events[1:] == [("start", "first"), ("stage", ("read", 3)),\
+                        ("stage", ("average", 3)), ("cancelled", "first"), ("start", "third"),\
+                        ("stage", ("read", 3)), ("stage", ("average", 3)),\
+                        ("stage", ("save", 3)), ("done", "third")]
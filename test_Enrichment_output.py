@@ -0,0 +1,83 @@
+'''
+test_Enrichment_output: Tests of Enrichment_output
+
+usage: python3 -m pytest test_Enrichment_output.py
+'''
+import importlib.util
+import os
+
+import pandas as pd
+import pytest
+
+import Enrichment_output
+
+def test_check_backend_unknown():
+    '''
+    unknown backends are refused
+    '''
+    with pytest.raises(ValueError):
+        Enrichment_output.check_backend("xls")
+
+@pytest.mark.parametrize("backend", ["parquet", "hdf5"])
+def test_check_backend_missing_package(monkeypatch, backend):
+    '''
+    backends whose packages are not installed are refused before writing anything
+    '''
+    monkeypatch.setattr(importlib.util, "find_spec", lambda package: None)
+
+    with pytest.raises(ImportError):
+        Enrichment_output.check_backend(backend)
+    with pytest.raises(ImportError):
+        Enrichment_output.open_output("unused", backend)
+
+@pytest.mark.parametrize("backend", ["xlsx", "xlsx-stream", "csv", "npz"])
+def test_check_backend_without_requirements(monkeypatch, backend):
+    '''
+    backends without optional packages are always available
+    '''
+    monkeypatch.setattr(importlib.util, "find_spec", lambda package: None)
+
+    Enrichment_output.check_backend(backend)
+
+@pytest.mark.parametrize("backend", ["xlsx", "xlsx-stream", "csv", "npz"])
+def test_output_removed_when_run_fails(tmp_path, backend):
+    '''
+    outputs of a with block that raised are not left half written, other files are kept
+    '''
+    destination = str(tmp_path / ("out" + Enrichment_output.OUTPUT_EXTENSIONS[backend]))
+    (tmp_path / "other.txt").write_text("kept")
+
+    with pytest.raises(RuntimeError):
+        with Enrichment_output.open_output(destination, backend) as output:
+            output.write_sheet("Sheet", [(pd.DataFrame({"a" : [1, 2]}), 0, 0)])
+            raise RuntimeError("stage failed")
+
+    left = [str(file.relative_to(tmp_path)) for file in tmp_path.rglob("*") if file.is_file()]
+    assert left == ["other.txt"]
+
+@pytest.mark.parametrize("backend", ["xlsx", "xlsx-stream", "csv", "npz"])
+def test_output_saved_once_closed(tmp_path, backend):
+    '''
+    outputs closed inside the with block are saved once
+    '''
+    destination = str(tmp_path / ("out" + Enrichment_output.OUTPUT_EXTENSIONS[backend]))
+
+    with Enrichment_output.open_output(destination, backend) as output:
+        output.write_table("Sheet", pd.DataFrame({"a" : [1, 2]}))
+        output.close()
+
+    assert os.path.exists(destination)
+
+def test_write_sheet_tables_by_name(tmp_path):
+    '''
+    sheets given several tables save each of them, named by its key
+    '''
+    with Enrichment_output.open_output(str(tmp_path), "csv") as output:
+        output.write_sheet("Form Enrichment LE Top", [(pd.DataFrame({"LNP" : ["LNP1"]}), 0, 0)],\
+                            {"Form Enrichment LE Top" : pd.DataFrame({"Level" : ["TOTAL"]}),\
+                            "Form Enrichment LE Top_lnps" : pd.DataFrame({"LNP" : ["LNP1"]})})
+
+    assert sorted(os.listdir(str(tmp_path))) == ["Form Enrichment LE Top.csv",\
+                                                "Form Enrichment LE Top_lnps.csv"]
+    assert pd.read_csv(str(tmp_path / "Form Enrichment LE Top_lnps.csv"))["LNP"].tolist() ==\
+            ["LNP1"]
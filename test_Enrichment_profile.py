@@ -0,0 +1,62 @@
+'''
+test_Enrichment_profile: Tests of Enrichment_profile
+
+usage: python3 -m pytest test_Enrichment_profile.py
+'''
+import json
+
+import numpy as np
+import pytest
+
+import Enrichment_profile
+
+def test_stage_records_are_passed_to_hooks(tmp_path):
+    '''
+    each stage is passed to every hook as it ends, with its size, the bytes written to its
+    destination and the number of stages expected so far
+    '''
+    records = []
+    profiler = Enrichment_profile.Profiler(hooks=[records.append, records.append])
+    profiler.expect(2)
+    destination = tmp_path / "output"
+    destination.mkdir()
+
+    with profiler.stage("write", str(destination)) as record:
+        (destination / "sheet.csv").write_bytes(b"x"*100)
+        record["rows"], record["columns"] = 10, 3
+    assert records == [profiler.stages[0]]*2
+
+    profiler.expect(1)
+    with pytest.raises(ValueError):
+        with profiler.stage("fail"):
+            raise ValueError("stage failed")
+
+    assert [record["stage"] for record in profiler.stages] == ["write", "fail"]
+    assert profiler.stages[0]["rows"] == 10 and profiler.stages[0]["columns"] == 3
+    assert profiler.stages[0]["bytes_written"] == 100
+    assert profiler.stages[0]["expected_stages"] == 2
+    assert profiler.stages[1]["expected_stages"] == 3
+    assert profiler.stages[1]["rows"] is None
+    for record in profiler.stages:
+        assert record["wall_seconds"] >= 0 and record["cpu_seconds"] >= 0
+        assert record["peak_allocated_bytes"] is None
+
+    report_file = tmp_path / "profile.json"
+    profiler.write_report(str(report_file))
+    report = json.loads(report_file.read_text())
+    assert report["bytes_written"] == 100
+    assert [record["stage"] for record in report["stages"]] == ["write", "fail"]
+
+def test_stage_traces_allocations():
+    '''
+    with trace_allocations the peak memory allocated during each stage is recorded
+    '''
+    profiler = Enrichment_profile.Profiler(trace_allocations=True)
+
+    with profiler.stage("allocate"):
+        values = np.ones(10**6)
+    with profiler.stage("small"):
+        values = values[:10].copy()
+
+    assert profiler.stages[0]["peak_allocated_bytes"] >= 8*10**6
+    assert profiler.stages[1]["peak_allocated_bytes"] < 8*10**6
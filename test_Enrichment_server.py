@@ -0,0 +1,45 @@
+'''
+test_Enrichment_server: Tests of Enrichment_server
+
+usage: python3 -m pytest test_Enrichment_server.py
+'''
+import os
+
+import Enrichment_server
+
+def test_screen_key_changes_when_a_file_is_modified(tmp_path):
+    '''
+    a screen overwritten on the same path gets a new id, so the stale screen is not answered
+    '''
+    formulations_sheet = tmp_path / "formulations.xlsx"
+    csv_filepath = tmp_path / "normalized_counts.csv"
+    formulations_sheet.write_bytes(b"formulations")
+    csv_filepath.write_text("BC,AD LE1\nAAAA,1.0\n")
+
+    key = Enrichment_server.screen_key(str(formulations_sheet), str(csv_filepath), ["LE"], 99.9)
+    assert key == Enrichment_server.screen_key(str(formulations_sheet), str(csv_filepath),\
+                                                ["LE"], 99.9)
+
+    csv_filepath.write_text("BC,AD LE1\nAAAA,2.0\n")
+    stat = os.stat(str(csv_filepath))
+    os.utime(str(csv_filepath), ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    assert key != Enrichment_server.screen_key(str(formulations_sheet), str(csv_filepath),\
+                                                ["LE"], 99.9)
+
+def test_answer_unexpected_error_as_json_500():
+    '''
+    errors other than missing or invalid values are answered as json with status 500
+    '''
+    handler = Enrichment_server.EnrichmentRequestHandler.__new__(\
+                Enrichment_server.EnrichmentRequestHandler)
+    responses = []
+    handler.respond = lambda status, payload: responses.append((status, payload))
+    handler.log_error = lambda *args: None
+
+    handler.answer(lambda: 1/0)
+    handler.answer(lambda: {}["screen"])
+    handler.answer(lambda: {"x_percent" : 5})
+
+    assert responses == [(500, {"error" : "ZeroDivisionError: division by zero"}),\
+                        (404, {"error" : "screen"}), (200, {"x_percent" : 5})]